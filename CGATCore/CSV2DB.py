@@ -37,6 +37,7 @@ import tempfile
 from CGATCore import Experiment as E
 from CGATCore import CSV as CSV
 from CGATCore import IOTools as IOTools
+from CGATCore import Database as Database
 import sqlite3
 
 
@@ -207,6 +208,8 @@ def createTable(dbhandle,
                 E.info("existing table %s deleted" % tablename)
             except sqlite3.OperationalError as msg:
                 E.warn(msg)
+                if not retry:
+                    raise
                 time.sleep(5)
                 continue
             except error as msg:
@@ -253,7 +256,12 @@ def createTable(dbhandle,
     return take, map_column2type, ignored
 
 
-def run(infile, options, report_step=10000):
+def run(infile, options, report_step=10000, dbhandle=None):
+    """upload data from `infile` into a database table.
+
+    If `dbhandle` is given, the sqlite database connection is used
+    instead of opening a new one.
+    """
 
     options.tablename = quoteTableName(
         options.tablename, backend=options.backend)
@@ -300,20 +308,21 @@ def run(infile, options, report_step=10000):
 
     elif options.backend == "sqlite":
         import sqlite3
-        dbhandle = sqlite3.connect(options.database_name)
-        try:
-            os.chmod(options.database_name, 0o664)
-        except OSError as msg:
-            E.warn("could not change permissions of database: %s" % msg)
-
-        # Avoid the following error:
-        # sqlite3.ProgrammingError: You must not use 8-bit bytestrings
-        # unless you use a text_factory that can interpret 8-bit
-        # bytestrings (like text_factory = str). It is highly
-        # recommended that you instead just switch your application
-        # to Unicode strings
-        # Note: might be better to make csv2db unicode aware.
-        dbhandle.text_factory = str
+        if dbhandle is None:
+            dbhandle = sqlite3.connect(options.database_name)
+            try:
+                os.chmod(options.database_name, 0o664)
+            except OSError as msg:
+                E.warn("could not change permissions of database: %s" % msg)
+
+            # Avoid the following error:
+            # sqlite3.ProgrammingError: You must not use 8-bit bytestrings
+            # unless you use a text_factory that can interpret 8-bit
+            # bytestrings (like text_factory = str). It is highly
+            # recommended that you instead just switch your application
+            # to Unicode strings
+            # Note: might be better to make csv2db unicode aware.
+            dbhandle.text_factory = str
 
         error = sqlite3.OperationalError
         options.insert_many = True  # False
@@ -361,7 +370,7 @@ def run(infile, options, report_step=10000):
                 "undefined columns in input file at row: %s" % row)
 
         try:
-            rows.append(IOTools.convertDictionary(row, map=options.map))
+            rows.append(IOTools.convert_dictionary_values(row, map=options.map))
         except TypeError as msg:
             E.warn(
                 "incomplete line? Type error in conversion: "
@@ -429,7 +438,7 @@ def run(infile, options, report_step=10000):
                            null=options.null,
                            string_value=options.string_value)
         for data in reader:
-            yield quoteRow(IOTools.convertDictionary(data, map=options.map),
+            yield quoteRow(IOTools.convert_dictionary_values(data, map=options.map),
                            take,
                            map_column2type,
                            options.missing_values,
@@ -562,6 +571,11 @@ def run(infile, options, report_step=10000):
     E.info("ninput=%i, noutput=%i, nskipped_columns=%i" %
            (ninput, noutput, len(ignored)))
 
+    if options.backend == "sqlite":
+        Database.update_table_status(
+            dbhandle, options.tablename, noutput,
+            append=options.append and options.tablename in existing_tables)
+
     dbhandle.commit()
 
 
@@ -11,7 +11,9 @@ Reference
 '''
 import time
 import re
-from pandas import DataFrame
+
+# name of the table recording loads, see update_table_status
+TABLE_STATUS = "table_status"
 
 
 def executewait(dbhandle, statement, error=Exception, regex_error="locked",
@@ -73,6 +75,192 @@ def getTables(dbhandle):
     return tuple([x[0] for x in cc])
 
 
+def create_table_status(dbhandle):
+    """create the table ``table_status`` if it does not exist."""
+    executewait(
+        dbhandle,
+        "CREATE TABLE IF NOT EXISTS %s ("
+        "tablename TEXT PRIMARY KEY, nrows INTEGER, max_rowid INTEGER, "
+        "version INTEGER, created INTEGER, loaded REAL, "
+        "changed INTEGER DEFAULT 0)" % TABLE_STATUS)
+
+
+def get_table_status(dbhandle, tablename):
+    """return the status of a table recorded by
+    :func:`update_table_status` or :func:`refresh_table_status`.
+
+    Arguments
+    ---------
+    dbhandle : object
+        A handle to an sqlite database.
+    tablename : string
+        Name of the table.
+
+    Returns
+    -------
+    status : dict
+        Dictionary with the number of rows (``nrows``), the largest
+        rowid (``max_rowid``), the number of loads and changes
+        (``version``), the version at which the table was last created
+        (``created``), the time of the last load (``loaded``) and
+        whether rows have been updated or deleted since (``changed``).
+        Returns None if no status has been recorded for the table.
+    """
+    cc = executewait(
+        dbhandle,
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='%s'" %
+        TABLE_STATUS)
+    if cc.fetchone() is None:
+        return None
+
+    cc = executewait(
+        dbhandle,
+        "SELECT nrows, max_rowid, version, created, loaded, changed "
+        "FROM %s WHERE tablename = '%s'" % (TABLE_STATUS, tablename))
+    result = cc.fetchone()
+    if result is None:
+        return None
+    return dict(zip(("nrows", "max_rowid", "version", "created", "loaded",
+                     "changed"), result))
+
+
+def track_table_changes(dbhandle, tablename):
+    """add triggers recording updates and deletions of rows in a table.
+
+    The triggers set the ``changed`` flag of the table in
+    ``table_status``. Insertions are not tracked, as appended rows are
+    detected through the largest rowid. The triggers are dropped
+    together with the table.
+
+    Returns
+    -------
+    tracked : bool
+        True if the triggers existed already.
+    """
+    triggers = [("%s_%s_%s" % (TABLE_STATUS, tablename, x.lower()), x)
+                for x in ("UPDATE", "DELETE")]
+    cc = executewait(
+        dbhandle,
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='trigger' "
+        "AND name IN ('%s')" % "','".join(x[0] for x in triggers))
+    tracked = cc.fetchone()[0] == len(triggers)
+    for trigger, event in triggers:
+        executewait(
+            dbhandle,
+            "CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON %s BEGIN "
+            "UPDATE %s SET changed = 1 "
+            "WHERE tablename = '%s' AND changed = 0; END" % (
+                trigger, event, tablename, TABLE_STATUS, tablename))
+    return tracked
+
+
+def write_table_status(dbhandle, tablename, status):
+    """write the status of a table, see :func:`get_table_status`."""
+    dbhandle.execute(
+        "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?, ?)" %
+        TABLE_STATUS,
+        (tablename, status["nrows"], status["max_rowid"], status["version"],
+         status["created"], status["loaded"], status["changed"]))
+
+
+def update_table_status(dbhandle, tablename, nrows, append=False):
+    """record that data have been loaded into a table.
+
+    The status is stored in the table ``table_status`` of an sqlite
+    database and permits detecting changes to tables without scanning
+    them, see :func:`refresh_table_status`. The change is not
+    committed.
+
+    Arguments
+    ---------
+    dbhandle : object
+        A handle to an sqlite database.
+    tablename : string
+        Name of the table.
+    nrows : int
+        Number of rows in the table after loading.
+    append : bool
+        If True, rows have been appended to an existing table.
+        Otherwise the table has been created.
+    """
+    create_table_status(dbhandle)
+    tracked = track_table_changes(dbhandle, tablename)
+    max_rowid = executewait(
+        dbhandle, "SELECT MAX(rowid) FROM %s" % tablename).fetchone()[0]
+
+    status = get_table_status(dbhandle, tablename)
+    if status is None:
+        version, created = 1, 1
+    else:
+        version = status["version"] + 1
+        # rows changed outside of loads count as a new table
+        if append and tracked and not status["changed"]:
+            created = status["created"]
+        else:
+            created = version
+
+    write_table_status(dbhandle, tablename, {
+        "nrows": nrows, "max_rowid": max_rowid, "version": version,
+        "created": created, "loaded": time.time(), "changed": 0})
+
+
+def refresh_table_status(dbhandle, tablename):
+    """return the status of a table including changes made outside
+    of loads.
+
+    Rows updated or deleted since the last call, see
+    :func:`track_table_changes`, and rows appended other than by
+    :func:`update_table_status` increase the version of the table.
+    Tables without triggers are taken to have been created anew. The
+    change is not committed.
+
+    Arguments
+    ---------
+    dbhandle : object
+        A handle to an sqlite database.
+    tablename : string
+        Name of the table.
+
+    Returns
+    -------
+    status : dict
+        The status of the table, see :func:`get_table_status`. The
+        number of rows is None if the table has been changed outside
+        of loads. Returns None if `tablename` is not a table with
+        rowids, for example because it is a view.
+    """
+    cc = executewait(
+        dbhandle,
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='table' "
+        "AND name='%s'" % tablename)
+    if cc.fetchone()[0] == 0:
+        return None
+    try:
+        max_rowid = executewait(
+            dbhandle, "SELECT MAX(rowid) FROM %s" % tablename).fetchone()[0]
+    except Exception:
+        return None
+
+    create_table_status(dbhandle)
+    tracked = track_table_changes(dbhandle, tablename)
+    status = get_table_status(dbhandle, tablename)
+    if status is None:
+        status = {"nrows": None, "max_rowid": max_rowid, "version": 1,
+                  "created": 1, "loaded": None, "changed": 0}
+    elif tracked and not status["changed"] and \
+            max_rowid == status["max_rowid"]:
+        return status
+    else:
+        status["version"] += 1
+        if not tracked or status["changed"] or \
+           (max_rowid or 0) < (status["max_rowid"] or 0):
+            status["created"] = status["version"]
+        status.update({"nrows": None, "max_rowid": max_rowid, "changed": 0})
+
+    write_table_status(dbhandle, tablename, status)
+    return status
+
+
 def toTSV(dbhandle, outfile, statement, remove_none=True):
     '''execute statement and save as tsv file
     to disk.
@@ -205,6 +393,9 @@ def fetch_DataFrame(query,
                     attach=False):
     '''Fetch query results and returns them as a pandas dataframe'''
 
+    # pandas is slow to import and only needed here
+    from pandas import DataFrame
+
     dbhandle = connect(dbhandle, attach=attach)
 
     cc = dbhandle.cursor()
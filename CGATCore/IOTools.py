@@ -42,7 +42,6 @@ import gzip
 import subprocess
 import itertools
 import tempfile
-import paramiko
 import CGATCore.Experiment as E
 
 
@@ -258,6 +257,8 @@ def zap_file(filename):
 
     If the file is a link, the link will be broken and replaced with
     an empty file having the same attributes as the file linked to.
+    Similarly, a file with several hard links is unlinked and replaced
+    so that the data seen through the other links are left intact.
 
     Returns
     -------
@@ -279,6 +280,11 @@ def zap_file(filename):
         os.unlink(filename)
         f = open(filename, "w")
         f.close()
+    elif original.st_nlink > 1:
+        linkdest = None
+        os.unlink(filename)
+        f = open(filename, "w")
+        f.close()
     else:
         linkdest = None
         f = open(filename, "w")
@@ -1388,6 +1394,8 @@ def mount_file(fn):
 
 
 def remote_file_exists(filename, hostname=None, expect=False):
+    # paramiko is slow to import and only needed here
+    import paramiko
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     try:
@@ -36,9 +36,17 @@ def setup_drmaa_job_template(drmaa_session,
                              job_memory,
                              job_threads,
                              working_directory,
+                             job_dependencies=None,
                              **kwargs):
     '''Sets up a Drmma job template. Currently SGE, SLURM, Torque and PBSPro are
-       supported'''
+       supported.
+
+    If *job_dependencies* is given, it should be a list of job ids.
+    The job will be held by the scheduler until all jobs in the
+    list have completed successfully. Dependencies are not supported
+    for SGE, as ``-hold_jid`` releases jobs once their dependencies
+    have finished, whether they succeeded or not.
+    '''
     if not job_memory:
         raise ValueError("Job memory must be specified when running"
                          "DRMAA jobs")
@@ -84,6 +92,10 @@ def setup_drmaa_job_template(drmaa_session,
         elif kwargs['queue'] != "NONE":
             spec.append("-q {}".format(kwargs["queue"]))
 
+        if job_dependencies:
+            raise ValueError(
+                "job dependencies are not supported for SGE")
+
     elif queue_manager.lower() == "slurm":
 
         # SLURM DOCS:
@@ -131,6 +143,14 @@ def setup_drmaa_job_template(drmaa_session,
         # set the partition to use (equivalent of SGE queue)
         spec.append("--partition={}".format(kwargs["queue"]))
 
+        # SLURM users can only lower the priority of their jobs
+        if kwargs.get("nice", None):
+            spec.append("--nice={}".format(kwargs["nice"]))
+
+        if job_dependencies:
+            spec.append("--dependency=afterok:{}".format(
+                ":".join(map(str, job_dependencies))))
+
     elif queue_manager.lower() == "torque":
 
         # PBS Torque native specifictation:
@@ -141,6 +161,10 @@ def setup_drmaa_job_template(drmaa_session,
 
         spec.append(kwargs.get("options", ""))
 
+        if job_dependencies:
+            spec.append("-W depend=afterok:{}".format(
+                ":".join(map(str, job_dependencies))))
+
         # There is no equivalent to sge -V option for pbs-drmaa
         # recreating this...
         jt.jobEnvironment = os.environ
@@ -196,6 +220,10 @@ def setup_drmaa_job_template(drmaa_session,
         elif kwargs['queue'] != "NONE":
             spec.append("-q {}".format(kwargs["queue"]))
 
+        if job_dependencies:
+            spec.append("-W depend=afterok:{}".format(
+                ":".join(map(str, job_dependencies))))
+
         # As for torque, there is no equivalent to sge -V option for pbs-drmaa:
         jt.jobEnvironment = os.environ
         jt.jobEnvironment.update(
@@ -6,26 +6,35 @@ The functions :func:`write_config_files`, :func:`clean`,
 functionality for particular pipeline commands.
 
 :class:`MultiLineFormatter` improves the formatting
-of long log messages, while
+of long log messages, while :class:`ProgressTracker` reports
+the progress of a running pipeline.
 
 Reference
 ---------
 
 """
 
-from io import StringIO
 from multiprocessing.pool import ThreadPool
 import multiprocessing
+import collections
 import contextlib
+import fcntl
+import functools
+import glob
+import hashlib
 import json
 import logging
 import math
 import os
 import re
+import resource
 import shutil
+import sqlite3
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import gevent.pool
 import gevent.queue
@@ -45,50 +54,25 @@ except RuntimeError:
 
 import CGATCore.Experiment as E
 import CGATCore.IOTools as IOTools
-import CGATCore.Requirements as Requirements
-from CGATCore.Pipeline.Parameters import input_validation
-from CGATCore.Pipeline.Utils import get_caller, get_caller_locals
+import CGATCore.Pipeline.Parameters as Parameters
+from CGATCore.Pipeline.Parameters import input_validation, PARAMS
+from CGATCore.Pipeline.Utils import get_caller, get_caller_locals, is_test
+import CGATCore.Pipeline.Execution as Execution
+import CGATCore.Pipeline.Files as Files
 from CGATCore.Pipeline.Execution import execute, start_session,\
-    close_session
+    close_session, is_pending_output, wait_for_pending_jobs
 
 
-# redirect os.stat and other OS utilities to cached versions to speed
-# up ruffus. Be careful not to use os.stat in task functions.
-# Does ruffus rely on os.stat for completed tasks?
-SAVED_OS_STAT = os.stat
-SAVED_OS_PATH_ABSPATH = os.path.abspath
-SAVED_OS_PATH_REALPATH = os.path.realpath
-SAVED_OS_PATH_RELPATH = os.path.relpath
-SAVED_OS_PATH_ISLINK = os.path.islink
+# ioctl request to clone a file on copy-on-write file systems
+FICLONE = 0x40049409
 
+# file in the working directory recording the duration of
+# jobs in previous pipeline runs
+TASK_DURATIONS_FILE = ".task_durations.json"
 
-@E.cached_function
-def cached_os_stat(filename, *args, **kwargs):
-    return SAVED_OS_STAT(filename, *args, **kwargs)
-
-
-@E.cached_function
-def cached_os_path_abspath(filename):
-    return SAVED_OS_PATH_ABSPATH(filename)
-
-
-@E.cached_function
-def cached_os_path_realpath(filename):
-    return SAVED_OS_PATH_REALPATH(filename)
-
-
-@E.cached_function
-def cached_os_path_relpath(filename):
-    return SAVED_OS_PATH_RELPATH(filename)
-
-
-@E.cached_function
-def cached_os_path_islink(filename):
-    return SAVED_OS_PATH_ISLINK(filename)
-
-
-# Set from Pipeline.py
-PARAMS = {}
+# file in the working directory recording jobs submitted to the
+# cluster, see Execution.RunJournal
+RUN_JOURNAL_FILE = ".run_journal.jsonl"
 
 # global options and arguments - set but currently not
 # used as relevant sections are entered into the PARAMS
@@ -174,7 +158,80 @@ def print_config_files():
             s -= 1
 
 
-def clone_pipeline(srcdir, destdir=None):
+def reflink_file(infile, outfile):
+    """create `outfile` as a copy-on-write clone of `infile`.
+
+    This requires a file system supporting reflinks, for example
+    btrfs or xfs. An OSError is raised otherwise.
+    """
+    with open(infile, "rb") as inf, open(outfile, "wb") as outf:
+        fcntl.ioctl(outf.fileno(), FICLONE, inf.fileno())
+    shutil.copystat(infile, outfile)
+
+
+def link_file(infile, outfile, link_mode="symlink"):
+    """link `outfile` to `infile`.
+
+    If a hardlink or reflink can not be created, for example because
+    source and destination are on different file systems, a symbolic
+    link is created instead.
+
+    Arguments
+    ---------
+    infile : string
+        Source file.
+    outfile : string
+        Destination file.
+    link_mode : string
+        One of ``symlink``, ``hardlink`` or ``reflink``.
+
+    Returns
+    -------
+    link_mode : string
+        The type of link that was created.
+    """
+    if link_mode == "hardlink":
+        try:
+            os.link(infile, outfile)
+            return "hardlink"
+        except OSError:
+            pass
+    elif link_mode == "reflink":
+        try:
+            reflink_file(infile, outfile)
+            return "reflink"
+        except (OSError, IOError):
+            if os.path.exists(outfile):
+                os.unlink(outfile)
+
+    os.symlink(infile, outfile)
+    return "symlink"
+
+
+def copy_database(infile, outfile):
+    """copy a database file.
+
+    SQLite databases are copied with the online backup API, giving a
+    consistent copy even if the database is being written to. Other
+    files are copied verbatim.
+    """
+    with open(infile, "rb") as inf:
+        header = inf.read(16)
+
+    if header != b"SQLite format 3\x00":
+        shutil.copyfile(infile, outfile)
+        return
+
+    source = sqlite3.connect(infile)
+    target = sqlite3.connect(outfile)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def clone_pipeline(srcdir, destdir=None, link_mode="symlink", threads=10):
     '''clone a pipeline.
 
     Cloning entails creating a mirror of the source pipeline.
@@ -189,18 +246,43 @@ def clone_pipeline(srcdir, destdir=None):
     Cloning pipelines permits sharing partial results between
     pipelines, for example for parameter optimization.
 
+    The source directory is scanned one level at a time and
+    directories are created and files linked by a pool of threads.
+
+    Data files are linked according to `link_mode`:
+
+    ``symlink``
+        symbolic link to the original file (default).
+    ``hardlink``
+        hard link to the original file. Note that files modified
+        in place will be modified in both pipelines.
+    ``reflink``
+        copy-on-write clone of the original file. This requires
+        file system support.
+
     Arguments
     ---------
     scrdir : string
         Source directory
     destdir : string
         Destination directory. If None, use the current directory.
+    link_mode : string
+        How to link data files, see above.
+    threads : int
+        Number of threads to use.
 
+    Returns
+    -------
+    counter : E.Counter
+        Counts of directories, copied files and links created.
     '''
 
     if destdir is None:
         destdir = os.path.curdir
 
+    if link_mode not in ("symlink", "hardlink", "reflink"):
+        raise ValueError("unknown link mode '%s'" % link_mode)
+
     get_logger().info("cloning pipeline from %s to %s" % (srcdir, destdir))
 
     copy_files = ("conf.py", "pipeline.ini", "benchmark.yml", "csvdb")
@@ -215,43 +297,137 @@ def clone_pipeline(srcdir, destdir=None):
                 return True
         return False
 
-    for root, dirs, files in os.walk(srcdir):
+    def _scan(relpath):
+        dirs, files = [], []
+        with os.scandir(os.path.join(srcdir, relpath)) as it:
+            for entry in it:
+                if _ignore(entry.name):
+                    continue
+                path = os.path.join(relpath, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append((path, entry.stat(follow_symlinks=False)))
+                else:
+                    files.append(path)
+        return dirs, files
+
+    def _mkdir(relpath):
+        os.mkdir(os.path.join(destdir, relpath))
+
+    def _clone(relpath):
+        fn = os.path.join(srcdir, relpath)
+        dest_fn = os.path.join(destdir, relpath)
+        if os.path.basename(relpath) == "csvdb":
+            copy_database(fn, dest_fn)
+            return "copied"
+        elif os.path.basename(relpath) in copy_files:
+            shutil.copyfile(fn, dest_fn)
+            return "copied"
+        else:
+            # realpath resolves links - thus links will be linked to
+            # the original target
+            return link_file(os.path.realpath(fn), dest_fn, link_mode)
 
-        relpath = os.path.relpath(root, srcdir)
-        if _ignore(relpath):
-            continue
+    c = E.Counter()
+    directories = []
+    pool = ThreadPool(max(1, threads))
+    try:
+        level = [os.path.curdir]
+        while level:
+            next_level = []
+            for dirs, files in pool.map(_scan, level):
+                directories.extend(dirs)
+                next_level.extend([x[0] for x in dirs])
+                for result in pool.imap_unordered(_clone, files,
+                                                  chunksize=16):
+                    c[result] += 1
+            pool.map(_mkdir, next_level)
+            c.directories += len(next_level)
+            level = next_level
+    finally:
+        pool.terminate()
+
+    # touch directories last as creating files updates their
+    # modification times. Deepest directories are listed last.
+    for relpath, s in reversed(directories):
+        os.utime(os.path.join(destdir, relpath), (s.st_atime, s.st_mtime))
+
+    get_logger().info("cloned pipeline: %s" % c)
 
-        for d in dirs:
-            if _ignore(d):
-                continue
-            dest = os.path.join(os.path.join(destdir, relpath, d))
-            os.mkdir(dest)
-            # touch
-            s = os.stat(os.path.join(root, d))
-            os.utime(dest, (s.st_atime, s.st_mtime))
-
-        for f in files:
-            if _ignore(f):
-                continue
+    return c
 
-            fn = os.path.join(root, f)
-            dest_fn = os.path.join(destdir, relpath, f)
-            if f in copy_files:
-                shutil.copyfile(fn, dest_fn)
-            else:
-                # realpath resolves links - thus links will be linked to
-                # the original target
-                os.symlink(os.path.realpath(fn),
-                           dest_fn)
 
+def zap_files(files, threads=10):
+    """zap files in parallel.
+
+    Zapping files on a network file system is dominated by the
+    latency of metadata operations. These are overlapped by zapping
+    files from a pool of threads.
+
+    Arguments
+    ---------
+    files : list
+        List of filenames.
+    threads : int
+        Number of threads to use.
+
+    Returns
+    -------
+    iterator
+        Iterator over tuples of (filename, stat, linkdest) as returned
+        by :func:`IOTools.zap_file`, in the order files are processed.
+    """
+    def _zap(fn):
+        st, linkdest = IOTools.zap_file(fn)
+        return fn, st, linkdest
+
+    pool = ThreadPool(max(1, threads))
+    try:
+        for result in pool.imap_unordered(_zap, files, chunksize=16):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def get_reclaimable_bytes(fn):
+    """return the size of `fn` and the number of bytes zapping
+    it would reclaim.
 
-def clean(files, logfile):
+    Zapping a symbolic link or a file with several hard links does
+    not free the data, which remain accessible through the other
+    links. Broken symbolic links have a size of 0.
+
+    Returns
+    -------
+    size : int
+        Size of the file, following symbolic links.
+    reclaimable : int
+        Number of bytes reclaimed by zapping the file.
+    """
+    st = os.lstat(fn)
+    if stat.S_ISLNK(st.st_mode):
+        try:
+            return os.stat(fn).st_size, 0
+        except OSError:
+            # the target does not exist
+            return 0, 0
+    if st.st_nlink > 1:
+        return st.st_size, 0
+    return st.st_size, st.st_size
+
+
+def clean(files, logfile, threads=10, batch_size=1000, dry_run=None):
     '''clean up files given by glob expressions.
 
     Files are cleaned up by zapping, i.e. the files are set to size
-    0. Links to files are replaced with place-holders.
+    0. Links to files are replaced with place-holders. Files are
+    zapped in parallel by a pool of threads (see :func:`zap_files`).
 
     Information about the original file is written to `logfile`.
+    Lines are written in batches of `batch_size`.
+
+    In a dry run, no files are changed and the number of bytes that
+    would be reclaimed is reported instead. Links are not counted
+    towards the bytes reclaimed, see :func:`get_reclaimable_bytes`.
 
     Arguments
     ---------
@@ -259,56 +435,220 @@ def clean(files, logfile):
         List of glob expressions of files to clean up.
     logfile : string
         Filename of logfile.
+    threads : int
+        Number of threads to use.
+    batch_size : int
+        Number of lines to collect before writing to `logfile`.
+    dry_run : bool
+        If True, only report what would be done. If None, the
+        value of the ``dryrun`` parameter is used.
 
+    Returns
+    -------
+    counter : E.Counter
+        Counts of files, zapped files, links and bytes reclaimed.
     '''
     fields = ('st_atime', 'st_blksize', 'st_blocks',
               'st_ctime', 'st_dev', 'st_gid', 'st_ino',
               'st_mode', 'st_mtime', 'st_nlink',
               'st_rdev', 'st_size', 'st_uid')
 
-    dry_run = PARAMS.get("dryrun", False)
-
-    if not dry_run:
-        if not os.path.exists(logfile):
-            outfile = IOTools.open_file(logfile, "w")
-            outfile.write("filename\tzapped\tlinkdest\t%s\n" %
-                          "\t".join(fields))
-        else:
-            outfile = IOTools.open_file(logfile, "a")
+    if dry_run is None:
+        dry_run = PARAMS.get("dryrun", False)
 
     c = E.Counter()
-    for fn in files:
-        c.files += 1
-        if not dry_run:
-            stat, linkdest = IOTools.zap_file(fn)
-            if stat is not None:
-                c.zapped += 1
-                if linkdest is not None:
-                    c.links += 1
-                outfile.write("%s\t%s\t%s\t%s\n" % (
-                    fn,
-                    time.asctime(time.localtime(time.time())),
-                    linkdest,
-                    "\t".join([str(getattr(stat, x)) for x in fields])))
+
+    if dry_run:
+        pool = ThreadPool(max(1, threads))
+        try:
+            for size, reclaimable in pool.imap_unordered(
+                    get_reclaimable_bytes, files, chunksize=16):
+                c.files += 1
+                if size > 0:
+                    c.zapped += 1
+                    c.bytes += reclaimable
+        finally:
+            pool.terminate()
+        get_logger().info(
+            "dry-run: zapping %i of %i files would reclaim %i bytes" %
+            (c.zapped, c.files, c.bytes))
+        return c
+
+    if not os.path.exists(logfile):
+        outfile = IOTools.open_file(logfile, "w")
+        outfile.write("filename\tzapped\tlinkdest\t%s\n" %
+                      "\t".join(fields))
+    else:
+        outfile = IOTools.open_file(logfile, "a")
+
+    lines, zapped = [], []
+    try:
+        for fn, st, linkdest in zap_files(files, threads=threads):
+            c.files += 1
+            if st is None:
+                continue
+            zapped.append(fn)
+            c.zapped += 1
+            if linkdest is not None:
+                c.links += 1
+            elif st.st_nlink == 1:
+                c.bytes += st.st_size
+            lines.append("%s\t%s\t%s\t%s\n" % (
+                fn,
+                time.asctime(time.localtime(time.time())),
+                linkdest,
+                "\t".join([str(getattr(st, x)) for x in fields])))
+            if len(lines) >= batch_size:
+                outfile.write("".join(lines))
+                lines = []
+    finally:
+        # record files zapped so far even if zapping failed
+        outfile.write("".join(lines))
+        outfile.close()
+        Files.invalidate_file_metadata(zapped)
 
     get_logger().info("zapped: %s" % (c))
-    outfile.close()
 
     return c
 
 
+def get_peek_parameters_key(workingdir, pipeline):
+    """return key identifying the parameters of `pipeline` in `workingdir`.
+
+    The key consists of two parts. The first is derived from
+    `workingdir` and `pipeline` and is shared by all keys for the same
+    pipeline. The second is computed from the modification times and
+    sizes of the pipeline script and of all configuration files it
+    might read, so that the key changes whenever any of these change.
+
+    Returns
+    -------
+    key : string
+    prefix : string
+        Prefix shared by all keys for `pipeline` in `workingdir`.
+    """
+    filenames = [pipeline,
+                 Parameters.__file__,
+                 "/etc/cgat/pipeline.ini",
+                 os.path.join(os.path.expanduser("~"), ".daisy.yml")]
+    for dirname in (workingdir,
+                    os.path.dirname(workingdir),
+                    os.path.dirname(pipeline),
+                    os.path.splitext(pipeline)[0]):
+        for pattern in ("*.yml", "*.ini"):
+            filenames.extend(glob.glob(os.path.join(dirname, pattern)))
+
+    signature = [os.path.abspath(workingdir),
+                 os.environ.get("TMPDIR", ""),
+                 os.environ.get("SHARED_TMPDIR", "")]
+    for filename in sorted(set(filenames)):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        signature.append((filename, st.st_mtime, st.st_size))
+
+    prefix = hashlib.sha1(json.dumps(
+        [os.path.abspath(workingdir),
+         os.path.abspath(pipeline)]).encode("utf-8")).hexdigest() + "-"
+    return (prefix + hashlib.sha1(
+        json.dumps(signature).encode("utf-8")).hexdigest(), prefix)
+
+
+def load_pipeline_parameters(workingdir,
+                             pipeline,
+                             filenames=None,
+                             defaults=None):
+    """load configuration parameters of a pipeline without running it.
+
+    The parameters are built in-process from the configuration files
+    of the pipeline. Parameters that the pipeline sets in code, for
+    example through the `defaults` argument of
+    :func:`Parameters.get_parameters`, are not visible unless they are
+    supplied through `defaults`.
+
+    Arguments
+    ---------
+    workingdir : string
+       Working directory of the pipeline.
+    pipeline : string
+       Path to the pipeline script.
+    filenames : list
+       Configuration files to read. Relative paths are interpreted
+       relative to `workingdir`. The default is the CGAT convention of
+       :file:`pipeline.yml` in the pipeline's source directory, the
+       parent directory and the working directory.
+    defaults : dict
+       Default values.
+
+    Returns
+    -------
+    config : dict
+        Dictionary of configuration values.
+    """
+    if filenames is None:
+        filenames = [
+            os.path.join(os.path.splitext(pipeline)[0], "pipeline.yml"),
+            "../pipeline.yml",
+            "pipeline.yml"]
+    filenames = [os.path.join(workingdir, x) for x in filenames]
+    return Parameters.build_parameters(filenames,
+                                       defaults=defaults,
+                                       workingdir=workingdir)
+
+
+def run_peek_parameters(workingdir, pipeline):
+    """execute `pipeline` in `workingdir` and return its parameters."""
+    statement = "python %s -f -v 0 dump" % pipeline
+    process = subprocess.Popen(statement,
+                               cwd=workingdir,
+                               shell=True,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    # process.stdin.close()
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise OSError(
+            ("Child was terminated by signal %i: \n"
+             "Statement: %s\n"
+             "The stderr was: \n%s\n"
+             "Stdout: %s") %
+            (-process.returncode, statement, stderr, stdout))
+
+    # subprocess only accepts encoding argument in py >= 3.6 so
+    # decode here.
+    stdout = stdout.decode("utf-8").splitlines()
+    # remove any log messages
+    stdout = [x for x in stdout if x.startswith("{")]
+    if len(stdout) > 1:
+        raise ValueError("received multiple configurations")
+
+    return json.loads(stdout[0])
+
+
 def peek_parameters(workingdir,
                     pipeline,
                     on_error_raise=None,
                     prefix=None,
                     update_interface=False,
-                    restrict_interface=False):
+                    restrict_interface=False,
+                    use_cache=True,
+                    in_process=False):
     '''peek configuration parameters from external pipeline.
 
     As the paramater dictionary is built at runtime, this method
     executes the pipeline in workingdir, dumping its configuration
     values and reading them into a dictionary.
 
+    Results are cached on disk in the directory returned by
+    :func:`Files.get_cache_dir`. The cache is keyed by the
+    modification times of the pipeline script and its configuration
+    files (see :func:`get_peek_parameters_key`), so that the pipeline
+    is only executed again if any of these have changed. Only the
+    latest result for a pipeline is kept.
+
     If either `pipeline` or `workingdir` are not found, an error is
     raised. This behaviour can be changed by setting `on_error_raise`
     to False. In that case, an empty dictionary is returned.
@@ -337,6 +677,11 @@ def peek_parameters(workingdir,
        transparent access to files in the external pipeline.
     restrict_interface : bool
        If  True, only interface parameters will be imported.
+    use_cache : bool
+       If True, re-use parameters from a previous call.
+    in_process : bool
+       If True, do not execute the pipeline but read its configuration
+       files with :func:`load_pipeline_parameters`.
 
     Returns
     -------
@@ -348,7 +693,7 @@ def peek_parameters(workingdir,
 
     # check if we should raise errors
     if on_error_raise is None:
-        on_error_raise = not isTest() and \
+        on_error_raise = not is_test() and \
             "__name__" in caller_locals and \
             caller_locals["__name__"] == "__main__"
 
@@ -398,32 +743,34 @@ def peek_parameters(workingdir,
         else:
             return {}
 
-    statement = "python %s -f -v 0 dump" % pipeline
-    process = subprocess.Popen(statement,
-                               cwd=workingdir,
-                               shell=True,
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-
-    # process.stdin.close()
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        raise OSError(
-            ("Child was terminated by signal %i: \n"
-             "Statement: %s\n"
-             "The stderr was: \n%s\n"
-             "Stdout: %s") %
-            (-process.returncode, statement, stderr, stdout))
-
-    # subprocess only accepts encoding argument in py >= 3.6 so
-    # decode here.
-    stdout = stdout.decode("utf-8").splitlines()
-    # remove any log messages
-    stdout = [x for x in stdout if x.startswith("{")]
-    if len(stdout) > 1:
-        raise ValueError("received multiple configurations")
-    dump = json.loads(stdout[0])
+    if in_process:
+        dump = load_pipeline_parameters(workingdir, pipeline)
+    else:
+        cache_filename = None
+        dump = None
+        if use_cache:
+            key, cache_prefix = get_peek_parameters_key(workingdir, pipeline)
+            cache_filename = os.path.join(
+                Files.get_cache_dir("peek_parameters"), key + ".json")
+            try:
+                with open(cache_filename) as inf:
+                    dump = json.load(inf)
+                get_logger().debug(
+                    "read parameters of {} from {}".format(
+                        pipeline, cache_filename))
+            except (IOError, ValueError):
+                dump = None
+
+        if dump is None:
+            dump = run_peek_parameters(workingdir, pipeline)
+            if cache_filename is not None:
+                # write to a temporary file first so that concurrent
+                # readers never see a partial file
+                tmpfile = "{}.{}.tmp".format(cache_filename, os.getpid())
+                with open(tmpfile, "w") as outf:
+                    json.dump(dump, outf)
+                os.replace(tmpfile, cache_filename)
+                Files.prune_cache_files(cache_filename, cache_prefix)
 
     # update interface
     if update_interface:
@@ -522,6 +869,137 @@ def ruffus_return_dag(stream,
                 stack.append(tt)
 
 
+def load_task_durations(filename=TASK_DURATIONS_FILE):
+    """return mean job durations of tasks recorded in previous runs.
+
+    Returns
+    -------
+    durations : dict
+        Dictionary mapping task function names to mean job duration
+        in seconds.
+    """
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as inf:
+            return json.load(inf)
+    except ValueError:
+        get_logger().warn("could not read task durations from {}".format(
+            filename))
+        return {}
+
+
+def save_task_durations(filename=TASK_DURATIONS_FILE):
+    """add job durations of this session to the durations
+    recorded in *filename*."""
+    if not Execution.TASK_DURATIONS:
+        return
+    durations = load_task_durations(filename)
+    for task_name, counts in Execution.TASK_DURATIONS.items():
+        njobs, total = counts[:2]
+        durations[task_name] = total / njobs
+    with open(filename, "w") as outf:
+        json.dump(durations, outf, indent=1, sort_keys=True)
+
+
+def compute_task_criticality(target_tasks=[],
+                             pipeline=None,
+                             durations=None,
+                             checksum_level=None,
+                             history_file=None):
+    """compute criticality of tasks from the ruffus DAG.
+
+    The criticality of a task is the length of the longest path from
+    the task to the end of the pipeline relative to the length of the
+    critical path of the pipeline. Path lengths are computed from task
+    durations. Tasks without a recorded duration are given the mean
+    duration of all tasks with a recorded duration.
+
+    Arguments
+    ---------
+    target_tasks : list
+        Targets of the pipeline.
+    pipeline : object
+        Ruffus pipeline.
+    durations : dict
+        Mean job duration per task function name, see
+        :func:`load_task_durations`.
+    checksum_level : int
+        Ruffus checksum level.
+    history_file : string
+        Ruffus job history file. Defaults to the ruffus default.
+
+    Returns
+    -------
+    criticality : dict
+        Dictionary mapping task function names to a value between 0
+        and 1, where 1 denotes tasks on the critical path.
+    """
+    if durations is None:
+        durations = {}
+
+    (checksum_level,
+     job_history,
+     pipeline,
+     runtime_data,
+     target_tasks,
+     forcedtorun_tasks) = _pipeline_prepare_to_run(
+         checksum_level,
+         history_file,
+         pipeline,
+         None,
+         target_tasks,
+         [])
+
+    # collect tasks and downstream edges by walking upstream from targets
+    downstream = collections.defaultdict(set)
+    stack = list(target_tasks)
+    visited = set(stack)
+    while stack:
+        t = stack.pop()
+        for tt in t._get_inward():
+            downstream[tt].add(t)
+            if tt not in visited:
+                visited.add(tt)
+                stack.append(tt)
+
+    if durations:
+        default_duration = float(sum(durations.values())) / len(durations)
+    else:
+        default_duration = 1.0
+
+    path_lengths = {}
+
+    def path_length(task):
+        # iterative depth-first evaluation to avoid recursion limits
+        todo = [task]
+        while todo:
+            t = todo[-1]
+            pending = [x for x in downstream[t] if x not in path_lengths]
+            if pending:
+                todo.extend(pending)
+                continue
+            todo.pop()
+            if t in path_lengths:
+                continue
+            path_lengths[t] = durations.get(t.func_name, default_duration) + \
+                max([path_lengths[x] for x in downstream[t]] or [0])
+        return path_lengths[task]
+
+    for t in visited:
+        path_length(t)
+
+    longest = max(list(path_lengths.values()) or [0])
+    if longest <= 0:
+        return {}
+
+    criticality = {}
+    for t, length in path_lengths.items():
+        criticality[t.func_name] = max(
+            criticality.get(t.func_name, 0), length / longest)
+    return criticality
+
+
 def setup_logging(options, pipeline=None):
 
     logger = logging.getLogger("daisy.pipeline")
@@ -553,7 +1031,60 @@ def setup_logging(options, pipeline=None):
     return logger
 
 
+def read_git_revision(dirname):
+    """return the commit checked out in the git repository at `dirname`.
+
+    The revision is read from the repository metadata directly, which
+    avoids starting a git process. Returns None if the revision can
+    not be determined.
+    """
+    dirname = os.path.abspath(dirname)
+    while not os.path.exists(os.path.join(dirname, ".git")):
+        parent = os.path.dirname(dirname)
+        if parent == dirname:
+            return None
+        dirname = parent
+
+    gitdir = os.path.join(dirname, ".git")
+    if not os.path.isdir(gitdir):
+        return None
+
+    try:
+        with open(os.path.join(gitdir, "HEAD")) as inf:
+            head = inf.read().strip()
+        if not head.startswith("ref:"):
+            return head
+
+        ref = head[len("ref:"):].strip()
+        fn = os.path.join(gitdir, ref)
+        if os.path.exists(fn):
+            with open(fn) as inf:
+                return inf.read().strip()
+
+        with open(os.path.join(gitdir, "packed-refs")) as inf:
+            for line in inf:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except IOError:
+        pass
+    return None
+
+
+@functools.lru_cache(maxsize=None)
 def get_version():
+    """return the version of the code base.
+
+    The lookup is done once per process.
+    """
+    # git would fail without a working directory
+    if not os.path.isdir(PARAMS["scriptsdir"]):
+        return "NA"
+
+    version = read_git_revision(PARAMS["scriptsdir"])
+    if version is not None:
+        return version
+
     # try git:
     try:
         stdout, stderr = execute(
@@ -744,6 +1275,52 @@ def parse_commandline(argv=None, **kwargs):
                       help="perform input validation before starting "
                       "[default=%default].")
 
+    parser.add_option("--prefetch-metadata", dest="prefetch_metadata",
+                      action="store_true",
+                      help="read the metadata of all files in the working "
+                      "directory before checking which tasks are up-to-date. "
+                      "This speeds up pipelines on network file systems "
+                      "[default=%default].")
+
+    parser.add_option("--metrics-file", dest="metrics_file",
+                      type="string",
+                      help="periodically write metrics of the running "
+                      "pipeline in Prometheus text format to this file "
+                      "[default=%default].")
+
+    parser.add_option("--metrics-port", dest="metrics_port",
+                      type="int",
+                      help="serve metrics of the running pipeline "
+                      "on this port on localhost [default=%default].")
+
+    parser.add_option("--metrics-interval", dest="metrics_interval",
+                      type="float",
+                      help="interval in seconds between metrics "
+                      "updates [default=%default].")
+
+    parser.add_option("--critical-path-priorities",
+                      dest="critical_path_priorities",
+                      action="store_true",
+                      help="lower the priority of jobs that are not on the "
+                      "critical path of the pipeline. Path lengths are "
+                      "estimated from the job durations of previous "
+                      "successful runs with this option. Jobs running "
+                      "locally are started with a higher nice value, "
+                      "the order in which they are started is not "
+                      "changed [default=%default].")
+
+    parser.add_option("--cluster-dependencies", dest="cluster_dependencies",
+                      action="store_true",
+                      help="submit cluster jobs ahead of time and let the "
+                      "scheduler hold jobs until their inputs have been "
+                      "computed [default=%default].")
+
+    parser.add_option("--clone-mode", dest="clone_mode",
+                      type="choice",
+                      choices=("symlink", "hardlink", "reflink"),
+                      help="how data files are linked when cloning a "
+                      "pipeline [default=%default].")
+
     parser.add_option_group(group)
 
     parser.set_defaults(
@@ -766,7 +1343,14 @@ def parse_commandline(argv=None, **kwargs):
         work_dir=None,
         always_mount=False,
         only_info=False,
-        input_validation=False)
+        input_validation=False,
+        prefetch_metadata=False,
+        metrics_file=None,
+        metrics_port=None,
+        metrics_interval=10,
+        critical_path_priorities=False,
+        cluster_dependencies=False,
+        clone_mode="symlink")
 
     parser.set_defaults(**kwargs)
 
@@ -803,6 +1387,8 @@ def update_params_with_commandline_options(params, options):
             options.cluster_parallel_environment
     if options.without_cluster:
         params["without_cluster"] = True
+    if options.cluster_dependencies:
+        params["cluster"]["dependencies"] = True
 
     params["shell_logfile"] = options.shell_logfile
 
@@ -823,41 +1409,150 @@ def update_params_with_commandline_options(params, options):
 
 
 @contextlib.contextmanager
-def cache_os_functions():
-    os.stat = cached_os_stat
-    os.path.abspath = cached_os_path_abspath
-    os.path.realpath = cached_os_path_realpath
-    os.path.relpath = cached_os_path_relpath
-    os.path.islink = cached_os_path_islink
+def cache_os_functions(maxsize=100000):
+    """redirect os.stat and other OS utilities to cached versions
+    to speed up ruffus.
 
-    yield
+    The cache is kept up-to-date for files created through
+    :func:`run` and for the output files of each job once the task
+    function has returned. Be careful when modifying other files
+    within task functions.
 
-    os.stat = SAVED_OS_STAT
-    os.path.abspath = SAVED_OS_PATH_ABSPATH
-    os.path.realpath = SAVED_OS_PATH_REALPATH
-    os.path.relpath = SAVED_OS_PATH_RELPATH
-    os.path.islink = SAVED_OS_PATH_ISLINK
+    Arguments
+    ---------
+    maxsize : int
+        Maximum number of entries per cached function.
+    """
+    cache = Files.FileMetadataCache(maxsize=maxsize)
+    Files.FILE_METADATA_CACHE = cache
+    saved_run_job = ruffus.task.run_pooled_job_without_exceptions
 
+    def run_pooled_job_without_exceptions(process_parameters):
+        try:
+            return saved_run_job(process_parameters)
+        finally:
+            # task functions might write their output without P.run
+            params = process_parameters[0]
+            if len(params) > 1:
+                cache.invalidate(
+                    ruffus.ruffus_utility.get_strings_in_flattened_sequence(
+                        params[1]))
+
+    os.stat = cache.stat
+    os.path.abspath = cache.abspath
+    os.path.realpath = cache.realpath
+    os.path.relpath = cache.relpath
+    os.path.islink = cache.islink
+    os.chdir = cache.chdir
+    ruffus.task.run_pooled_job_without_exceptions = \
+        run_pooled_job_without_exceptions
+
+    try:
+        yield cache
+    finally:
+        os.stat = Files.SAVED_OS_STAT
+        os.path.abspath = Files.SAVED_OS_PATH_ABSPATH
+        os.path.realpath = Files.SAVED_OS_PATH_REALPATH
+        os.path.relpath = Files.SAVED_OS_PATH_RELPATH
+        os.path.islink = Files.SAVED_OS_PATH_ISLINK
+        os.chdir = Files.SAVED_OS_CHDIR
+        ruffus.task.run_pooled_job_without_exceptions = saved_run_job
+        Files.FILE_METADATA_CACHE = None
+        get_logger().info("file metadata cache: {}".format(cache.counts))
+
+
+def cluster_only(func):
+    '''mark a task function that only runs jobs on the cluster.
+
+    Jobs of such tasks are started while their input files are still
+    being created by jobs that have been submitted ahead to the
+    cluster. The scheduler holds the jobs submitted by :func:`run`
+    until their inputs have been created. Functions that read their
+    input files within the pipeline process must not be marked.
+
+    Submitting jobs ahead only shortens the time between dependent
+    jobs of marked tasks. Jobs of all other tasks start once the jobs
+    creating their input files have been collected, see
+    :func:`allow_pending_inputs`.
+    '''
+    func.cluster_only = True
+    return func
 
-class LoggingFilterProgress(logging.Filter):
-    """add progress information to the log-stream.
+
+@contextlib.contextmanager
+def allow_pending_inputs():
+    '''let ruffus start jobs whose input files are still being
+    created by jobs that have been submitted ahead to the cluster.
+
+    Before running a job, ruffus checks that all input files
+    exist. Files that will be created by pending jobs are exempted
+    from this check. Before the task function is called, the pending
+    jobs creating its input files are waited for unless the function
+    has been marked with :func:`cluster_only`.
+    '''
+    saved_check = ruffus.task.check_input_files_exist
+    saved_run_job = ruffus.task.run_pooled_job_without_exceptions
+
+    def check_input_files_exist(*params):
+        if len(params):
+            input_files = [x for x in
+                           ruffus.ruffus_utility.get_strings_in_flattened_sequence(
+                               params[0])
+                           if not is_pending_output(x)]
+            params = (input_files,) + tuple(params[1:])
+        return saved_check(*params)
+
+    def run_pooled_job_without_exceptions(process_parameters):
+        process_parameters = list(process_parameters)
+        params, func = process_parameters[0], process_parameters[6]
+        if Execution.PENDING_OUTPUTS and \
+           not getattr(func, "cluster_only", False):
+
+            @functools.wraps(func)
+            def wait_and_run(*args, **kwargs):
+                wait_for_pending_jobs(
+                    Execution.get_pending_job_ids(params[:1]))
+                return func(*args, **kwargs)
+
+            process_parameters[6] = wait_and_run
+        return saved_run_job(tuple(process_parameters))
+
+    ruffus.task.check_input_files_exist = check_input_files_exist
+    ruffus.task.run_pooled_job_without_exceptions = \
+        run_pooled_job_without_exceptions
+    try:
+        yield
+    finally:
+        ruffus.task.check_input_files_exist = saved_check
+        ruffus.task.run_pooled_job_without_exceptions = saved_run_job
+
+
+class ProgressTracker(object):
+    """track the progress of tasks and jobs while a pipeline is running.
 
     A :term:`task` is a ruffus_ decorated function, which will execute
     one or more :term:`jobs`.
 
-    Valid task/job status:
-    update
-       task/job needs updating
+    The tracker hooks into ruffus' job scheduling to count jobs as
+    they are checked, dispatched and completed. Thus the progress is
+    obtained from the same dependency evaluation that decides which
+    jobs to run.
+
+    Valid task status:
+    running
+       task is running
     completed
-       task/job completed successfully
+       task completed successfully
     failed
-       task/job failed
-    running
-       task/job is running
-    ignore
-       ignore task/job (is up-to-date)
+       a job of the task failed
+    uptodate
+       task is up-to-date and has not been run. Tasks that ruffus
+       finds to be up-to-date as a whole are reported with this
+       status without any jobs.
 
-    This filter adds the following context to a log record:
+    Whenever the status of a task changes or one of its jobs
+    finishes, the tracker logs a message in json format with the
+    following fields:
 
     task
        task_name
@@ -866,167 +1561,361 @@ class LoggingFilterProgress(logging.Filter):
        task status
 
     task_total
-       number of jobs in task
+       number of jobs in task. Jobs are counted as ruffus checks
+       whether they are up-to-date, so the total is final once all
+       jobs of a task have been queued.
 
     task_completed
-       number of jobs in task completed
+       number of jobs in task completed, including jobs that
+       were up-to-date
 
     task_completed_percent
        percentage of task completed
 
-    The filter will also generate an additional log message in json format
-    with the fields above.
-
     Arguments
     ---------
-    ruffus_text : string
-        Log messages from ruffus.pipeline_printout. These are used
-        to collect all tasks that will be executed during pipeline
-        execution.
+    logger : object
+        Logger to send progress information to.
 
+    Attributes
+    ----------
+    tasks : dict
+        Dictionary of :class:`TaskProgress` objects by task name.
     """
-    def __init__(self,
-                 ruffus_text):
-
-        # dictionary of jobs to run
-        self.jobs = {}
-        self.tasks = {}
-        self.map_job2task = {}
-        self.logger = get_logger()
-
-        def split_by_job(text):
-            # ignore optional docstring at beginning (is bracketed by '"')
-            text = re.sub('^\"[^"]+\"', "", "".join(text))
-            for line in re.split("Job\s+=", text):
-                if not line.strip():
-                    continue
-                if "Make missing directories" in line:
-                    continue
-                try:
-                    # long file names cause additional wrapping and
-                    # additional white-space characters
-                    job_name = re.search(
-                        r"\[.*-> ([^\]]+)\]", line).groups()[0]
-                except AttributeError:
-                    continue
-                    # raise AttributeError("could not parse '%s'" % line)
-                job_status = "ignore"
-                if "Job needs update" in line:
-                    job_status = "update"
-
-                yield job_name, job_status
-
-        def split_by_task(text):
-            block, task_name = [], None
-            task_status = None
-            for line in text.splitlines():
-                line = line.strip()
-
-                if line.startswith("Tasks which will be run"):
-                    task_status = "update"
-                    block = []
-                    continue
-                elif line.startswith("Tasks which are up-to-date"):
-                    task_status = "ignore"
-                    block = []
-                    continue
-
-                if line.startswith("Task = "):
-                    if task_name:
-                        yield task_name, task_status, list(split_by_job(block))
-                    block = []
-                    task_name = re.match("Task = (.*)", line).groups()[0]
-                    continue
-                if line:
-                    block.append(line)
-            if task_name:
-                yield task_name, task_status, list(split_by_job(block))
-
-        # populate with initial messages
-        for task_name, task_status, jobs in split_by_task(ruffus_text):
-            if task_name.startswith("(mkdir"):
-                continue
-
-            to_run = 0
-            for job_name, job_status in jobs:
-                self.jobs[job_name] = (task_name, job_name)
-                if job_status == "update":
-                    to_run += 1
-                self.map_job2task[re.sub("\s", "", job_name)] = task_name
-
-            self.tasks[task_name] = [task_status,
-                                     len(jobs),
-                                     len(jobs) - to_run]
-
-    def filter(self, record):
-
-        if not record.filename.endswith("task.py"):
-            return True
-
-        # update task counts and status
-        job_name, task_name = None, None
-        if re.search(r"Job\s+=", record.msg):
-            try:
-                job_name = re.search(
-                    r"\[.*-> ([^\]]+)\]", record.msg).groups()[0]
-            except AttributeError:
-                return True
-            job_name = re.sub("\s", "", job_name)
-            task_name = self.map_job2task.get(job_name, None)
-            if task_name is None:
-                return
-            if "completed" in record.msg:
-                self.tasks[task_name][2] += 1
-
-        elif re.search(r"Task\s+=", record.msg):
-            try:
-                before, task_name = record.msg.strip().split(" = ")
-            except ValueError:
-                return True
-
-            # ignore the mkdir, etc tasks
-            if task_name not in self.tasks:
-                return True
 
-            if before == "Task enters queue":
-                self.tasks[task_name][0] = "running"
-            elif before == "Completed Task":
-                self.tasks[task_name][0] = "completed"
-            elif before == "Uptodate Task":
-                self.tasks[task_name][0] = "uptodate"
+    class TaskProgress(object):
+        """job counts of a task."""
+
+        def __init__(self, name):
+            self.name = name
+            self.status = "running"
+            self.total = 0
+            self.uptodate = 0
+            self.queued = 0
+            self.running = 0
+            self.completed = 0
+            self.failed = 0
+
+    def __init__(self, logger=None):
+        self.tasks = collections.OrderedDict()
+        self.logger = logger or get_logger()
+        self.lock = threading.Lock()
+
+    def get_task(self, task):
+        """return progress of ruffus *task*, given as object or name."""
+        name = task if isinstance(task, str) else task._name
+        try:
+            return self.tasks[name]
+        except KeyError:
+            pass
+        with self.lock:
+            if name not in self.tasks:
+                if isinstance(task, str):
+                    display_name = name
+                else:
+                    display_name = task._get_display_name()
+                # ignore prefix:: in task_name for output
+                self.tasks[name] = self.TaskProgress(
+                    re.sub("^[^:]+::", "", display_name))
+            return self.tasks[name]
+
+    def job_checked(self, task, needs_to_run):
+        progress = self.get_task(task)
+        with self.lock:
+            progress.total += 1
+            if needs_to_run:
+                progress.queued += 1
             else:
-                return True
-        else:
-            return True
-
-        if task_name is None:
-            return
-
-        # update log record
-        task_status, task_total, task_completed = self.tasks[task_name]
-        if task_total > 0:
-            task_completed_percent = 100.0 * task_completed / task_total
+                progress.uptodate += 1
+        if progress.total == 1:
+            self.report(progress)
+
+    def job_started(self, task_name):
+        progress = self.get_task(task_name)
+        with self.lock:
+            progress.queued -= 1
+            progress.running += 1
+
+    def job_finished(self, task_name, success):
+        progress = self.get_task(task_name)
+        with self.lock:
+            progress.running -= 1
+            if success:
+                progress.completed += 1
+            else:
+                progress.failed += 1
+                progress.status = "failed"
+        self.report(progress)
+
+    def task_completed(self, task):
+        progress = self.get_task(task)
+        with self.lock:
+            if progress.total == progress.uptodate:
+                status = "uptodate"
+            else:
+                status = "completed"
+            # failures have been reported when the job finished
+            if progress.status in ("failed", status):
+                return
+            progress.status = status
+        self.report(progress)
+
+    def task_uptodate(self, task):
+        """record a task that is up-to-date as a whole.
+
+        Ruffus does not check the jobs of such tasks, so their status
+        is reported when the task is found to be up-to-date.
+        """
+        progress = self.get_task(task)
+        with self.lock:
+            if progress.total > 0 or progress.status == "uptodate":
+                return
+            progress.status = "uptodate"
+        self.report(progress)
+
+    def report(self, progress):
+        """log progress of a task in json format."""
+        task_completed = progress.completed + progress.uptodate
+        if progress.total > 0:
+            task_completed_percent = 100.0 * task_completed / progress.total
         else:
             task_completed_percent = 0
 
-        # ignore prefix:: in task_name for output
-        task_name = re.sub("^[^:]+::", "", task_name)
-        data = {
-            "task": task_name,
-            "task_status": task_status,
-            "task_total": task_total,
+        self.logger.info(json.dumps({
+            "task": progress.name,
+            "task_status": progress.status,
+            "task_total": progress.total,
             "task_completed": task_completed,
-            "task_completed_percent": task_completed_percent}
+            "task_completed_percent": task_completed_percent}))
+
+    @contextlib.contextmanager
+    def track(self):
+        """install hooks into ruffus to track progress."""
+
+        saved_job_needs_to_run = ruffus.task.job_needs_to_run
+        saved_run_job = ruffus.task.run_pooled_job_without_exceptions
+        saved_completed = ruffus.task.Task._completed
+        saved_is_node_up_to_date = ruffus.task.is_node_up_to_date
+
+        def is_node_up_to_date(node, *args, **kwargs):
+            result = saved_is_node_up_to_date(node, *args, **kwargs)
+            if result and isinstance(node, ruffus.task.Task) and \
+               node.is_active:
+                self.task_uptodate(node)
+            return result
+
+        def job_needs_to_run(task, *args, **kwargs):
+            result = saved_job_needs_to_run(task, *args, **kwargs)
+            self.job_checked(task, result)
+            return result
+
+        def run_pooled_job_without_exceptions(process_parameters):
+            task_name = process_parameters[2]
+            self.job_started(task_name)
+            result = saved_run_job(process_parameters)
+            self.job_finished(
+                task_name,
+                result.state not in (ruffus.task.JOB_ERROR,
+                                     ruffus.task.JOB_SIGNALLED_BREAK))
+            return result
+
+        def _completed(task):
+            saved_completed(task)
+            if task.is_active:
+                self.task_completed(task)
+
+        ruffus.task.job_needs_to_run = job_needs_to_run
+        ruffus.task.run_pooled_job_without_exceptions = \
+            run_pooled_job_without_exceptions
+        ruffus.task.Task._completed = _completed
+        ruffus.task.is_node_up_to_date = is_node_up_to_date
+        try:
+            yield self
+        finally:
+            ruffus.task.job_needs_to_run = saved_job_needs_to_run
+            ruffus.task.run_pooled_job_without_exceptions = saved_run_job
+            ruffus.task.Task._completed = saved_completed
+            ruffus.task.is_node_up_to_date = saved_is_node_up_to_date
+
+
+class MetricsExporter(object):
+    """export metrics of a running pipeline in the Prometheus_ text
+    format.
+
+    The metrics are collected periodically in a background thread.
+    They are written to a file, which can be picked up by the textfile
+    collector of a node exporter, and/or served over http on a local
+    port.
+
+    The following metrics are exported:
+
+    cgat_pipeline_jobs
+       number of jobs per task and state (queued, running, completed,
+       failed, uptodate)
+    cgat_pipeline_jobs_submitted_total, cgat_pipeline_jobs_finished_total
+       number of jobs submitted and finished
+    cgat_pipeline_job_submission_rate, cgat_pipeline_job_completion_rate
+       jobs submitted and finished per second since the last update
+    cgat_pipeline_controller_cpu_seconds_total
+       CPU time used by the pipeline controller
+    cgat_pipeline_controller_rss_bytes
+       resident set size of the pipeline controller
+    cgat_pipeline_job_queue_wait_seconds_mean
+       mean time jobs spent in the cluster queue
+    cgat_pipeline_job_duration_seconds_mean
+       mean run time of jobs
+
+    .. _Prometheus: https://prometheus.io/docs/instrumenting/exposition_formats/
 
-        record.task_status = task_status
-        record.task_total = task_total
-        record.task_completed = task_completed
-        record.task_completed_percent = task_completed_percent
+    Arguments
+    ---------
+    tracker : ProgressTracker
+        Tracker providing job counts.
+    filename : string
+        File to write metrics to. The file is replaced atomically.
+    port : int
+        If given, serve metrics on this port on localhost.
+    interval : float
+        Update interval in seconds.
+    """
 
-        # log status
-        self.logger.info(json.dumps(data))
+    def __init__(self, tracker, filename=None, port=None, interval=10):
+        self.tracker = tracker
+        self.filename = filename
+        self.port = port
+        self.interval = interval
+        self.text = ""
+        self.last = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def collect(self):
+        """return current metrics in Prometheus text format."""
+
+        def quote(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"')
+
+        lines = ["# HELP cgat_pipeline_jobs Number of jobs by task and state.",
+                 "# TYPE cgat_pipeline_jobs gauge"]
+        submitted, finished = 0, 0
+        for progress in list(self.tracker.tasks.values()):
+            for state in ("queued", "running", "completed", "failed", "uptodate"):
+                lines.append('cgat_pipeline_jobs{{task="{}",state="{}"}} {}'.format(
+                    quote(progress.name), state, getattr(progress, state)))
+            finished += progress.completed + progress.failed
+            submitted += progress.running + progress.completed + progress.failed
+
+        now = time.time()
+        if self.last is None:
+            submission_rate, completion_rate = 0.0, 0.0
+        else:
+            last_time, last_submitted, last_finished = self.last
+            delta = max(now - last_time, 1e-6)
+            submission_rate = (submitted - last_submitted) / delta
+            completion_rate = (finished - last_finished) / delta
+        self.last = (now, submitted, finished)
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        rss = usage.ru_maxrss * 1024
+        try:
+            with open("/proc/self/statm") as inf:
+                rss = int(inf.read().split()[1]) * resource.getpagesize()
+        except (IOError, IndexError, ValueError):
+            pass
 
-        return True
+        njobs, run_time, queue_wait = 0, 0.0, 0.0
+        for counts in list(Execution.TASK_DURATIONS.values()):
+            njobs += counts[0]
+            run_time += counts[2]
+            queue_wait += counts[3]
+        njobs = max(njobs, 1)
+
+        for name, metric_type, value, description in (
+                ("jobs_submitted_total", "counter", submitted,
+                 "Number of jobs submitted."),
+                ("jobs_finished_total", "counter", finished,
+                 "Number of jobs finished."),
+                ("job_submission_rate", "gauge", submission_rate,
+                 "Jobs submitted per second."),
+                ("job_completion_rate", "gauge", completion_rate,
+                 "Jobs finished per second."),
+                ("controller_cpu_seconds_total", "counter",
+                 usage.ru_utime + usage.ru_stime,
+                 "CPU time of the pipeline controller."),
+                ("controller_rss_bytes", "gauge", rss,
+                 "Resident set size of the pipeline controller."),
+                ("job_queue_wait_seconds_mean", "gauge", queue_wait / njobs,
+                 "Mean time jobs waited in the queue."),
+                ("job_duration_seconds_mean", "gauge", run_time / njobs,
+                 "Mean run time of jobs.")):
+            lines.append("# HELP cgat_pipeline_{} {}".format(name, description))
+            lines.append("# TYPE cgat_pipeline_{} {}".format(name, metric_type))
+            lines.append("cgat_pipeline_{} {}".format(name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def update(self):
+        """collect metrics and write them to the output file."""
+        self.text = self.collect()
+        if self.filename:
+            tmpfile = self.filename + ".tmp"
+            with open(tmpfile, "w") as outf:
+                outf.write(self.text)
+            os.replace(tmpfile, self.filename)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.update()
+            except Exception as ex:
+                get_logger().warn("could not update metrics: {}".format(ex))
+
+    def start(self):
+        """start updating metrics in the background."""
+        self.update()
+        if self.port:
+            import http.server
+            exporter = self
+
+            class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    data = exporter.text.encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type",
+                                     "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = http.server.HTTPServer(("localhost", self.port),
+                                                 MetricsHandler)
+            threading.Thread(target=self.server.serve_forever,
+                             daemon=True).start()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """stop updating and write final metrics."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.update()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
 
 
 def main(options, args, pipeline=None):
@@ -1115,6 +2004,7 @@ def main(options, args, pipeline=None):
         input_validation(PARAMS, sys.argv[0])
 
     if options.pipeline_action == "check":
+        import CGATCore.Requirements as Requirements
         counter, requirements = Requirements.checkRequirementsFromAllModules()
         for requirement in requirements:
             logger.info("\t".join(map(str, requirement)))
@@ -1140,25 +2030,17 @@ def main(options, args, pipeline=None):
                                      "touch",
                                      "regenerate"):
 
-        messenger = None
         try:
-            with cache_os_functions():
-                if options.pipeline_action == "make":
+            with cache_os_functions() as cache:
+                if options.prefetch_metadata:
+                    nentries = cache.prefetch(
+                        PARAMS["workingdir"],
+                        ignore=[PARAMS["tmpdir"], PARAMS["shared_tmpdir"]])
+                    logger.info("prefetched metadata of {} files".format(
+                        nentries))
 
-                    # get tasks to be done. This essentially replicates
-                    # the state information within ruffus.
-                    stream = StringIO()
-                    ruffus.pipeline_printout(
-                        stream,
-                        options.pipeline_targets,
-                        verbose=5,
-                        pipeline=pipeline,
-                        checksum_level=options.ruffus_checksums_level)
-
-                    messenger = LoggingFilterProgress(stream.getvalue())
-                    logger.addFilter(messenger)
+                if options.pipeline_action == "make":
 
-                    global task
                     if options.without_cluster:
                         # use ThreadPool to avoid taking multiple CPU for pipeline
                         # controller.
@@ -1168,24 +2050,69 @@ def main(options, args, pipeline=None):
                         ruffus.task.Pool = EventPool
                         ruffus.task.queue = gevent.queue
 
-                        # create the session proxy
-                        start_session()
+                        # create the session proxy. Reconnect to the
+                        # session of a previous run if it left jobs
+                        # running and re-attach to these.
+                        journal = Execution.RunJournal(RUN_JOURNAL_FILE)
+                        start_session(
+                            contact=Execution.get_journal_session_contact(
+                                journal))
+                        Execution.reattach_jobs(journal)
+                        Execution.RUN_JOURNAL = journal
 
                     logger.info("code location: {}".format(PARAMS["scriptsdir"]))
                     logger.info("code version: {}".format(version))
                     logger.info("working directory is: {}".format(PARAMS["workingdir"]))
-                    ruffus.pipeline_run(
-                        options.pipeline_targets,
-                        forcedtorun_tasks=forcedtorun_tasks,
-                        multiprocess=options.multiprocess,
-                        logger=logger,
-                        verbose=options.loglevel,
-                        log_exceptions=options.log_exceptions,
-                        exceptions_terminate_immediately=options.exceptions_terminate_immediately,
-                        checksum_level=options.ruffus_checksums_level,
-                        pipeline=pipeline,
-                        one_second_per_job=False,
-                    )
+
+                    if options.critical_path_priorities:
+                        Execution.TASK_CRITICALITY.update(
+                            compute_task_criticality(
+                                options.pipeline_targets,
+                                pipeline=pipeline,
+                                durations=load_task_durations(),
+                                checksum_level=options.ruffus_checksums_level))
+
+                    try:
+                        with contextlib.ExitStack() as stack:
+                            stack.enter_context(allow_pending_inputs())
+                            tracker = stack.enter_context(
+                                ProgressTracker(logger).track())
+                            if options.metrics_file or options.metrics_port:
+                                stack.enter_context(MetricsExporter(
+                                    tracker,
+                                    filename=options.metrics_file,
+                                    port=options.metrics_port,
+                                    interval=options.metrics_interval))
+
+                            ruffus.pipeline_run(
+                                options.pipeline_targets,
+                                forcedtorun_tasks=forcedtorun_tasks,
+                                multiprocess=options.multiprocess,
+                                logger=logger,
+                                verbose=options.loglevel,
+                                log_exceptions=options.log_exceptions,
+                                exceptions_terminate_immediately=options.exceptions_terminate_immediately,
+                                checksum_level=options.ruffus_checksums_level,
+                                pipeline=pipeline,
+                                one_second_per_job=False,
+                            )
+
+                            # collect jobs that have been submitted ahead
+                            wait_for_pending_jobs()
+
+                        # durations of a failed run are incomplete
+                        if options.critical_path_priorities:
+                            save_task_durations()
+                    finally:
+                        if Execution.RUN_JOURNAL is not None:
+                            # keep only jobs that are still running
+                            running = Execution.RUN_JOURNAL.read()
+                            Execution.RUN_JOURNAL.compact(running)
+                            Execution.RUN_JOURNAL = None
+                            # job scripts of running jobs are in
+                            # temporary namespaces
+                            if running:
+                                Files.keep_temp_namespaces()
 
                     close_session()
 
@@ -1294,7 +2221,8 @@ def main(options, args, pipeline=None):
         write_config_files(pipeline_path, general_path)
 
     elif options.pipeline_action == "clone":
-        clone_pipeline(options.pipeline_targets[0])
+        clone_pipeline(options.pipeline_targets[0],
+                       link_mode=options.clone_mode)
 
     else:
         raise ValueError("unknown pipeline action %s" %
@@ -5,18 +5,51 @@ Reference
 ---------
 
 """
+import atexit
+import collections
+import copy
+import itertools
+import logging
+import queue
+import random
 import re
 import os
+import shlex
 import sqlite3
+import threading
+import time
+import gevent
 from CGATCore import Database as Database
+from CGATCore import CSV2DB as CSV2DB
 import CGATCore.Experiment as E
 
-from CGATCore.IOTools import touch_file, snip
+from CGATCore.IOTools import touch_file, snip, open_file
 
-from CGATCore.Pipeline.Execution import interpolate_statement, run
+from CGATCore.Pipeline.Execution import interpolate_statement, run, \
+    will_run_on_cluster
 from CGATCore.Pipeline.Files import get_temp_file
 from CGATCore.Pipeline.Parameters import get_params
 
+# Number of times an upload failing because of a lock is retried,
+# see upload_lines
+LOAD_RETRIES = 20
+
+# Load coordinators by database, see get_load_coordinator
+LOAD_COORDINATORS = {}
+LOAD_COORDINATORS_LOCK = threading.Lock()
+
+# Connection pools by process and database, see connect
+CONNECTION_POOLS = {}
+CONNECTION_POOLS_LOCK = threading.Lock()
+
+# per-connection pragmas that are restored when a connection
+# is returned to its pool
+CONNECTION_PRAGMAS = ("cache_size", "synchronous", "mmap_size",
+                      "foreign_keys", "temp_store", "busy_timeout",
+                      "query_only", "recursive_triggers",
+                      "automatic_index", "cache_spill",
+                      "reverse_unordered_selects")
+
 
 def tablequote(track):
     '''quote a track name such that is suitable as a table name.'''
@@ -80,16 +113,15 @@ def build_load_statement(tablename, retry=True, options=""):
     if retry:
         opts.append(" --retry ")
 
-    PARAMS = getParams()
-    backend = PARAMS["database_backend"]
+    PARAMS = get_params()
+    backend = getDatabaseBackend()
 
     if backend not in ("sqlite", "mysql", "postgres"):
         raise NotImplementedError(
             "backend %s not implemented" % backend)
 
     opts.append("--database-backend=%s" % backend)
-    opts.append("--database-name=%s" %
-                PARAMS.get("database_name"))
+    opts.append("--database-name=%s" % getDatabaseName())
     opts.append("--database-host=%s" %
                 PARAMS.get("database_host", ""))
     opts.append("--database-user=%s" %
@@ -108,11 +140,845 @@ def build_load_statement(tablename, retry=True, options=""):
     --table=%(tablename)s
     ''')
 
-    load_statement = interpolate_statement(statement, **locals())
+    load_statement = interpolate_statement(statement, locals())
 
     return load_statement
 
 
+def build_load_options(tablename, retry=True, options=""):
+    """build options to upload data with :func:`CSV2DB.run`.
+
+    This is the in-process equivalent of :func:`build_load_statement`.
+
+    Arguments
+    ---------
+    tablename : string
+        Tablename for upload
+    retry : bool
+        Set the ``--retry`` option.
+    options : string
+        Command line options of `csv2db.py`.
+
+    Returns
+    -------
+    options : optparse.Values
+        Options for :func:`CSV2DB.run`.
+
+    Raises
+    ------
+    ValueError
+        If `options` contains options not understood by `csv2db.py`.
+    """
+    parser = CSV2DB.buildParser()
+    # raise instead of exiting on unknown options
+    parser.error = _raise_value_error
+    load_options, args = parser.parse_args(shlex.split(options))
+    if args:
+        raise ValueError("unexpected arguments for csv2db: %s" % args)
+
+    PARAMS = get_params()
+    load_options.tablename = tablename
+    load_options.retry = retry or load_options.retry
+    load_options.backend = getDatabaseBackend()
+    load_options.database_backend = load_options.backend
+    load_options.database_name = getDatabaseName()
+    load_options.database_host = PARAMS.get("database_host", "")
+    load_options.database_username = PARAMS.get("database_username", "")
+    load_options.database_password = PARAMS.get("database_password", "")
+    load_options.database_port = PARAMS.get("database_port", 3306)
+    return load_options
+
+
+def _raise_value_error(msg):
+    raise ValueError(msg)
+
+
+def collapse_table(lines, missing_value="na"):
+    """collapse a table with two columns.
+
+    The first column contains row names. A new column starts whenever
+    the first row name appears again. This is the in-process
+    equivalent of ``cgat table2table --collapse``.
+
+    Arguments
+    ---------
+    lines : iterator
+        Lines of a tab-separated table with a header.
+    missing_value : string
+        Value for row names missing in a column.
+
+    Returns
+    -------
+    lines : list
+        Lines of the collapsed table.
+    """
+    rows = [x.rstrip("\r\n").split("\t") for x in lines
+            if not x.startswith("#") and x.strip()][1:]
+    if not rows:
+        return []
+    if any(len(x) != 2 for x in rows):
+        raise NotImplementedError(
+            "can only collapse tables with two columns")
+
+    values = collections.OrderedDict((x[0], []) for x in rows)
+    separator = rows[0][0]
+    added = set()
+    for row_name, value in rows:
+        if row_name == separator and added:
+            for r in values:
+                if r not in added:
+                    values[r].append(missing_value)
+            added = set()
+        values[row_name].append(value)
+        added.add(row_name)
+    for r in values:
+        if r not in added:
+            values[r].append(missing_value)
+
+    size = len(values[separator])
+    result = ["row\t%s\n" % "\t".join(
+        ["column_%i" % x for x in range(size)])]
+    result.extend(["%s\t%s\n" % (key, "\t".join(row))
+                   for key, row in values.items()])
+    return result
+
+
+def transpose_table(lines, transpose="track"):
+    """transpose a tab-separated table.
+
+    The first column in the first row is set to `transpose`. This
+    is the in-process equivalent of ``cgat table2table --transpose``.
+    """
+    rows = [x.rstrip("\r\n").split("\t") for x in lines
+            if not x.startswith("#") and x.strip()]
+    if not rows:
+        return []
+    ncolumns = max(len(x) for x in rows)
+    rows = [x + [""] * (ncolumns - len(x)) for x in rows]
+    rows[0][0] = transpose
+    return ["\t".join(x) + "\n" for x in zip(*rows)]
+
+
+class LoadRequest(object):
+    """a request to the :class:`LoadCoordinator`."""
+
+    def __init__(self, func, retries=0):
+        self.func = func
+        self.retries = retries
+        self.submitted = time.time()
+        self.latency = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class DeferredCommitConnection(object):
+    """a database connection that ignores commits.
+
+    Commits are performed by the :class:`LoadCoordinator` once all
+    uploads of a batch have completed.
+    """
+
+    def __init__(self, dbhandle):
+        self.dbhandle = dbhandle
+
+    def commit(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.dbhandle, name)
+
+
+class LoadCoordinator(object):
+    """upload data into an sqlite database from a single thread.
+
+    Uploads from tasks running in parallel are queued and executed
+    one after another in a thread that owns the only connection to
+    the database that is used for uploads. Queued uploads are grouped
+    into a single transaction. Each upload is enclosed in a savepoint
+    so that a failing upload does not affect others in the same batch.
+
+    Uploads failing because a table or the database is locked are
+    queued again after the transaction has been committed, so that
+    the write lock is not held while waiting.
+
+    The time uploads spend waiting in the queue is logged and
+    summarized when the coordinator is stopped.
+
+    Arguments
+    ---------
+    database_name : string
+        Filename of the sqlite database.
+    max_batch_size : int
+        Maximum number of uploads in a transaction.
+    timeout : float
+        Time in seconds to wait for locks held by other processes.
+    """
+
+    def __init__(self, database_name, max_batch_size=50, timeout=300):
+        self.database_name = database_name
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run,
+                    name="load_coordinator",
+                    daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """stop the coordinator once all queued uploads are done."""
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+        if self.counts["uploads"]:
+            E.info("load coordinator: {} uploads in {} transactions, "
+                   "queue latency mean={:.2f}s, max={:.2f}s".format(
+                       self.counts["uploads"],
+                       self.counts["transactions"],
+                       self.total_latency / self.counts["uploads"],
+                       self.max_latency))
+
+    def submit(self, func, retries=0):
+        """run `func` in the coordinator and wait until it has completed.
+
+        `func` is called with a database handle. Changes are committed
+        before this method returns. If `func` fails because of a lock,
+        it is run again up to `retries` times.
+
+        When called from a gevent greenlet, the wait is performed in
+        the thread pool of the gevent hub so that other greenlets
+        continue to run.
+        """
+        self.start()
+        request = LoadRequest(func, retries=retries)
+        self.queue.put(request)
+        if isinstance(gevent.getcurrent(), gevent.Greenlet):
+            gevent.get_hub().threadpool.spawn(request.done.wait).get()
+        else:
+            request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+    def run(self):
+        dbhandle = sqlite3.connect(self.database_name,
+                                   timeout=self.timeout,
+                                   isolation_level=None)
+        try:
+            os.chmod(self.database_name, 0o664)
+        except OSError as msg:
+            E.warn("could not change permissions of database: %s" % msg)
+        dbhandle.text_factory = str
+        configure_connection(dbhandle, **get_connection_pragmas())
+
+        running, retry = True, []
+        while running or retry:
+            # uploads to retry are run first
+            batch, retry = retry, []
+            while running and len(batch) < self.max_batch_size:
+                try:
+                    request = self.queue.get(block=not batch)
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                batch.append(request)
+            if batch:
+                retry = self.process(dbhandle, batch)
+
+        dbhandle.close()
+
+    def process(self, dbhandle, batch):
+        """upload a batch of requests in a single transaction.
+
+        Returns the requests that failed because of a lock and
+        should be retried.
+        """
+        proxy = DeferredCommitConnection(dbhandle)
+        retry = []
+        try:
+            dbhandle.execute("BEGIN IMMEDIATE")
+            for x, request in enumerate(batch):
+                request.latency = time.time() - request.submitted
+                dbhandle.execute("SAVEPOINT load%i" % x)
+                try:
+                    request.func(proxy)
+                except Exception as e:
+                    request.error = e
+                    dbhandle.execute("ROLLBACK TO load%i" % x)
+                dbhandle.execute("RELEASE load%i" % x)
+            dbhandle.execute("COMMIT")
+        except Exception as e:
+            if dbhandle.in_transaction:
+                dbhandle.execute("ROLLBACK")
+            for request in batch:
+                if request.error is None:
+                    request.error = e
+        finally:
+            self.counts["transactions"] += 1
+            for request in batch:
+                if request.retries > 0 and \
+                   isinstance(request.error, sqlite3.OperationalError) and \
+                   "locked" in str(request.error):
+                    E.warn("load coordinator: retrying upload: %s" %
+                           request.error)
+                    request.retries -= 1
+                    request.error = None
+                    self.counts["retries"] += 1
+                    retry.append(request)
+                    continue
+                self.counts["uploads"] += 1
+                latency = request.latency or 0
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                request.done.set()
+        E.debug("load coordinator: committed {} uploads".format(
+            len(batch) - len(retry)))
+        return retry
+
+
+def get_load_coordinator(database_name):
+    """return the :class:`LoadCoordinator` for a database."""
+    key = os.path.abspath(database_name)
+    with LOAD_COORDINATORS_LOCK:
+        if key not in LOAD_COORDINATORS:
+            LOAD_COORDINATORS[key] = LoadCoordinator(database_name)
+        return LOAD_COORDINATORS[key]
+
+
+def stop_load_coordinators():
+    """stop all load coordinators."""
+    with LOAD_COORDINATORS_LOCK:
+        coordinators = list(LOAD_COORDINATORS.values())
+        LOAD_COORDINATORS.clear()
+    for coordinator in coordinators:
+        coordinator.stop()
+
+
+atexit.register(stop_load_coordinators)
+
+
+def load_in_process(infile,
+                    outfile,
+                    tablename,
+                    options="",
+                    collapse=False,
+                    transpose=False,
+                    retry=True,
+                    limit=0,
+                    shuffle=False):
+    """upload a tab-separated file into the database without
+    starting a job.
+
+    The file is read and streamed into :func:`CSV2DB.run`. Compressed
+    files are read directly. See :func:`load` for the arguments.
+    """
+    load_options = build_load_options(tablename, retry=retry, options=options)
+
+    with open_file(infile) as inf:
+        lines = iter(inf)
+        if collapse:
+            lines = collapse_table(lines, missing_value=collapse)
+        if transpose:
+            lines = transpose_table(lines, transpose=transpose)
+        if shuffle:
+            lines = list(lines)
+            header, body = lines[:1], lines[1:]
+            random.shuffle(body)
+            lines = header + body
+        if limit > 0:
+            lines = itertools.islice(lines, limit + 1)
+
+        upload_lines(lines, outfile, load_options)
+
+
+class ReplayableLines(object):
+    """lines of a table that can be iterated over repeatedly.
+
+    Lines are taken from `lines` as they are needed and recorded in a
+    temporary file. Iterating again replays the recorded lines before
+    continuing with the remaining lines, so that an upload can be
+    retried after a previous attempt has consumed its input.
+
+    Arguments
+    ---------
+    lines : iterator
+        Lines of the table.
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.outf = get_temp_file()
+
+    def __iter__(self):
+        self.outf.seek(0)
+        for line in self.outf:
+            yield line.decode()
+        for line in self.lines:
+            self.outf.write(line.encode())
+            yield line
+
+    def close(self):
+        self.outf.close()
+        os.unlink(self.outf.name)
+
+
+def upload_lines(lines, outfile, load_options):
+    """upload lines of a tab-separated table into the database.
+
+    Uploads into sqlite databases are performed by the
+    :class:`LoadCoordinator` of the database. If uploads are retried,
+    `lines` are recorded while they are read, see
+    :class:`ReplayableLines`.
+
+    Arguments
+    ---------
+    lines : iterator
+        Lines of the table including the header.
+    outfile : string
+        Filename to write log messages of the upload to.
+    load_options : optparse.Values
+        Options for :func:`CSV2DB.run`, see :func:`build_load_options`.
+    """
+    with open(outfile, "w") as outf:
+
+        def _upload(dbhandle=None):
+            # record log messages of the upload in outfile. Other
+            # tasks might be logging in other threads at the
+            # same time.
+            handler = logging.StreamHandler(outf)
+            handler.setFormatter(logging.Formatter(
+                "# %(asctime)s %(levelname)s %(message)s"))
+            thread = threading.get_ident()
+            handler.addFilter(lambda record: record.thread == thread)
+            logger = logging.getLogger()
+            logger.addHandler(handler)
+            try:
+                CSV2DB.run(iter(lines), load_options, dbhandle=dbhandle)
+            finally:
+                logger.removeHandler(handler)
+
+        if load_options.backend == "sqlite":
+            # retries are performed by the coordinator outside of
+            # the transaction holding the write lock
+            retries = LOAD_RETRIES if load_options.retry else 0
+            load_options = copy.copy(load_options)
+            load_options.retry = False
+            if retries:
+                lines = ReplayableLines(lines)
+            try:
+                get_load_coordinator(load_options.database_name).submit(
+                    _upload, retries=retries)
+            finally:
+                if retries:
+                    lines.close()
+        else:
+            _upload()
+
+
+def read_table_header(infile):
+    """return the column titles in the first line of a tab-separated file.
+
+    Returns None if the file is empty.
+    """
+    with open_file(infile) as inf:
+        line = inf.readline()
+    if not line:
+        return None
+    return line.rstrip("\r\n").split("\t")
+
+
+def read_table_lines(infile):
+    """return all lines of a tab-separated file."""
+    with open_file(infile) as inf:
+        return inf.readlines()
+
+
+def iterate_concatenated_tables(infiles,
+                                tracks,
+                                pool,
+                                cat="track",
+                                has_titles=True,
+                                missing_value="na",
+                                window=8):
+    """concatenate tab-separated files, adding track columns.
+
+    The output corresponds to ``cgat combine_tables --cat``. If
+    `has_titles` is set, the output header is the union of the column
+    titles of all files in the order of their first appearance and
+    columns that are absent in a file are filled with `missing_value`.
+
+    Files are read and decompressed concurrently in `pool`. At most
+    `window` files are kept in memory while their lines are yielded in
+    the order of `infiles`.
+
+    Arguments
+    ---------
+    infiles : list
+        Filenames of the input data.
+    tracks : list
+        Tuple of track values for each file in `infiles`.
+    pool : multiprocessing.pool.ThreadPool
+        Pool of threads to read files with.
+    cat : string
+        Comma-separated list of titles of track columns.
+    has_titles : bool
+        If True, files are expected to have column titles in their
+        first row.
+    missing_value : string
+        String to use for missing values.
+    window : int
+        Number of files to read ahead.
+
+    Returns
+    -------
+    lines : iterator
+        Lines of the concatenated table.
+    """
+    if has_titles:
+        headers = pool.map(read_table_header, infiles)
+        columns = []
+        for titles in headers:
+            for title in titles or []:
+                if title not in columns:
+                    columns.append(title)
+        yield "\t".join(cat.split(",") + columns) + "\n"
+
+    def _iterate_files():
+        results = collections.deque()
+        infile_iter = iter(enumerate(infiles))
+        for idx, infile in itertools.islice(infile_iter, window):
+            results.append((idx, pool.apply_async(read_table_lines,
+                                                  (infile, ))))
+        while results:
+            idx, result = results.popleft()
+            for next_idx, infile in itertools.islice(infile_iter, 1):
+                results.append((next_idx, pool.apply_async(read_table_lines,
+                                                           (infile, ))))
+            yield idx, result.get()
+
+    for idx, lines in _iterate_files():
+        if not lines:
+            continue
+        prefix = "\t".join(tracks[idx]) + "\t"
+        if not has_titles:
+            for line in lines:
+                yield prefix + line.rstrip("\r\n") + "\n"
+            continue
+
+        titles = headers[idx]
+        if titles == columns:
+            for line in lines[1:]:
+                yield prefix + line.rstrip("\r\n") + "\n"
+            continue
+
+        # map columns of this file onto the combined header
+        mapping = [titles.index(x) if x in titles else None for x in columns]
+        for line in lines[1:]:
+            values = line.rstrip("\r\n").split("\t")
+            yield prefix + "\t".join(
+                missing_value if x is None or x >= len(values) else values[x]
+                for x in mapping) + "\n"
+
+
+def concatenate_and_load_in_process(infiles,
+                                    outfile,
+                                    tablename,
+                                    regex_filename=None,
+                                    header=None,
+                                    cat="track",
+                                    has_titles=True,
+                                    missing_value="na",
+                                    retry=True,
+                                    options="",
+                                    threads=4):
+    """concatenate tab-separated files and upload them into the
+    database without starting a job.
+
+    Files are read concurrently by `threads` threads and streamed into
+    a single :func:`CSV2DB.run`. Indices are created after all rows
+    have been inserted. See :func:`concatenateAndLoad` for the
+    arguments.
+    """
+    load_options = ["--add-index=%s" % x for x in cat.split(",")]
+    if header:
+        load_options.append("--header-names=%s" % header)
+    load_options = build_load_options(
+        tablename, retry=retry,
+        options=" ".join(load_options) + " " + options)
+
+    rx = re.compile(regex_filename or "(.*)")
+    tracks = []
+    for infile in infiles:
+        match = rx.search(infile)
+        if not match:
+            raise ValueError(
+                "regular expression '%s' does not match filename '%s'" %
+                (rx.pattern, infile))
+        tracks.append(match.groups())
+
+    # imported here as multiprocessing is slow to import
+    from multiprocessing.pool import ThreadPool
+
+    threads = max(1, min(threads, len(infiles)))
+    pool = ThreadPool(threads)
+    try:
+        lines = iterate_concatenated_tables(infiles, tracks, pool,
+                                            cat=cat,
+                                            has_titles=has_titles,
+                                            missing_value=missing_value,
+                                            window=2 * threads)
+        upload_lines(lines, outfile, load_options)
+    finally:
+        pool.terminate()
+
+
+def read_merge_table(infile, columns=(0, 1), keys_only=False,
+                     missing_value="0"):
+    """read the key and value columns of a table for merging.
+
+    The first row of the file is expected to contain column titles.
+    Empty lines and repeated keys are ignored. Value columns missing
+    at the end of short lines are set to `missing_value`.
+
+    Arguments
+    ---------
+    infile : string
+        Filename of the table.
+    columns : list
+        The columns to be taken with the first being the key. If None,
+        all columns are taken.
+    keys_only : bool
+        If True, only read the key column.
+    missing_value : string
+        Value of columns missing in a line.
+
+    Returns
+    -------
+    titles : list
+        Titles of the value columns.
+    keys : list
+        Keys in the order of the file.
+    values : list
+        List of values for each key. None if `keys_only` is set.
+
+    Returns None if the file contains no data.
+
+    Raises
+    ------
+    ValueError
+        If a line or the header has no key column or the header
+        lacks one of `columns`.
+    """
+    with open_file(infile) as inf:
+        titles = inf.readline().rstrip("\r\n").split("\t")
+        if columns is None:
+            columns = list(range(len(titles)))
+        key_column, value_columns = columns[0], columns[1:]
+        ncolumns = max(columns) + 1
+        if len(titles) < ncolumns:
+            raise ValueError(
+                "%s: header has %i columns, but column %i is required" %
+                (infile, len(titles), ncolumns))
+        keys, values, seen = [], [], set()
+        for nline, line in enumerate(inf, start=2):
+            if not line.strip():
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            if key_column >= len(fields):
+                raise ValueError(
+                    "%s:%i: missing key column %i in line with %i fields" %
+                    (infile, nline, key_column + 1, len(fields)))
+            key = fields[key_column]
+            if key in seen:
+                continue
+            seen.add(key)
+            keys.append(key)
+            if not keys_only:
+                if len(fields) < ncolumns:
+                    fields.extend(
+                        [missing_value] * (ncolumns - len(fields)))
+                values.append([fields[x] for x in value_columns])
+
+    if not keys:
+        return None
+    return ([titles[x] for x in value_columns],
+            keys,
+            None if keys_only else values)
+
+
+def iterate_merged_tables(infiles,
+                          names,
+                          columns=(0, 1),
+                          prefixes=None,
+                          row_wise=True,
+                          missing_value="0",
+                          max_cells=10000000,
+                          threads=4):
+    """merge tables on their key column.
+
+    The output corresponds to ``cgat combine_tables --skip-titles``,
+    optionally followed by a transposition if `row_wise` is set. Keys
+    are output in the order of their first appearance.
+
+    Values are collected in a :mod:`numpy` matrix indexed by value
+    column and key. If `row_wise` is set, the keys of all files are
+    collected first and the files are then merged in chunks of at most
+    `max_cells` values. The values read while collecting the keys are
+    kept for as many leading files as fit into `max_cells`, all other
+    files are read a second time when their chunk is merged. Otherwise
+    all files are merged in memory.
+
+    Value columns missing in short lines are set to `missing_value`.
+
+    Arguments
+    ---------
+    infiles : list
+        Filenames of the input data.
+    names : list
+        Column title for the values of each file.
+    columns : list
+        The columns to be taken with the first being the key. If None,
+        all columns are taken and their titles prefixed with the
+        respective entry in `prefixes` or `names`.
+    prefixes : list
+        Prefixes for column titles if `columns` is None.
+    row_wise : bool
+        If set, each value column will be a row in the output.
+    missing_value : string
+        String to use for missing values.
+    max_cells : int
+        Maximum number of values to hold in memory while merging
+        row-wise.
+    threads : int
+        Number of threads to read files with.
+
+    Returns
+    -------
+    lines : iterator
+        Lines of the merged table.
+    """
+    # imported here as multiprocessing is slow to import
+    from multiprocessing.pool import ThreadPool
+    import numpy
+
+    if prefixes is None:
+        prefixes = names
+
+    def _read(args):
+        idx, keys_only = args
+        return idx, read_merge_table(infiles[idx], columns,
+                                     keys_only=keys_only,
+                                     missing_value=missing_value)
+
+    def _collect_keys(tables):
+        keys = {}
+        for idx, table in tables:
+            if table is not None:
+                keys.update(dict.fromkeys(table[1]))
+        return dict((key, x) for x, key in enumerate(keys))
+
+    def _merge(tables, key_index):
+        # returns value column titles and a matrix of value
+        # columns by keys
+        tables = [(idx, table) for idx, table in tables if table is not None]
+        titles = []
+        for idx, table in tables:
+            if columns is None:
+                titles.extend("%s_%s" % (prefixes[idx], x) for x in table[0])
+            else:
+                titles.append(names[idx])
+        matrix = numpy.full((len(titles), len(key_index)), missing_value,
+                            dtype=object)
+        row = 0
+        for idx, (table_titles, keys, values) in tables:
+            nrows = len(table_titles)
+            matrix[row:row + nrows,
+                   [key_index[x] for x in keys]] = numpy.array(
+                       values, dtype=object).reshape(len(keys), nrows).T
+            row += nrows
+        return titles, matrix
+
+    pool = ThreadPool(max(1, min(threads, len(infiles))))
+    try:
+        if not row_wise:
+            tables = pool.map(_read, [(idx, False)
+                                      for idx in range(len(infiles))])
+            key_index = _collect_keys(tables)
+            titles, matrix = _merge(tables, key_index)
+            yield "\t".join(["bin"] + titles) + "\n"
+            for key, values in zip(key_index, matrix.T):
+                yield key + "\t" + "\t".join(values) + "\n"
+            return
+
+        # keep the values of leading files while they fit into
+        # max_cells so that these are not read twice
+        cached, ncells, keys = {}, 0, []
+        for idx, table in pool.imap(
+                _read, [(idx, False) for idx in range(len(infiles))]):
+            if table is None:
+                continue
+            ncells += len(table[0]) * len(table[1])
+            if ncells <= max_cells:
+                cached[idx] = table
+            keys.append((idx, table[:2]))
+        key_index = _collect_keys(keys)
+        del keys
+        yield "\t".join(["track"] + list(key_index)) + "\n"
+
+        chunk_size = max(1, max_cells // max(1, len(key_index)))
+        for start in range(0, len(infiles), chunk_size):
+            indices = range(start, min(start + chunk_size, len(infiles)))
+            tables = dict(pool.map(
+                _read, [(idx, False) for idx in indices
+                        if idx not in cached]))
+            tables = [(idx, cached.pop(idx) if idx in cached
+                       else tables[idx]) for idx in indices]
+            titles, matrix = _merge(tables, key_index)
+            for title, values in zip(titles, matrix):
+                yield title + "\t" + "\t".join(values) + "\n"
+    finally:
+        pool.terminate()
+
+
+def merge_and_load_in_process(infiles,
+                              outfile,
+                              tablename,
+                              names,
+                              columns=(0, 1),
+                              prefixes=None,
+                              row_wise=True,
+                              retry=True,
+                              options=""):
+    """merge tables and upload the result into the database without
+    starting a job.
+
+    Tables are merged with :func:`iterate_merged_tables` and the result
+    is streamed into :func:`CSV2DB.run`. See :func:`mergeAndLoad` for
+    the arguments.
+    """
+    load_options = build_load_options(
+        tablename, retry=retry, options="--add-index=track " + options)
+    lines = iterate_merged_tables(infiles, names,
+                                  columns=columns,
+                                  prefixes=prefixes,
+                                  row_wise=row_wise)
+    upload_lines(lines, outfile, load_options)
+
+
 def load(infile,
          outfile=None,
          options="",
@@ -122,7 +988,8 @@ def load(infile,
          retry=True,
          limit=0,
          shuffle=False,
-         job_memory=None):
+         job_memory=None,
+         in_process=None):
     """import data from a tab-separated file into database.
 
     The table name is given by outfile without the
@@ -134,7 +1001,9 @@ def load(infile,
         def loadData(infile, outfile):
             P.load(infile, outfile)
 
-    Upload is performed via the :doc:`csv2db` script.
+    Upload is performed via the :doc:`csv2db` script. If the task
+    does not run on the cluster, the data is uploaded within the
+    pipeline process, see :func:`load_in_process`.
 
     Arguments
     ---------
@@ -165,15 +1034,37 @@ def load(infile,
     job_memory : string
         Amount of memory to allocate for job. If unset, uses the global
         default.
+    in_process : bool
+        If True, upload within the pipeline process. If False, run
+        `csv2db.py` as a job. The default is to upload within the
+        pipeline process unless the task runs on the cluster.
     """
-    PARAMS = getParams()
+    PARAMS = get_params()
     if job_memory is None:
-        job_memory = PARAMS["cluster_memory_default"]
+        job_memory = PARAMS["cluster"]["memory_default"]
 
     if not tablename:
         tablename = toTable(outfile)
 
+    if in_process is None:
+        in_process = not will_run_on_cluster(PARAMS)
+
+    if in_process:
+        try:
+            build_load_options(tablename, retry=retry, options=options)
+        except ValueError as msg:
+            E.debug("uploading %s with csv2db: %s" % (infile, msg))
+        else:
+            return load_in_process(infile, outfile, tablename,
+                                   options=options,
+                                   collapse=collapse,
+                                   transpose=transpose,
+                                   retry=retry,
+                                   limit=limit,
+                                   shuffle=shuffle)
+
     statement = []
+    ignore_pipe_errors = False
 
     if infile.endswith(".gz"):
         statement.append("zcat %(infile)s")
@@ -204,7 +1095,9 @@ def load(infile,
 
     statement = " | ".join(statement) + " > %(outfile)s"
 
-    run()
+    run(statement,
+        job_memory=job_memory,
+        ignore_pipe_errors=ignore_pipe_errors)
 
 
 def concatenateAndLoad(infiles,
@@ -217,7 +1110,8 @@ def concatenateAndLoad(infiles,
                        retry=True,
                        tablename=None,
                        options="",
-                       job_memory=None):
+                       job_memory=None,
+                       in_process=None):
     """concatenate multiple tab-separated files and upload into database.
 
     The table name is given by outfile without the
@@ -229,7 +1123,10 @@ def concatenateAndLoad(infiles,
         def loadData(infile, outfile):
             P.concatenateAndLoad(infiles, outfile)
 
-    Upload is performed via the :doc:`csv2db` script.
+    Upload is performed via the :doc:`csv2db` script. If the task
+    does not run on the cluster, the files are read concurrently and
+    uploaded within the pipeline process, see
+    :func:`concatenate_and_load_in_process`.
 
     Arguments
     ---------
@@ -263,16 +1160,40 @@ def concatenateAndLoad(infiles,
     job_memory : string
         Amount of memory to allocate for job. If unset, uses the global
         default.
+    in_process : bool
+        If True, upload within the pipeline process. If False, run
+        `combine_tables` and `csv2db.py` as a job. The default is to
+        upload within the pipeline process unless the task runs on the
+        cluster.
 
     """
-    PARAMS = getParams()
+    PARAMS = get_params()
 
     if job_memory is None:
-        job_memory = PARAMS["cluster_memory_default"]
+        job_memory = PARAMS["cluster"]["memory_default"]
 
     if tablename is None:
         tablename = toTable(outfile)
 
+    if in_process is None:
+        in_process = not will_run_on_cluster(PARAMS)
+
+    if in_process:
+        try:
+            build_load_options(tablename, retry=retry, options=options)
+        except ValueError as msg:
+            E.debug("uploading %s with csv2db: %s" % (outfile, msg))
+        else:
+            return concatenate_and_load_in_process(
+                infiles, outfile, tablename,
+                regex_filename=regex_filename,
+                header=header,
+                cat=cat,
+                has_titles=has_titles,
+                missing_value=missing_value,
+                retry=retry,
+                options=options)
+
     infiles = " ".join(infiles)
 
     passed_options = options
@@ -302,7 +1223,7 @@ def concatenateAndLoad(infiles,
     | %(load_statement)s
     > %(outfile)s'''
 
-    run()
+    run(statement, job_memory=job_memory)
 
 
 def mergeAndLoad(infiles,
@@ -313,7 +1234,8 @@ def mergeAndLoad(infiles,
                  row_wise=True,
                  retry=True,
                  options="",
-                 prefixes=None):
+                 prefixes=None,
+                 in_process=None):
     '''merge multiple categorical tables and load into a database.
 
     The tables are merged and entered row-wise, i.e, the contents of
@@ -380,21 +1302,49 @@ def mergeAndLoad(infiles,
         If given, the respective prefix will be added to each
         column. The number of `prefixes` and `infiles` needs to be the
         same.
+    in_process : bool
+        If True, merge and upload within the pipeline process, see
+        :func:`merge_and_load_in_process`. If False, run
+        `combine_tables` and `csv2db.py` as a job. The default is to
+        upload within the pipeline process unless the task runs on the
+        cluster.
 
     '''
-    PARAMS = getParams()
+    PARAMS = get_params()
     if len(infiles) == 0:
         raise ValueError("no files for merging")
 
     if suffix:
-        header = ",".join([os.path.basename(snip(x, suffix)) for x in infiles])
+        names = [os.path.basename(snip(x, suffix)) for x in infiles]
     elif regex:
-        header = ",".join(["-".join(re.search(regex, x).groups())
-                          for x in infiles])
+        names = ["-".join(re.search(regex, x).groups()) for x in infiles]
     else:
-        header = ",".join([os.path.basename(x) for x in infiles])
+        names = [os.path.basename(x) for x in infiles]
+
+    if prefixes:
+        assert len(prefixes) == len(infiles)
 
-    header_stmt = "--header-names=%s" % header
+    if in_process is None:
+        in_process = not will_run_on_cluster(PARAMS)
+
+    # the in-process merge supports a single value column per file
+    if in_process and (columns is None or len(columns) == 2):
+        try:
+            build_load_options(toTable(outfile), retry=retry,
+                               options=options)
+        except ValueError as msg:
+            E.debug("uploading %s with csv2db: %s" % (outfile, msg))
+        else:
+            return merge_and_load_in_process(infiles, outfile,
+                                             toTable(outfile),
+                                             names,
+                                             columns=columns,
+                                             prefixes=prefixes,
+                                             row_wise=row_wise,
+                                             retry=retry,
+                                             options=options)
+
+    header_stmt = "--header-names=%s" % ",".join(names)
 
     if columns:
         column_filter = "| cut -f %s" % ",".join(map(str,
@@ -402,7 +1352,6 @@ def mergeAndLoad(infiles,
     else:
         column_filter = ""
         if prefixes:
-            assert len(prefixes) == len(infiles)
             header_stmt = "--prefixes=%s" % ",".join(prefixes)
         else:
             header_stmt = "--add-file-prefix"
@@ -435,7 +1384,263 @@ def mergeAndLoad(infiles,
     | %(load_statement)s
     > %(outfile)s
     """
-    run()
+    run(statement)
+
+
+def get_connection_pragmas():
+    """return the pragmas for sqlite connections from the configuration.
+
+    Returns
+    -------
+    pragmas : dict
+        Arguments for :func:`configure_connection`.
+    """
+    PARAMS = get_params()
+    return dict(
+        (key, PARAMS.get("database_%s" % key, None))
+        for key in ("journal_mode", "synchronous", "mmap_size", "cache_size"))
+
+
+def configure_connection(dbhandle,
+                         journal_mode=None,
+                         synchronous=None,
+                         mmap_size=None,
+                         cache_size=None):
+    """set pragmas on an sqlite connection.
+
+    Pragmas that are None are left at the sqlite defaults.
+
+    Arguments
+    ---------
+    dbhandle : sqlite3.Connection
+        The database connection.
+    journal_mode : string
+        Journal mode of the database, for example ``wal``. The journal
+        mode is stored in the database file.
+    synchronous : string
+        Synchronisation setting, for example ``normal``.
+    mmap_size : int
+        Maximum number of bytes of the database to memory map.
+    cache_size : int
+        Page cache size. Negative numbers are in KiB.
+    """
+    for pragma, value in (("journal_mode", journal_mode),
+                          ("synchronous", synchronous),
+                          ("mmap_size", mmap_size),
+                          ("cache_size", cache_size)):
+        if value is None:
+            continue
+        try:
+            dbhandle.execute("PRAGMA %s = %s" % (pragma, value)).fetchall()
+        except sqlite3.OperationalError as msg:
+            E.warn("could not set %s = %s: %s" % (pragma, value, msg))
+
+
+class PooledConnection(sqlite3.Connection):
+    """an sqlite connection that is returned to its
+    :class:`ConnectionPool` when closed.
+
+    Databases attached to the connection are recorded in
+    :attr:`attached` so that they persist between uses. Functions
+    and collations are recorded in :attr:`functions` so that they can
+    be removed before the connection is reused.
+
+    A connection must not be used or closed again after it has been
+    closed. Statements on a connection that is idle in its pool raise
+    a :class:`sqlite3.ProgrammingError`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.pool = None
+        self.in_pool = False
+        self.attached = {}
+        self.functions = []
+        self.pragmas = {}
+
+    def check_in_use(self):
+        if self.in_pool:
+            raise sqlite3.ProgrammingError(
+                "Cannot operate on a connection returned to its pool.")
+
+    def cursor(self, *args, **kwargs):
+        self.check_in_use()
+        return sqlite3.Connection.cursor(self, *args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        self.check_in_use()
+        return sqlite3.Connection.execute(self, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.check_in_use()
+        return sqlite3.Connection.executemany(self, *args, **kwargs)
+
+    def executescript(self, *args, **kwargs):
+        self.check_in_use()
+        return sqlite3.Connection.executescript(self, *args, **kwargs)
+
+    def create_function(self, name, narg, *args, **kwargs):
+        self.functions.append(("create_function", name, narg))
+        return sqlite3.Connection.create_function(
+            self, name, narg, *args, **kwargs)
+
+    def create_aggregate(self, name, narg, *args, **kwargs):
+        self.functions.append(("create_aggregate", name, narg))
+        return sqlite3.Connection.create_aggregate(
+            self, name, narg, *args, **kwargs)
+
+    def create_collation(self, name, *args, **kwargs):
+        self.functions.append(("create_collation", name, None))
+        return sqlite3.Connection.create_collation(
+            self, name, *args, **kwargs)
+
+    def reset(self):
+        """reset the connection to the state it was opened in.
+
+        Uncommitted changes are rolled back, temporary tables and
+        views are dropped and databases attached other than through
+        :func:`connect` are detached. Factories, callbacks, functions
+        and the pragmas in :data:`CONNECTION_PRAGMAS` are restored.
+        """
+        if self.in_transaction:
+            self.rollback()
+        self.row_factory = None
+        self.text_factory = str
+        self.isolation_level = ""
+        self.set_authorizer(None)
+        self.set_progress_handler(None, 0)
+        self.set_trace_callback(None)
+
+        for method, name, narg in self.functions:
+            if narg is None:
+                getattr(sqlite3.Connection, method)(self, name, None)
+            else:
+                getattr(sqlite3.Connection, method)(self, name, narg, None)
+        self.functions = []
+
+        for object_type, name in self.execute(
+                "SELECT type, name FROM temp.sqlite_master "
+                "WHERE type IN ('table', 'view')").fetchall():
+            self.execute("DROP %s IF EXISTS temp.%s" % (object_type, name))
+
+        databases = [x[1] for x in
+                     self.execute("PRAGMA database_list").fetchall()]
+        for name in databases:
+            if name not in ("main", "temp") and name not in self.attached:
+                self.execute("DETACH DATABASE %s" % name)
+        self.attached = dict((x, y) for x, y in self.attached.items()
+                             if x in databases)
+
+        for pragma, value in self.pragmas.items():
+            if self.execute("PRAGMA %s" % pragma).fetchone()[0] != value:
+                self.execute("PRAGMA %s = %s" % (pragma, value)).fetchall()
+
+        if self.in_transaction:
+            self.commit()
+
+    def close(self):
+        if self.pool is None or not self.pool.release(self):
+            sqlite3.Connection.close(self)
+
+
+class ConnectionPool(object):
+    """a pool of connections to an sqlite database.
+
+    Connections are configured with :func:`configure_connection` when
+    they are opened. Closed connections are reset and kept for reuse
+    by other threads of the same process.
+
+    Arguments
+    ---------
+    database_name : string
+        Filename of the sqlite database.
+    size : int
+        Maximum number of idle connections to keep.
+    pragmas : dict
+        Arguments for :func:`configure_connection`.
+    """
+
+    def __init__(self, database_name, size=4, pragmas=None):
+        self.database_name = database_name
+        self.size = size
+        self.pragmas = pragmas or {}
+        self.idle = []
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def acquire(self):
+        """return an idle connection or open a new one."""
+        with self.lock:
+            if self.idle:
+                self.counts["reused"] += 1
+                dbhandle = self.idle.pop()
+                dbhandle.in_pool = False
+                return dbhandle
+            self.counts["opened"] += 1
+
+        dbhandle = sqlite3.connect(self.database_name,
+                                   factory=PooledConnection,
+                                   check_same_thread=False)
+        configure_connection(dbhandle, **self.pragmas)
+        for pragma in CONNECTION_PRAGMAS:
+            value = dbhandle.execute("PRAGMA %s" % pragma).fetchone()
+            if value is not None:
+                dbhandle.pragmas[pragma] = value[0]
+        dbhandle.pool = self
+        return dbhandle
+
+    def release(self, dbhandle):
+        """reset `dbhandle` and return it to the pool.
+
+        Returns False if the pool is full or the connection could not
+        be reset and the connection should be closed.
+        """
+        if dbhandle.in_pool:
+            return True
+
+        try:
+            dbhandle.reset()
+        except sqlite3.ProgrammingError:
+            # connection has been closed
+            return True
+        except sqlite3.Error as msg:
+            E.warn("could not reset connection to %s: %s" %
+                   (self.database_name, msg))
+            dbhandle.pool = None
+            return False
+
+        with self.lock:
+            if len(self.idle) >= self.size:
+                dbhandle.pool = None
+                return False
+            dbhandle.in_pool = True
+            self.idle.append(dbhandle)
+            return True
+
+    def close(self):
+        """close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for dbhandle in idle:
+            dbhandle.pool = None
+            dbhandle.in_pool = False
+            dbhandle.close()
+        E.debug("connection pool for %s: opened=%i, reused=%i" %
+                (self.database_name,
+                 self.counts["opened"],
+                 self.counts["reused"]))
+
+
+def close_connection_pools():
+    """close all connection pools of this process."""
+    with CONNECTION_POOLS_LOCK:
+        pools = list(CONNECTION_POOLS.values())
+        CONNECTION_POOLS.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_connection_pools)
 
 
 def connect():
@@ -449,6 +1654,12 @@ def connect():
     If ``annotations_database`` is in PARAMS, this method
     will attach the named database as ``annotations``.
 
+    Connections are taken from a per-process :class:`ConnectionPool`
+    and returned to it when they are closed, see
+    :class:`PooledConnection`. Connections are configured with
+    the ``database_journal_mode``, ``database_synchronous``,
+    ``database_mmap_size`` and ``database_cache_size`` options.
+
     Returns
     -------
     dbh
@@ -458,22 +1669,107 @@ def connect():
 
     # Note that in the future this might return an sqlalchemy or
     # db.py handle.
-    PARAMS = getParams()
-    if PARAMS["database_backend"] == "sqlite":
-        dbh = sqlite3.connect(getDatabaseName())
-
-        if "annotations_database" in PARAMS:
-            statement = '''ATTACH DATABASE '%s' as annotations''' % \
-                        (PARAMS["annotations_database"])
+    PARAMS = get_params()
+    backend = getDatabaseBackend()
+    if backend == "sqlite":
+        database_name = os.path.abspath(getDatabaseName())
+        key = (os.getpid(), database_name)
+        with CONNECTION_POOLS_LOCK:
+            if key not in CONNECTION_POOLS:
+                CONNECTION_POOLS[key] = ConnectionPool(
+                    database_name,
+                    size=PARAMS.get("database_pool_size", 4),
+                    pragmas=get_connection_pragmas())
+            pool = CONNECTION_POOLS[key]
+        dbh = pool.acquire()
+
+        annotations_database = PARAMS.get("annotations_database", None)
+        if dbh.attached.get("annotations", None) != annotations_database:
             cc = dbh.cursor()
-            cc.execute(statement)
+            if "annotations" in dbh.attached:
+                cc.execute("DETACH DATABASE annotations")
+                del dbh.attached["annotations"]
+            if annotations_database is not None:
+                statement = '''ATTACH DATABASE '%s' as annotations''' % \
+                            (annotations_database)
+                cc.execute(statement)
+                dbh.attached["annotations"] = annotations_database
             cc.close()
     else:
         raise NotImplementedError(
-            "backend %s not implemented" % PARAMS["database_backend"])
+            "backend %s not implemented" % backend)
     return dbh
 
 
+# name of the table recording the sources of views, see createView
+VIEW_STATUS = "view_status"
+
+
+def get_view_status(dbhandle, tablename):
+    """return the status of the sources of a view recorded by
+    :func:`createView`.
+
+    Returns
+    -------
+    definition : string
+        Definition of the view.
+    sources : dict
+        Mapping of source tables to their ``version`` and
+        ``max_rowid`` when the view was last updated.
+
+    Returns None if the status of the view is unknown.
+    """
+    cc = Database.executewait(
+        dbhandle,
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='%s'" %
+        VIEW_STATUS)
+    if cc.fetchone() is None:
+        return None
+
+    cc = Database.executewait(
+        dbhandle,
+        "SELECT source, version, max_rowid, definition FROM %s "
+        "WHERE viewname = '%s'" % (VIEW_STATUS, tablename))
+    definition, sources = None, {}
+    for source, version, max_rowid, definition in cc:
+        sources[source] = {"version": version, "max_rowid": max_rowid}
+    if not sources:
+        return None
+    return definition, sources
+
+
+def update_view_status(dbhandle, tablename, definition, sources):
+    """record the status of the sources of a view.
+
+    Arguments
+    ---------
+    dbhandle : object
+        A database handle.
+    tablename : string
+        Name of the view.
+    definition : string
+        Definition of the view.
+    sources : dict
+        Mapping of source tables to their status, see
+        :func:`CGATCore.Database.refresh_table_status`. The status
+        is None for sources that are not tables.
+    """
+    Database.executewait(
+        dbhandle,
+        "CREATE TABLE IF NOT EXISTS %s ("
+        "viewname TEXT, source TEXT, version INTEGER, max_rowid INTEGER, "
+        "definition TEXT, PRIMARY KEY (viewname, source))" % VIEW_STATUS)
+    dbhandle.execute("DELETE FROM %s WHERE viewname = ?" % VIEW_STATUS,
+                     (tablename, ))
+    dbhandle.executemany(
+        "INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % VIEW_STATUS,
+        [(tablename, source,
+          status["version"] if status else None,
+          status["max_rowid"] if status else None,
+          definition)
+         for source, status in sources.items()])
+
+
 def createView(dbhandle, tables, tablename, outfile,
                view_type="TABLE",
                ignore_duplicates=True):
@@ -482,6 +1778,14 @@ def createView(dbhandle, tables, tablename, outfile,
     This method performs a join across multiple tables and stores the
     result either as a view or a table in the database.
 
+    The versions of the tables recorded by csv2db and by triggers
+    on the tables are stored with the view, see
+    :func:`CGATCore.Database.refresh_table_status`. If none of the
+    tables have changed since the view has been created, the view is
+    left unchanged. If rows have only been appended to tables, the
+    rows of the view for the affected tracks are replaced. Otherwise
+    the view is created anew.
+
     Arguments
     ---------
     dbhandle :
@@ -509,27 +1813,52 @@ def createView(dbhandle, tables, tablename, outfile,
 
     '''
 
-    Database.executewait(
-        dbhandle,
-        "DROP %(view_type)s IF EXISTS %(tablename)s" % locals())
-
-    tracks, columns = [], []
     tablenames = [x[0] for x in tables]
+    definition = repr(([tuple(x) for x in tables], view_type,
+                       ignore_duplicates))
+
+    exists = Database.executewait(
+        dbhandle,
+        "SELECT COUNT(*) FROM sqlite_master WHERE name = '%s'" %
+        tablename).fetchone()[0] > 0
+    previous = get_view_status(dbhandle, tablename) if exists else None
+    if previous is not None and (previous[0] != definition or
+                                 set(previous[1]) != set(tablenames)):
+        previous = None
+
+    sources = dict((x, Database.refresh_table_status(dbhandle, x))
+                   for x in tablenames)
+
+    mode, changed = "create", tablenames
+    if previous is not None and \
+       all(sources[x] is not None and
+           previous[1][x]["version"] is not None for x in tablenames):
+        changed = [x for x in tablenames
+                   if sources[x]["version"] != previous[1][x]["version"]]
+        appended = all(sources[x]["created"] <= previous[1][x]["version"]
+                       for x in changed)
+        if not changed:
+            mode = "skip"
+        elif appended and view_type == "VIEW":
+            # views query the tables directly
+            mode = "skip"
+        elif appended and tables[0][1] == "track":
+            mode = "update"
+
+    if mode == "skip":
+        E.info("%s is up to date" % tablename)
+        if changed:
+            update_view_status(dbhandle, tablename, definition, sources)
+        dbhandle.commit()
+        touch_file(outfile)
+        return
+
+    columns = []
     for table, track in tables:
-        d = Database.executewait(
-            dbhandle,
-            "SELECT COUNT(DISTINCT %s) FROM %s" % (track, table))
-        tracks.append(d.fetchone()[0])
         columns.append(
             [x.lower() for x in Database.getColumnNames(dbhandle, table)
              if x != track])
 
-    E.info("creating %s from the following tables: %s" %
-           (tablename, str(list(zip(tablenames, tracks)))))
-    if min(tracks) != max(tracks):
-        raise ValueError(
-            "number of rows not identical - will not create view")
-
     from_statement = " , ".join(
         ["%s as t%i" % (y[0], x) for x, y in enumerate(tables)])
     f = tables[0][1]
@@ -552,27 +1881,62 @@ def createView(dbhandle, tables, tablename, outfile,
         taken.update(set(c))
 
     all_columns = ",".join(all_columns)
-    statement = '''
-    CREATE %(view_type)s %(tablename)s AS SELECT t0.track, %(all_columns)s
+    select_statement = '''SELECT t0.track, %(all_columns)s
     FROM %(from_statement)s
-    WHERE %(where_statement)s
-    ''' % locals()
+    WHERE %(where_statement)s''' % locals()
+
+    tracks = []
+    for table, track in tables:
+        d = Database.executewait(
+            dbhandle,
+            "SELECT COUNT(DISTINCT %s) FROM %s" % (track, table))
+        tracks.append(d.fetchone()[0])
+
+    E.info("%s %s from the following tables: %s" %
+           ("updating" if mode == "update" else "creating",
+            tablename, str(list(zip(tablenames, tracks)))))
+    if min(tracks) != max(tracks):
+        raise ValueError(
+            "number of rows not identical - will not create view")
+
+    if mode == "update":
+        # tracks in rows appended since the last update
+        tracks_statement = " UNION ".join(
+            ["SELECT %s FROM %s WHERE rowid > %i" % (
+                track, table, previous[1][table]["max_rowid"] or 0)
+             for table, track in tables if table in changed])
+        Database.executewait(
+            dbhandle,
+            "DELETE FROM %s WHERE track IN (%s)" % (
+                tablename, tracks_statement))
+        statement = "INSERT INTO %s %s AND t0.track IN (%s)" % (
+            tablename, select_statement, tracks_statement)
+    else:
+        Database.executewait(
+            dbhandle,
+            "DROP %(view_type)s IF EXISTS %(tablename)s" % locals())
+        statement = '''
+        CREATE %(view_type)s %(tablename)s AS %(select_statement)s
+        ''' % locals()
 
     Database.executewait(dbhandle, statement)
 
     nrows = Database.executewait(
-        dbhandle, "SELECT COUNT(*) FROM view_mapping").fetchone()[0]
+        dbhandle, "SELECT COUNT(*) FROM %s" % tablename).fetchone()[0]
 
     if nrows == 0:
         raise ValueError(
-            "empty view mapping, check statement = %s" %
-            (statement % locals()))
+            "empty view mapping, check statement = %s" % statement)
     if nrows != min(tracks):
         E.warn("view creates duplicate rows, got %i, expected %i" %
                (nrows, min(tracks)))
 
-    E.info("created view_mapping with %i rows" % nrows)
-    touchFile(outfile)
+    update_view_status(dbhandle, tablename, definition, sources)
+    dbhandle.commit()
+
+    E.info("%s %s with %i rows" % (
+        "updated" if mode == "update" else "created", tablename, nrows))
+    touch_file(outfile)
 
 
 def getDatabaseName():
@@ -596,15 +1960,44 @@ def getDatabaseName():
     '''
 
     locations = ["database_name", "database"]
-    PARAMS = getParams()
+    PARAMS = get_params()
     for location in locations:
         database = PARAMS.get(location, None)
+        if isinstance(database, dict):
+            # new style database url, for example sqlite:///./csvdb
+            database = database.get("url", None)
+            if database is not None:
+                database = re.sub("^[^:]+:///", "", database)
         if database is not None:
             return database
 
     raise KeyError("database name not found")
 
 
+def getDatabaseBackend():
+    '''Return the database backend associated with the pipeline.
+
+    The backend is taken from ``database_backend`` or the scheme of
+    the database url in the ``database`` section.
+
+    Returns
+    -------
+    backend : string
+        Database backend such as ``sqlite``.
+    '''
+    PARAMS = get_params()
+    backend = PARAMS.get("database_backend", None)
+    if backend is None:
+        database = PARAMS.get("database", None)
+        if isinstance(database, dict) and "url" in database:
+            backend = database["url"].split(":")[0]
+        else:
+            backend = "sqlite"
+    if backend == "sqlite3":
+        backend = "sqlite"
+    return backend
+
+
 def importFromIterator(
         outfile,
         tablename,
@@ -7,6 +7,11 @@ Session
 This module manages a DRMAA session. :func:`start_session`
 starts a session and :func:`close_session` closes it.
 
+Jobs submitted to the cluster are recorded in a :class:`RunJournal`.
+If the pipeline controller is restarted, :func:`reattach_jobs` uses
+the journal to resume waiting on jobs that are still running instead
+of submitting them again.
+
 Reference
 ---------
 
@@ -22,17 +27,24 @@ import stat
 import logging
 import subprocess
 import sys
+import threading
 import time
 import math
 import shutil
+import shlex
 import gevent
+import gevent.event
 import CGATCore.Experiment as E
 import CGATCore.IOTools as IOTools
 
 from CGATCore.Pipeline.Utils import get_caller_locals, get_caller, get_calling_function
-from CGATCore.Pipeline.Files import get_temp_filename, get_temp_dir
-from CGATCore.Pipeline.Parameters import substitute_parameters
-from CGATCore.Pipeline.Cluster import setup_drmaa_job_template, get_drmaa_job_stdout_stderr
+from CGATCore.Pipeline.Files import get_temp_filename, get_temp_dir, \
+    invalidate_file_metadata, release_temp_space, get_temp_dir_selector, \
+    ReferenceCache, TempNamespace
+from CGATCore.Pipeline.Parameters import substitute_parameters, \
+    stack_parameters, ParameterStack, PARAMS
+from CGATCore.Pipeline.Cluster import setup_drmaa_job_template, \
+    set_drmaa_job_paths, get_drmaa_job_stdout_stderr
 
 
 # talking to a cluster
@@ -44,9 +56,6 @@ except RuntimeError:
 except ImportError:
     HAS_DRMAA = False
 
-# Set from Pipeline.py
-PARAMS = {}
-
 # global drmaa session
 GLOBAL_SESSION = None
 
@@ -54,6 +63,29 @@ GLOBAL_SESSION = None
 GEVENT_TIMEOUT_STARTUP = 5
 GEVENT_TIMEOUT_WAIT = 1
 
+# Jobs that have been submitted to the cluster ahead of their
+# consumers and have not been collected yet. PENDING_JOBS maps
+# job ids to job records, PENDING_OUTPUTS maps absolute
+# output filenames to the ids of all jobs of the task producing them.
+PENDING_JOBS = collections.OrderedDict()
+PENDING_OUTPUTS = {}
+
+# Criticality of tasks in [0, 1] by function name, with 1 for tasks
+# on the critical path of the pipeline. Set by Control.main.
+TASK_CRITICALITY = {}
+
+# Journal of submitted jobs, see RunJournal. Set by Control.main.
+RUN_JOURNAL = None
+
+# Jobs of a previous run of the pipeline that were still running
+# when the pipeline was restarted. Maps job ids to journal records.
+REATTACHED_JOBS = collections.OrderedDict()
+
+# Number of jobs, total job duration, total run time and total time
+# spent waiting in the queue of tasks by function name for jobs that
+# have been run during this session.
+TASK_DURATIONS = {}
+
 
 def get_logger():
     return logging.getLogger("CGATCore.pipeline")
@@ -84,11 +116,28 @@ def _pickle_args(args, kwargs):
     return (submit_args, args_file)
 
 
-def start_session():
-    """start and initialize the global DRMAA session."""
+def start_session(contact=None):
+    """start and initialize the global DRMAA session.
+
+    Arguments
+    ---------
+    contact : string
+        Contact string of a previous session to reconnect to. If
+        reconnecting fails, a new session is started.
+    """
     global GLOBAL_SESSION
 
     if HAS_DRMAA and GLOBAL_SESSION is None:
+        if contact is not None:
+            GLOBAL_SESSION = drmaa.Session(contactString=contact)
+            try:
+                GLOBAL_SESSION.initialize()
+                return GLOBAL_SESSION
+            except drmaa.errors.DrmaaException as ex:
+                get_logger().warn(
+                    "could not reconnect to drmaa session {}: {}".format(
+                        contact, ex))
+
         GLOBAL_SESSION = drmaa.Session()
         try:
             GLOBAL_SESSION.initialize()
@@ -108,6 +157,430 @@ def close_session():
         GLOBAL_SESSION = None
 
 
+class RunJournal(object):
+    """append-only journal of jobs submitted to the cluster.
+
+    Each line of the journal is a JSON record. A ``submit`` record is
+    written when a job has been submitted and contains the job id,
+    the statement, the paths of the job script and its output, the
+    expected output files and the contact string of the DRMAA session.
+    A ``collect`` record is written once the job has been collected.
+
+    Records are flushed to disk immediately so that the journal
+    survives a crash of the pipeline controller.
+
+    Arguments
+    ---------
+    filename : string
+        Filename of the journal.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.outfile = None
+
+    def read(self):
+        """return records of jobs that have not been collected.
+
+        Returns
+        -------
+        jobs : collections.OrderedDict
+            Mapping of job ids to ``submit`` records.
+        """
+        jobs = collections.OrderedDict()
+        if not os.path.exists(self.filename):
+            return jobs
+
+        with open(self.filename) as inf:
+            for line in inf:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # ignore a partially written last line
+                    continue
+                if record["event"] == "submit":
+                    jobs[record["job_id"]] = record
+                elif record["event"] == "collect":
+                    jobs.pop(record["job_id"], None)
+        return jobs
+
+    def compact(self, jobs):
+        """rewrite the journal to only contain `jobs`."""
+        with self.lock:
+            self.close()
+            if not jobs:
+                if os.path.exists(self.filename):
+                    os.unlink(self.filename)
+                return
+            tmpfile = self.filename + ".tmp"
+            with open(tmpfile, "w") as outf:
+                for record in jobs.values():
+                    outf.write(json.dumps(record) + "\n")
+            os.replace(tmpfile, self.filename)
+
+    def write(self, record):
+        with self.lock:
+            if self.outfile is None:
+                self.outfile = open(self.filename, "a")
+            self.outfile.write(json.dumps(record) + "\n")
+            self.outfile.flush()
+            os.fsync(self.outfile.fileno())
+
+    def record_submission(self, job_id, statement, paths, outfiles,
+                          session=None, job_name=None):
+        """record that a job has been submitted."""
+        job_path, stdout_path, stderr_path = paths
+        self.write({"event": "submit",
+                    "job_id": job_id,
+                    "job_name": job_name,
+                    "statement": statement,
+                    "job_path": job_path,
+                    "stdout_path": stdout_path,
+                    "stderr_path": stderr_path,
+                    "outfiles": outfiles,
+                    "session": getattr(session, "contact", None),
+                    "time": time.time()})
+
+    def record_collection(self, job_id, success):
+        """record that a job has been collected."""
+        self.write({"event": "collect",
+                    "job_id": job_id,
+                    "success": success,
+                    "time": time.time()})
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+
+def _journal_submission(job_id, statement, paths, outfiles, session,
+                        job_name=None):
+    if RUN_JOURNAL is not None:
+        RUN_JOURNAL.record_submission(job_id, statement, paths, outfiles,
+                                      session, job_name=job_name)
+
+
+def _journal_collection(job_id, success):
+    REATTACHED_JOBS.pop(job_id, None)
+    if RUN_JOURNAL is not None:
+        RUN_JOURNAL.record_collection(job_id, success)
+
+
+def get_journal_session_contact(journal):
+    """return the session contact of the most recently submitted job
+    in `journal` that has not been collected."""
+    jobs = journal.read()
+    for record in reversed(list(jobs.values())):
+        if record.get("session"):
+            return record["session"]
+    return None
+
+
+def reattach_jobs(journal, session=None):
+    """re-attach to jobs of a previous run of the pipeline.
+
+    Jobs in `journal` that have not been collected are looked up on
+    the cluster. Jobs that are still queued or running are registered
+    so that :class:`GridExecutor` waits for them instead of submitting
+    the same statement again. Jobs that have finished are removed from
+    the journal. Whether their output is complete is decided by ruffus
+    as usual.
+
+    Arguments
+    ---------
+    journal : RunJournal
+        Journal of a previous run.
+    session : drmaa.Session
+        Session to query the cluster with. Defaults to the global
+        session.
+
+    Returns
+    -------
+    job_ids : list
+        Ids of jobs that have been re-attached.
+    """
+    if session is None:
+        session = GLOBAL_SESSION
+
+    jobs = journal.read()
+    live = collections.OrderedDict()
+    if session is not None:
+        finished = (drmaa.JobState.DONE, drmaa.JobState.FAILED,
+                    drmaa.JobState.UNDETERMINED)
+        for job_id, record in jobs.items():
+            try:
+                status = session.jobStatus(job_id)
+            except Exception as ex:
+                get_logger().debug("job {} is not known to the cluster: {}".format(
+                    job_id, ex))
+                continue
+            if status not in finished:
+                live[job_id] = record
+
+    REATTACHED_JOBS.clear()
+    REATTACHED_JOBS.update(live)
+    journal.compact(live)
+
+    if live:
+        get_logger().info("re-attached to {} running jobs: {}".format(
+            len(live), ",".join(map(str, live.keys()))))
+    return list(live.keys())
+
+
+def take_reattached_job(statement, outfiles=None, job_name=None):
+    """return the record of a re-attached job for `statement`.
+
+    Each job is returned only once.
+
+    Statements often contain temporary filenames that differ between
+    runs. Thus, if `outfiles` are given, a job is identified by its
+    output files and its job name. A job running the same statement
+    is preferred, otherwise jobs are taken in the order they have been
+    submitted. Without `outfiles`, the statement needs to be the same.
+    """
+    candidates = []
+    for record in REATTACHED_JOBS.values():
+        if record.get("taken"):
+            continue
+        if not outfiles or not record["outfiles"]:
+            if record["statement"] == statement:
+                candidates.append(record)
+            continue
+        if sorted(outfiles) != sorted(record["outfiles"]):
+            continue
+        if job_name and record.get("job_name") and \
+           job_name != record["job_name"]:
+            continue
+        candidates.append(record)
+
+    if not candidates:
+        return None
+
+    record = next((x for x in candidates if x["statement"] == statement),
+                  candidates[0])
+    # the job stays registered until it has been collected
+    record["taken"] = True
+    return record
+
+
+def _flatten_filenames(value):
+    """return list of strings in a possibly nested list of filenames."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    result = []
+    try:
+        for v in value:
+            result.extend(_flatten_filenames(v))
+    except TypeError:
+        pass
+    return result
+
+
+def get_pending_job_ids(filenames, statements=None):
+    """return ids of pending jobs that produce any of *filenames*.
+
+    If *statements* is given, jobs whose output files are mentioned
+    in any of the statements are returned as well.
+
+    Arguments
+    ---------
+    filenames : list
+        List of filenames, possibly nested.
+    statements : list
+        List of command line statements.
+
+    Returns
+    -------
+    job_ids : list
+        Sorted list of job ids.
+    """
+    if not PENDING_OUTPUTS:
+        return []
+
+    job_ids = set()
+    for fn in _flatten_filenames(filenames):
+        job_ids.update(PENDING_OUTPUTS.get(os.path.abspath(fn), ()))
+
+    if statements:
+        for job_id, job in PENDING_JOBS.items():
+            if job_id in job_ids:
+                continue
+            for fn in job["outfiles"]:
+                if any(fn in x for x in statements):
+                    job_ids.add(job_id)
+                    break
+
+    return sorted(job_ids)
+
+
+def is_pending_output(filename):
+    """return True if *filename* will be created by a pending job."""
+    return os.path.abspath(filename) in PENDING_OUTPUTS
+
+
+def wait_for_pending_jobs(job_ids=None):
+    """wait for jobs that have been submitted ahead and collect them.
+
+    Benchmark data of the jobs are logged in the same way as for
+    jobs that have been waited for by :func:`run`. If a job failed,
+    all pending jobs depending on it are removed from the cluster.
+
+    Arguments
+    ---------
+    job_ids : list
+        Job ids to wait for. If None, wait for all pending jobs.
+
+    Raises
+    ------
+    OSError
+        If any of the jobs waited for failed.
+    """
+    if job_ids is None:
+        job_ids = list(PENDING_JOBS.keys())
+
+    logger = get_logger()
+    errors = []
+    for job_id in job_ids:
+        job = PENDING_JOBS.get(job_id, None)
+        if job is None:
+            continue
+
+        if job["collector"] is not None:
+            # another greenlet is collecting this job
+            if not job["collector"].get():
+                errors.append("dependency {} failed".format(job_id))
+            continue
+
+        job["collector"] = gevent.event.AsyncResult()
+        executor = job["executor"]
+        job_path, stdout_path, stderr_path = job["paths"]
+        success = False
+        try:
+            executor.wait_for_job_completion([job_id])
+            stdout, stderr, resource_usage = \
+                executor.collect_single_job_from_cluster(
+                    job_id, job["statement"],
+                    stdout_path, stderr_path, job_path)
+            benchmark_data = executor.collect_benchmark_data(
+                stdout,
+                [job["statement"]],
+                job["start_time"],
+                time.time(),
+                resource_usage=resource_usage)
+            for data in benchmark_data:
+                logger.info(json.dumps(data._asdict()))
+            _record_task_durations(executor.task_name, benchmark_data)
+            success = True
+        except OSError as ex:
+            errors.append(str(ex))
+            for dependent_id in _get_dependent_job_ids(job_id):
+                logger.warn("removing job {} as it depends on "
+                            "failed job {}".format(dependent_id, job_id))
+                try:
+                    executor.session.control(
+                        dependent_id, drmaa.JobControlAction.TERMINATE)
+                except Exception as msg:
+                    logger.warn("could not remove job {}: {}".format(
+                        dependent_id, msg))
+                _remove_pending_job(dependent_id, success=False)
+                _journal_collection(dependent_id, False)
+        finally:
+            invalidate_file_metadata(job["outfiles"])
+            _remove_pending_job(job_id, success=success)
+            _journal_collection(job_id, success)
+
+    if errors:
+        raise OSError("\n".join(errors))
+
+
+def _record_task_durations(task_name, benchmark_data):
+    """add job durations in *benchmark_data* to TASK_DURATIONS."""
+    if not benchmark_data:
+        return
+    counts = TASK_DURATIONS.setdefault(task_name.split(".")[-1],
+                                       [0, 0.0, 0.0, 0.0])
+    for data in benchmark_data:
+        counts[0] += 1
+        counts[1] += data.total_t
+        if data.start_time > 0 and data.end_time >= data.start_time:
+            counts[2] += data.end_time - data.start_time
+        if data.submit_time > 0 and data.start_time >= data.submit_time:
+            counts[3] += data.start_time - data.submit_time
+
+
+def _get_dependent_job_ids(job_id):
+    """return ids of pending jobs depending directly or indirectly
+    on *job_id*."""
+    dependents = []
+    to_check = [job_id]
+    while to_check:
+        current = to_check.pop()
+        for other_id, job in PENDING_JOBS.items():
+            if current in job["dependencies"] and other_id not in dependents:
+                dependents.append(other_id)
+                to_check.append(other_id)
+    return dependents
+
+
+def _remove_pending_job(job_id, success):
+    job = PENDING_JOBS.pop(job_id, None)
+    if job is None:
+        return
+    for fn in job["outfiles"]:
+        job_ids = PENDING_OUTPUTS.get(fn, [])
+        if job_id in job_ids:
+            job_ids.remove(job_id)
+        if not job_ids:
+            PENDING_OUTPUTS.pop(fn, None)
+    if job["collector"] is not None:
+        job["collector"].set(success)
+
+
+def read_exit_status(job_path, attempts=10):
+    """return the exit status recorded by the job script `job_path`.
+
+    The exit status is written by the script when it exits. As the
+    file might not yet be visible on a shared file system, reading
+    it is attempted several times.
+
+    Returns
+    -------
+    exit_status : int
+        The exit status or None if it has not been recorded.
+    """
+    for attempt in range(attempts):
+        try:
+            with open(job_path + ".exit") as inf:
+                return int(inf.read().strip())
+        except (IOError, OSError, ValueError):
+            if attempt < attempts - 1:
+                gevent.sleep(GEVENT_TIMEOUT_WAIT)
+    return None
+
+
+def substitute_filename(statement, filename, replacement):
+    """replace `filename` in `statement` with `replacement`.
+
+    Only complete words are replaced, for example, ``sample.bam``
+    will not be replaced in ``sample.bam.bai``.
+
+    Returns
+    -------
+    statement : string
+        The modified statement.
+    n : int
+        The number of replacements.
+    """
+    pattern = re.compile(
+        r"(?<![^\s'\"=<>|;:,(])" + re.escape(filename) +
+        r"(?![^\s'\"<>|;:,)])")
+    return pattern.subn(lambda m: replacement, statement)
+
+
 def shellquote(statement):
     '''shell quote a string to be used as a function argument.
 
@@ -181,7 +654,7 @@ def execute(statement, **kwargs):
     if not kwargs:
         kwargs = get_caller_locals()
 
-    kwargs = dict(list(PARAMS.items()) + list(kwargs.items()))
+    kwargs = ParameterStack(kwargs, PARAMS)
 
     logger = get_logger()
     logger.debug("running %s" % (statement % kwargs))
@@ -245,7 +718,7 @@ def interpolate_statement(statement, kwargs):
 
     '''
 
-    local_params = substitute_parameters(**kwargs)
+    local_params = stack_parameters(kwargs)
 
     # build the statement
     try:
@@ -424,7 +897,16 @@ def will_run_on_cluster(options):
 
 class Executor(object):
 
-    def __init__(self, **kwargs):
+    # choose between temporary directories configured with ``tmpdirs``
+    # on the execution host, see build_job_script
+    select_temp_dir_on_node = False
+
+    def __init__(self, options=None, **kwargs):
+
+        # options are usually a ParameterStack built by :func:`run`
+        # and are used as is to avoid copying them.
+        if options is not None:
+            kwargs = ParameterStack(kwargs, options) if kwargs else options
 
         self.logger = get_logger()
 
@@ -451,6 +933,20 @@ class Executor(object):
         self.job_name = kwargs.get("job_name", "unknow_job_name")
         self.task_name = kwargs.get("task_name", "unknown_task_name")
 
+        # lower the priority of jobs off the critical path. Jobs on
+        # the critical path keep the configured priority.
+        self.job_priority = kwargs.get("job_priority", None)
+        self.job_nice = kwargs.get("job_nice", None)
+        criticality = TASK_CRITICALITY.get(self.task_name.split(".")[-1], None)
+        if criticality is not None:
+            cluster_options = kwargs.get("cluster", {})
+            spread = cluster_options.get("priority_spread", 100)
+            offset = int(round((1.0 - criticality) * spread))
+            if self.job_priority is None:
+                self.job_priority = cluster_options.get("priority", 0) - offset
+            if self.job_nice is None:
+                self.job_nice = offset
+
         # deduce output directory/directories, requires somewhat
         # consistent naming in the calling function.
         outfiles = []
@@ -462,6 +958,27 @@ class Executor(object):
         self.output_directories = set(sorted(
             [os.path.dirname(x) for x in outfiles]))
 
+        self.outfiles = [os.path.abspath(x) for x in _flatten_filenames(outfiles)]
+        self.infiles = _flatten_filenames(
+            [kwargs.get("infile", None), kwargs.get("infiles", None)])
+
+        # copy input and output files to and from local scratch
+        self.stage_inputs = kwargs.get("job_stage_inputs", False)
+        self.staged_outfiles = _flatten_filenames(outfiles)
+
+        # expected size of temporary files of a job. Space is
+        # reserved when choosing a temporary directory.
+        self.job_temp_space = kwargs.get("job_temp_space", None)
+        if isinstance(self.job_temp_space, str):
+            self.job_temp_space = IOTools.human2bytes(self.job_temp_space)
+        # temporary directories with reserved space by job script
+        self.temp_reservations = {}
+
+        # parameters referring to files to keep in the reference cache
+        self.cache_parameters = kwargs.get("job_cache_parameters", [])
+        if isinstance(self.cache_parameters, str):
+            self.cache_parameters = [self.cache_parameters]
+
         self.options = kwargs
 
         self.workingdir = PARAMS["workingdir"]
@@ -475,7 +992,17 @@ class Executor(object):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        pass
+        # space of jobs that have not been collected, for example
+        # because a job failed
+        for job_path in list(self.temp_reservations):
+            self.release_job_temp_space(job_path)
+
+    def release_job_temp_space(self, job_path):
+        """release the temporary space reserved for the job
+        running `job_path`."""
+        tmpdir = self.temp_reservations.pop(job_path, None)
+        if tmpdir is not None:
+            release_temp_space(tmpdir)
 
     def expand_statement(self, statement):
         '''add generic commands before and after statement.
@@ -546,6 +1073,17 @@ class Executor(object):
                                   set -e
                                   }}'''.format(**locals())))
 
+        if self.stage_inputs:
+            statement, stage_in, stage_out, clean_stage = \
+                self.stage_statement(statement)
+            setup_cmds.extend(stage_in)
+            teardown_cmds.extend(stage_out)
+            cleanup_funcs.extend(clean_stage)
+
+        if self.cache_parameters:
+            statement, cache_cmds = self.cache_statement(statement)
+            setup_cmds.extend(cache_cmds)
+
         if "job_condaenv" in self.options:
             # In conda < 4.4 there is an issue with parallel activations,
             # see https://github.com/conda/conda/issues/2837 .
@@ -570,6 +1108,125 @@ class Executor(object):
 
         return statement, cleanup_funcs
 
+    def stage_statement(self, statement):
+        '''stage input and output files of a statement on local scratch.
+
+        Input files that appear in the statement are copied to a
+        directory in the local scratch directory (``tmpdir``) before
+        the statement is run and the statement is changed to use the
+        local copies. Output files that appear in the statement are
+        written to the scratch directory and copied to their final
+        location once the statement has completed successfully. The
+        copy is written next to the output file and then renamed so
+        that partial output files are never visible.
+
+        Arguments
+        ---------
+        statement : string
+            Command line statement to stage.
+
+        Returns
+        -------
+        statement : string
+            The statement using local copies.
+        setup_cmds : list
+            Commands to copy input files.
+        teardown_cmds : list
+            Commands to copy output files.
+        cleanup_funcs : list
+            Cleanup functions to remove the local copies.
+        '''
+        stagedir = get_temp_dir(clear=True)
+        setup_cmds, teardown_cmds = [], []
+
+        infiles = set(self.infiles)
+        for x, infile in enumerate(self.infiles):
+            if not os.path.isfile(infile):
+                continue
+            local = os.path.join(
+                stagedir, "in{}_{}".format(x, os.path.basename(infile)))
+            statement, n = substitute_filename(statement, infile, local)
+            if n:
+                setup_cmds.append('cp "{}" "{}"'.format(infile, local))
+
+        for x, outfile in enumerate(self.staged_outfiles):
+            if outfile in infiles:
+                continue
+            local = os.path.join(
+                stagedir, "out{}_{}".format(x, os.path.basename(outfile)))
+            statement, n = substitute_filename(statement, outfile, local)
+            if n:
+                partial = os.path.join(
+                    os.path.dirname(outfile),
+                    ".{}.staging".format(os.path.basename(outfile)))
+                teardown_cmds.append(
+                    'if [ -e "{local}" ]; then '
+                    'cp "{local}" "{partial}" && mv -f "{partial}" "{outfile}"; '
+                    'fi'.format(**locals()))
+
+        if setup_cmds or teardown_cmds:
+            setup_cmds.insert(0, 'mkdir -p "{}"'.format(stagedir))
+            cleanup_funcs = [("clean_stage",
+                              "{{ rm -rf {}; }}".format(stagedir))]
+        else:
+            cleanup_funcs = []
+        return statement, setup_cmds, teardown_cmds, cleanup_funcs
+
+    def cache_statement(self, statement):
+        '''use the reference cache for files in a statement.
+
+        Files given by the parameters in ``job_cache_parameters`` are
+        looked up in the :class:`ReferenceCache` on local scratch of
+        the execution host. The statement is changed to use the
+        cached copies. The job holds a lock on the cache entries it
+        uses until it has completed.
+
+        Arguments
+        ---------
+        statement : string
+            Command line statement.
+
+        Returns
+        -------
+        statement : string
+            The statement using cached copies.
+        setup_cmds : list
+            Commands to populate and lock the cache entries.
+        '''
+        cachedir = self.options.get("reference_cache_dir", None)
+        if not cachedir:
+            cachedir = os.path.join(PARAMS["tmpdir"], "reference_cache")
+        cache_size = self.options.get("reference_cache_size", None)
+
+        setup_cmds = []
+        for parameter in self.cache_parameters:
+            path = self.options.get(parameter, None)
+            if not isinstance(path, str) or not path:
+                continue
+            key, sources = ReferenceCache.get_entry(path)
+            if not sources:
+                continue
+            local = os.path.join(
+                cachedir, key, os.path.basename(os.path.abspath(path)))
+            statement, n = substitute_filename(statement, path, local)
+            if not n:
+                continue
+            setup_cmds.append(
+                'exec {{cache_lock}}>>"{}" && flock -s $cache_lock'.format(
+                    os.path.join(cachedir, key + ".lock")))
+            setup_cmds.append(
+                "python -c 'import sys; "
+                "from CGATCore.Pipeline.Files import ReferenceCache; "
+                "ReferenceCache(sys.argv[1], sys.argv[2] or None)"
+                ".fetch(sys.argv[3], sys.argv[4:])' "
+                '"{}" "{}" {} {}'.format(
+                    cachedir, cache_size or "", key,
+                    " ".join('"{}"'.format(x) for x in sources)))
+
+        if setup_cmds:
+            setup_cmds.insert(0, 'mkdir -p "{}"'.format(cachedir))
+        return statement, setup_cmds
+
     def build_job_script(self,
                          statement):
         '''build job script from statement.
@@ -579,7 +1236,15 @@ class Executor(object):
         tmpfilename = get_temp_filename(dir=self.workingdir, clear=True)
         tmpfilename = tmpfilename + ".sh"
 
-        tmpdir = get_temp_dir(clear=True)
+        # jobs running on other hosts choose between several
+        # temporary directories on the execution host
+        selector = None
+        if self.select_temp_dir_on_node:
+            selector = get_temp_dir_selector()
+        if selector is None:
+            tmpdir = get_temp_dir(clear=True, size=self.job_temp_space)
+            if self.job_temp_space:
+                self.temp_reservations[os.path.abspath(tmpfilename)] = tmpdir
 
         expanded_statement, cleanup_funcs = self.expand_statement(statement)
 
@@ -599,13 +1264,37 @@ class Executor(object):
                     if outdir:
                         tmpfile.write("\nmkdir -p {}\n".format(outdir))
 
-            # create and set system scratch dir for temporary files
+            # create and set system scratch dir for temporary files.
+            # This also creates the temporary namespace on the
+            # execution host for other temporary files in the statement.
             tmpfile.write("umask 002\n")
-            tmpfile.write("mkdir -p {}\n".format(tmpdir))
-            tmpfile.write("export TMPDIR={}\n".format(tmpdir))
-            cleanup_funcs.append(
-                ("clean_temp",
-                 "{{ rm -rf {}; }}".format(tmpdir)))
+            if selector is None:
+                tmpfile.write("mkdir -p {}\n".format(tmpdir))
+                tmpfile.write("export TMPDIR={}\n".format(tmpdir))
+                cleanup_funcs.append(
+                    ("clean_temp",
+                     "{{ rm -rf {}; }}".format(tmpdir)))
+            else:
+                # the directory is a namespace of the job's shell
+                # so that it can be swept if the job is killed.
+                tmpfile.write(
+                    "tmpbase=$(python -c 'import sys, json; "
+                    "from CGATCore.Pipeline.Files import "
+                    "select_temp_dir_on_node; "
+                    "print(select_temp_dir_on_node("
+                    "json.loads(sys.argv[1]), int(sys.argv[2]), "
+                    "int(sys.argv[3])))' {} {} {}) || tmpbase={}\n".format(
+                        shlex.quote(json.dumps(selector.locations)),
+                        selector.min_free,
+                        self.job_temp_space or 0,
+                        shlex.quote(selector.locations[0][0])))
+                tmpfile.write('mkdir -p "$tmpbase"\n')
+                tmpfile.write(
+                    'export TMPDIR=$(mktemp -d '
+                    '"$tmpbase/{}$(hostname)-$$-XXXXXXXX")\n'.format(
+                        TempNamespace.prefix))
+                cleanup_funcs.append(
+                    ("clean_temp", '{ rm -rf "$TMPDIR"; }'))
 
             # output times whenever script exits, preserving
             # return status
@@ -614,7 +1303,10 @@ class Executor(object):
             for cleanup_func, cleanup_code in cleanup_funcs:
                 tmpfile.write("\n{}() {}\n".format(cleanup_func, cleanup_code))
 
-            tmpfile.write("\nclean_all() {{ {}; }}\n".format(
+            # record the exit status so that it can be checked if
+            # the scheduler does not report it, see read_exit_status
+            tmpfile.write("\nclean_all() {{ echo $? > {}; {}; }}\n".format(
+                os.path.abspath(tmpfilename) + ".exit",
                 "; ".join([x[0] for x in cleanup_funcs])))
 
             tmpfile.write("\ntrap clean_all EXIT\n\n")
@@ -774,8 +1466,10 @@ class Executor(object):
 
 class GridExecutor(Executor):
 
-    def __init__(self, **kwargs):
-        Executor.__init__(self, **kwargs)
+    select_temp_dir_on_node = True
+
+    def __init__(self, options=None, **kwargs):
+        Executor.__init__(self, options, **kwargs)
         self.session = GLOBAL_SESSION
         if self.session is None:
             raise ValueError("no Grid Session found")
@@ -783,6 +1477,20 @@ class GridExecutor(Executor):
         # if running on cluster, use a working directory on shared drive
         self.workingdir_is_local = IOTools.is_local(self.workingdir)
 
+        # submit jobs without waiting for them to finish. Downstream
+        # jobs will be held by the scheduler until these have completed.
+        # SGE releases held jobs even if their dependencies failed.
+        cluster_options = self.options.get("cluster", {})
+        self.submit_ahead = self.options.get(
+            "job_dependencies",
+            cluster_options.get("dependencies", False))
+        if self.submit_ahead and \
+           cluster_options.get("queue_manager", "").lower() == "sge":
+            self.logger.debug(
+                "job dependencies are not supported for SGE, "
+                "jobs will be waited for")
+            self.submit_ahead = False
+
         # connect to global session
         pid = os.getpid()
         self.logger.debug('task: pid={}, grid-session={}, workingdir={}'.format(
@@ -815,6 +1523,8 @@ class GridExecutor(Executor):
 
             shutil.rmtree(self.workingdir)
 
+        Executor.__exit__(self, exc_type, exc_value, traceback)
+
     def collect_single_job_from_cluster(self,
                                         job_id,
                                         statement,
@@ -824,14 +1534,41 @@ class GridExecutor(Executor):
         try:
             retval = self.session.wait(job_id, drmaa.Session.TIMEOUT_WAIT_FOREVER)
         except Exception as msg:
-            # ignore message 24, indicates jobs that have been qdel'ed
-            if not str(msg).startswith("code 24"):
+            # ignore message 24, indicates jobs that have been qdel'ed.
+            # Jobs re-attached from a previous run might not be known
+            # to the current session.
+            if not str(msg).startswith("code 24") and \
+               job_id not in REATTACHED_JOBS:
                 raise
             retval = None
 
         stdout, stderr = get_drmaa_job_stdout_stderr(stdout_path, stderr_path)
         resource_usage = None
 
+        if retval is None and job_id in REATTACHED_JOBS and \
+           not self.ignore_errors:
+            # the scheduler did not report the exit status of a job
+            # submitted in a previous run, use the status recorded by
+            # the job script instead. Jobs that have not recorded a
+            # status, for example because they have been killed, are
+            # failed.
+            exit_status = read_exit_status(job_path)
+            if exit_status is None:
+                raise OSError(
+                    "---------------------------------------\n"
+                    "Job {} did not record an exit status and might "
+                    "have been killed: \n"
+                    "The stderr was: \n{}\n{}\n"
+                    "-----------------------------------------".format(
+                        job_id, "".join(stderr), statement))
+            elif exit_status != 0:
+                raise OSError(
+                    "---------------------------------------\n"
+                    "Job {} exited with error code {}: \n"
+                    "The stderr was: \n{}\n{}\n"
+                    "-----------------------------------------".format(
+                        job_id, exit_status, "".join(stderr), statement))
+
         if retval is not None and not self.ignore_errors:
             if retval.exitStatus != 0:
                 raise OSError(
@@ -859,6 +1596,10 @@ class GridExecutor(Executor):
             self.logger.warn(
                 ("temporary job file %s not present for "
                  "clean-up - ignored") % job_path)
+        try:
+            os.unlink(job_path + ".exit")
+        except OSError:
+            pass
 
         return stdout, stderr, resource_usage
 
@@ -866,7 +1607,20 @@ class GridExecutor(Executor):
 
         # submit statements to cluster individually.
         benchmark_data = []
-        jt = self.setup_job(self.options["cluster"])
+
+        job_dependencies = get_pending_job_ids(self.infiles, statement_list)
+
+        # jobs can only be left running if their output can be tracked
+        # and the job runs in the final working directory.
+        submit_ahead = self.submit_ahead and self.outfiles and \
+            not self.workingdir_is_local
+
+        if job_dependencies and not submit_ahead:
+            wait_for_pending_jobs(job_dependencies)
+            job_dependencies = []
+
+        jt = self.setup_job(self.options["cluster"],
+                            job_dependencies=job_dependencies)
 
         self.logger.debug("job-options: %s" % jt.nativeSpecification)
 
@@ -875,6 +1629,19 @@ class GridExecutor(Executor):
         for statement in statement_list:
             self.logger.debug("running statement:\n%s" % statement)
 
+            record = take_reattached_job(statement, self.outfiles,
+                                         self.job_name)
+            if record is not None:
+                job_id = record["job_id"]
+                job_ids.append(job_id)
+                filenames.append((record["job_path"],
+                                  record["stdout_path"],
+                                  record["stderr_path"]))
+                self.logger.info(
+                    "re-attached to job {} submitted in a previous run".format(
+                        job_id))
+                continue
+
             full_statement, job_path = self.build_job_script(statement)
 
             stdout_path, stderr_path = set_drmaa_job_paths(jt, job_path)
@@ -882,10 +1649,36 @@ class GridExecutor(Executor):
             job_id = self.session.runJob(jt)
             job_ids.append(job_id)
             filenames.append((job_path, stdout_path, stderr_path))
+            _journal_submission(job_id, statement, filenames[-1],
+                                self.outfiles, self.session,
+                                job_name=self.job_name)
             self.logger.debug("job has been submitted with job_id %s" % str(job_id))
             # give back control for bulk submission
             gevent.sleep(GEVENT_TIMEOUT_STARTUP)
 
+        self.session.deleteJobTemplate(jt)
+
+        if submit_ahead:
+            # leave jobs running and let downstream jobs wait on
+            # the cluster. Outputs are registered with all jobs as
+            # they are complete only once all jobs have finished.
+            for job_id, statement, paths in zip(job_ids,
+                                                statement_list,
+                                                filenames):
+                PENDING_JOBS[job_id] = {
+                    "executor": self,
+                    "statement": statement,
+                    "paths": paths,
+                    "start_time": start_time,
+                    "dependencies": job_dependencies,
+                    "outfiles": self.outfiles,
+                    "collector": None}
+                for fn in self.outfiles:
+                    PENDING_OUTPUTS.setdefault(fn, []).append(job_id)
+            self.logger.debug("jobs {} will be collected later".format(
+                ",".join(map(str, job_ids))))
+            return benchmark_data
+
         self.wait_for_job_completion(job_ids)
 
         end_time = time.time()
@@ -896,12 +1689,18 @@ class GridExecutor(Executor):
                                             filenames):
             job_path, stdout_path, stderr_path = paths
             # TODO: collect timings from individual jobs
-            stdout, stderr, resource_usage = self.collect_single_job_from_cluster(
-                job_id,
-                statement,
-                stdout_path,
-                stderr_path,
-                job_path)
+            success = False
+            try:
+                stdout, stderr, resource_usage = \
+                    self.collect_single_job_from_cluster(
+                        job_id,
+                        statement,
+                        stdout_path,
+                        stderr_path,
+                        job_path)
+                success = True
+            finally:
+                _journal_collection(job_id, success)
 
             # end time is meaningless
             end_time = time.time()
@@ -912,17 +1711,23 @@ class GridExecutor(Executor):
                                             end_time,
                                             resource_usage=resource_usage))
 
-        self.session.deleteJobTemplate(jt)
         return benchmark_data
 
-    def setup_job(self, options):
+    def setup_job(self, options, job_dependencies=None):
+
+        options = dict(options)
+        if self.job_priority is not None:
+            options["priority"] = self.job_priority
+        if self.job_nice is not None:
+            options["nice"] = self.job_nice
 
         return setup_drmaa_job_template(self.session,
                                         job_name=self.job_name,
                                         job_memory=self.job_memory,
                                         job_threads=self.job_threads,
                                         working_directory=self.workingdir,
-                                        **options["cluster"])
+                                        job_dependencies=job_dependencies,
+                                        **options)
 
     def wait_for_job_completion(self, job_ids):
 
@@ -930,7 +1735,14 @@ class GridExecutor(Executor):
         running_job_ids = set(job_ids)
         while running_job_ids:
             for job_id in list(running_job_ids):
-                status = self.session.jobStatus(job_id)
+                try:
+                    status = self.session.jobStatus(job_id)
+                except drmaa.errors.InvalidJobException:
+                    # jobs re-attached from a previous run disappear
+                    # once finished
+                    if job_id not in REATTACHED_JOBS:
+                        raise
+                    status = drmaa.JobState.DONE
                 if status in (drmaa.JobState.DONE, drmaa.JobState.FAILED):
                     running_job_ids.remove(job_id)
                 else:
@@ -943,6 +1755,9 @@ class GridArrayExecutor(GridExecutor):
     def run(self, statement_list):
 
         benchmark_data = []
+        wait_for_pending_jobs(
+            get_pending_job_ids(self.infiles, statement_list))
+
         # run statements through array interface
         jobsfile = get_temp_filename(dir=self.workingdir,
                                      clear=True) + ".jobs"
@@ -973,10 +1788,11 @@ class GridArrayExecutor(GridExecutor):
                                         start_time,
                                         end_time,
                                         resource_usage=resource_usage))
-        try:
-            os.unlink(jobsfile)
-        except OSError:
-            pass
+        for fn in (jobsfile, job_path + ".exit"):
+            try:
+                os.unlink(fn)
+            except OSError:
+                pass
 
         return benchmark_data
 
@@ -1017,11 +1833,20 @@ class LocalExecutor(Executor):
     def run(self, statement_list):
 
         benchmark_data = []
+        wait_for_pending_jobs(
+            get_pending_job_ids(self.infiles, statement_list))
+
         for statement in statement_list:
             self.logger.debug("running statement:\n%s" % statement)
 
             full_statement, job_path = self.build_job_script(statement)
 
+            # run jobs off the critical path with a lower scheduling
+            # priority on the local machine.
+            command = job_path
+            if self.job_nice:
+                command = "nice -n {} {}".format(min(19, self.job_nice), job_path)
+
             # max_vmem is set to max_rss, not available by /usr/bin/time
             full_statement = (
                 "/usr/bin/time --output=%s.times "
@@ -1048,7 +1873,7 @@ class LocalExecutor(Executor):
                 "socket_sent\t%%s\n"
                 "major_page_fault\t%%F\n"
                 "unshared_data\t%%D\n' "
-                "%s") % (job_path, job_path)
+                "%s") % (job_path, command)
 
             while 1:
                 start_time = time.time()
@@ -1094,11 +1919,12 @@ class LocalExecutor(Executor):
                     end_time,
                     time_data_file=job_path + ".times"))
 
-            try:
-                os.unlink(job_path)
-                os.unlink(job_path + ".times")
-            except OSError:
-                pass
+            for fn in (job_path, job_path + ".times", job_path + ".exit"):
+                try:
+                    os.unlink(fn)
+                except OSError:
+                    pass
+            self.release_job_temp_space(job_path)
 
         return benchmark_data
 
@@ -1107,10 +1933,17 @@ class LocalArrayExecutor(LocalExecutor):
     pass
 
 
-def make_runner(**kwargs):
+def make_runner(options=None, **kwargs):
     """factory function returning an object capable of executing
     a list of command line statements.
+
+    Arguments
+    ---------
+    options : dict
+        Mapping of job options. Values in `kwargs` take precedence.
     """
+    if options is not None:
+        kwargs = ParameterStack(kwargs, options) if kwargs else options
 
     run_as_array = "job_array" in kwargs and kwargs["job_array"] is not None
 
@@ -1122,14 +1955,14 @@ def make_runner(**kwargs):
 
     if run_on_cluster:
         if run_as_array:
-            runner = GridArrayExecutor(**kwargs)
+            runner = GridArrayExecutor(kwargs)
         else:
-            runner = GridExecutor(**kwargs)
+            runner = GridExecutor(kwargs)
     else:
         if run_as_array:
-            runner = LocalArrayExecutor(**kwargs)
+            runner = LocalArrayExecutor(kwargs)
         else:
-            runner = LocalExecutor(**kwargs)
+            runner = LocalExecutor(kwargs)
 
     return runner
 
@@ -1162,6 +1995,38 @@ def run(statement, **kwargs):
     job_array
         if set, run statement as an array job. Job_array should be
         tuple with start, end, and increment.
+    job_priority
+        priority of the job in the cluster queue. By default, the
+        configured priority is lowered for tasks off the critical
+        path if critical path priorities are enabled.
+    job_dependencies
+        if set, submit cluster jobs without waiting for them to
+        finish. Jobs consuming their output will be held by the
+        scheduler until they have completed successfully. Only
+        tasks marked with :func:`cluster_only` start before their
+        inputs are complete, other tasks wait for the jobs creating
+        their inputs. Not supported for SGE. Defaults to the
+        ``cluster_dependencies`` configuration value.
+    job_cache_parameters
+        list of parameters referring to reference files, directories
+        or file prefixes. The files are copied to a cache on local
+        scratch of the execution host that is shared between jobs,
+        see :class:`Files.ReferenceCache`, and the statement is
+        changed to use the cached copies. The location and size of
+        the cache are set by the ``reference_cache_dir`` and
+        ``reference_cache_size`` configuration values.
+    job_temp_space
+        expected size of temporary files written by the job, for
+        example ``10G``. If several temporary directories have been
+        configured with ``tmpdirs``, the space is reserved in the
+        chosen directory while the job is running. Jobs running on
+        a cluster choose the directory on the execution host.
+    job_stage_inputs
+        if set, copy input files to local scratch (``tmpdir``) before
+        running the statement and write output files to local scratch
+        before copying them to their final location. Only files given
+        as ``infile(s)`` and ``outfile(s)`` that appear in the
+        statement are staged.
 
     In addition, any additional variables will be used to interpolate
     the command line string using python's '%' string interpolation
@@ -1232,15 +2097,14 @@ def run(statement, **kwargs):
     """
     logger = get_logger()
 
-    # combine options using priority
-    options = dict(list(PARAMS.items()))
+    # combine options using priority. Options are set in the top
+    # layer, the dictionaries below are not modified.
     caller_options = get_caller_locals()
+    if "self" in caller_options:
+        caller_options = dict(caller_options)
+        del caller_options["self"]
 
-    options.update(list(caller_options.items()))
-
-    if "self" in options:
-        del options["self"]
-    options.update(list(kwargs.items()))
+    options = ParameterStack({}, kwargs, caller_options, PARAMS)
 
     # inject params dictionary from Task functions into option dict.
     # This allows passing options from the config file.
@@ -1249,10 +2113,10 @@ def run(statement, **kwargs):
 
     # insert parameters supplied through simplified interface such
     # as job_memory, job_options, job_queue
-    options['cluster']['options'] = options.get(
-        'job_options', options['cluster']['options'])
-    options['cluster']['queue'] = options.get(
-        'job_queue', options['cluster']['queue'])
+    options['cluster'] = dict(
+        options['cluster'],
+        options=options.get('job_options', options['cluster']['options']),
+        queue=options.get('job_queue', options['cluster']['queue']))
     options['without_cluster'] = options.get('without_cluster')
 
     # SGE compatible job_name
@@ -1288,15 +2152,21 @@ def run(statement, **kwargs):
         return []
 
     # execute statement list
-    runner = make_runner(**options)
+    runner = make_runner(options)
 
-    with runner as r:
-        benchmark_data = r.run(statement_list)
+    try:
+        with runner as r:
+            benchmark_data = r.run(statement_list)
+    finally:
+        # outputs have been (re-)written
+        invalidate_file_metadata(runner.outfiles)
 
     # log benchmark_data
     for data in benchmark_data:
         logger.info(json.dumps(data._asdict()))
 
+    _record_task_durations(options["task_name"], benchmark_data)
+
     return benchmark_data
 
 
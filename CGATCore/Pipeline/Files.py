@@ -1,12 +1,36 @@
 """Files.py - Working with files in ruffus pipelines
 ====================================================
 
+:class:`FileMetadataCache` caches file system metadata such as
+the results of :func:`os.stat` while ruffus checks which tasks
+are up-to-date.
+
+Temporary files and directories are named within a private
+directory of each process, see :class:`TempNamespace`.
+
+:class:`ReferenceCache` keeps copies of reference files on local
+scratch of a compute node to be shared by jobs on that node.
+
 Reference
 ---------
 
 """
+import atexit
+import collections
+import contextlib
+import fcntl
+import glob
+import hashlib
+import itertools
+import json
 import os
+import random
+import shutil
+import socket
+import stat
 import tempfile
+import threading
+import time
 
 import CGATCore.IOTools as IOTools
 import CGATCore.Experiment as E
@@ -14,6 +38,612 @@ import CGATCore.Experiment as E
 # Set from Pipeline.py
 PARAMS = {}
 
+SAVED_OS_STAT = os.stat
+SAVED_OS_PATH_ABSPATH = os.path.abspath
+SAVED_OS_PATH_REALPATH = os.path.realpath
+SAVED_OS_PATH_RELPATH = os.path.relpath
+SAVED_OS_PATH_ISLINK = os.path.islink
+SAVED_OS_CHDIR = os.chdir
+
+# The active metadata cache, see Control.cache_os_functions
+FILE_METADATA_CACHE = None
+
+# Temporary namespaces by process id and directory,
+# see get_temp_namespace
+TEMP_NAMESPACES = {}
+TEMP_NAMESPACES_LOCK = threading.Lock()
+
+# Process running the heartbeat of temporary namespaces,
+# see start_temp_namespace_heartbeat
+TEMP_NAMESPACES_HEARTBEAT = None
+
+# Selection of temporary directories, see get_temp_dir_selector
+TEMP_DIR_SELECTOR = None
+
+
+class FileMetadataCache(object):
+    """a bounded cache of file system metadata.
+
+    The cache provides replacements for :func:`os.stat`,
+    :func:`os.path.abspath`, :func:`os.path.realpath`,
+    :func:`os.path.relpath` and :func:`os.path.islink`. Each type of
+    lookup is kept in a separate least-recently-used cache of at most
+    `maxsize` entries. Relative paths are resolved against the working
+    directory, which needs to be changed through :meth:`chdir`.
+
+    Failed lookups such as a stat of a file that does not exist yet
+    are not cached. Entries for files that have been modified need
+    to be removed with :meth:`invalidate`.
+
+    Arguments
+    ---------
+    maxsize : int
+        Maximum number of entries per type of lookup.
+
+    Attributes
+    ----------
+    counts : Counter
+        Number of cache hits and misses.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.cwd = os.getcwd()
+        self.counts = E.Counter()
+        self.lock = threading.Lock()
+        self.caches = collections.defaultdict(collections.OrderedDict)
+
+    def _get(self, cache_name, key):
+        with self.lock:
+            cache = self.caches[cache_name]
+            try:
+                value = cache[key]
+            except KeyError:
+                self.counts[cache_name + "_misses"] += 1
+                raise
+            cache.move_to_end(key)
+            self.counts[cache_name + "_hits"] += 1
+            return value
+
+    def _set(self, cache_name, key, value):
+        with self.lock:
+            cache = self.caches[cache_name]
+            cache[key] = value
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+
+    def _normalize(self, path):
+        return os.path.normpath(os.path.join(self.cwd, path))
+
+    def stat(self, path, *args, **kwargs):
+        if args or not isinstance(path, str) or \
+           set(kwargs).difference(("follow_symlinks",)):
+            return SAVED_OS_STAT(path, *args, **kwargs)
+
+        key = (self._normalize(path), kwargs.get("follow_symlinks", True))
+        try:
+            return self._get("stat", key)
+        except KeyError:
+            pass
+        result = SAVED_OS_STAT(path, **kwargs)
+        self._set("stat", key, result)
+        return result
+
+    def islink(self, path):
+        try:
+            result = self.stat(path, follow_symlinks=False)
+        except (OSError, ValueError, TypeError):
+            return False
+        return stat.S_ISLNK(result.st_mode)
+
+    def chdir(self, path):
+        SAVED_OS_CHDIR(path)
+        self.cwd = os.getcwd()
+
+    def abspath(self, path):
+        key = (self.cwd, path)
+        try:
+            return self._get("abspath", key)
+        except (KeyError, TypeError):
+            pass
+        result = SAVED_OS_PATH_ABSPATH(path)
+        self._set("abspath", key, result)
+        return result
+
+    def relpath(self, path, start=None):
+        key = (self.cwd, path, start)
+        try:
+            return self._get("relpath", key)
+        except (KeyError, TypeError):
+            pass
+        result = SAVED_OS_PATH_RELPATH(path, start)
+        self._set("relpath", key, result)
+        return result
+
+    def realpath(self, path):
+        if not isinstance(path, str):
+            return SAVED_OS_PATH_REALPATH(path)
+        key = self._normalize(path)
+        try:
+            return self._get("realpath", key)
+        except KeyError:
+            pass
+        result = SAVED_OS_PATH_REALPATH(path)
+        # do not cache paths that do not resolve to an existing file
+        try:
+            self.stat(result)
+        except (OSError, ValueError):
+            return result
+        self._set("realpath", key, result)
+        return result
+
+    def prefetch(self, directory, max_depth=5, threads=10, ignore=None):
+        """fill the cache with the metadata of files below *directory*.
+
+        Directories are listed with :func:`os.scandir`, one level of
+        the directory tree at a time, with all directories in a level
+        being listed in parallel. Hidden files and directories as well
+        as directories that are symbolic links are skipped. Prefetching
+        stops once the cache is full.
+
+        Arguments
+        ---------
+        directory : string
+            Directory to start from.
+        max_depth : int
+            Maximum depth of sub-directories to descend into.
+        threads : int
+            Number of directories to list in parallel.
+        ignore : list
+            Directories to skip, for example temporary directories.
+
+        Returns
+        -------
+        nentries : int
+            Number of files and directories added to the cache.
+        """
+        ignore = set(self._normalize(x) for x in (ignore or []))
+
+        def scan(path):
+            entries, subdirs = [], []
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.name.startswith("."):
+                            continue
+                        try:
+                            lstat = entry.stat(follow_symlinks=False)
+                            if stat.S_ISLNK(lstat.st_mode):
+                                fstat = entry.stat(follow_symlinks=True)
+                            else:
+                                fstat = lstat
+                        except OSError:
+                            continue
+                        entries.append((entry.path, fstat, lstat))
+                        if stat.S_ISDIR(lstat.st_mode) and entry.path not in ignore:
+                            subdirs.append(entry.path)
+            except OSError:
+                pass
+            return entries, subdirs
+
+        directory = self._normalize(directory)
+        try:
+            self._set("stat", (directory, True), SAVED_OS_STAT(directory))
+        except OSError:
+            return 0
+
+        # imported here as multiprocessing is slow to import
+        from multiprocessing.pool import ThreadPool
+
+        nentries = 0
+        level = [directory]
+        pool = ThreadPool(threads)
+        try:
+            for depth in range(max_depth + 1):
+                if not level or nentries >= self.maxsize:
+                    break
+                next_level = []
+                for entries, subdirs in pool.imap_unordered(scan, level):
+                    for path, fstat, lstat in entries:
+                        self._set("stat", (path, True), fstat)
+                        self._set("stat", (path, False), lstat)
+                    nentries += len(entries)
+                    next_level.extend(subdirs)
+                level = next_level
+        finally:
+            pool.close()
+            pool.join()
+
+        self.counts["prefetched"] += nentries
+        return nentries
+
+    def invalidate(self, paths):
+        """remove cached entries for *paths* and their directories."""
+        keys = set()
+        for path in paths:
+            path = self._normalize(path)
+            keys.add(path)
+            keys.add(os.path.dirname(path))
+
+        with self.lock:
+            stats = self.caches["stat"]
+            realpaths = self.caches["realpath"]
+            for key in keys:
+                stats.pop((key, True), None)
+                stats.pop((key, False), None)
+                realpaths.pop(key, None)
+            self.counts["invalidated"] += len(paths)
+
+
+def invalidate_file_metadata(paths):
+    """remove *paths* from the active file metadata cache.
+
+    This function should be called for any files that have been
+    created or modified by a job.
+    """
+    if FILE_METADATA_CACHE is not None:
+        FILE_METADATA_CACHE.invalidate(paths)
+
+
+class TempNamespace(object):
+    """hand out names of temporary files within a private directory.
+
+    A single directory :file:`ctmp-ns-<host>-<pid>-<random>` is
+    created within `basedir` the first time a name is requested.
+    Names within it are generated from a counter and are unique
+    without any further file system access. The directory and
+    everything left in it is removed by :meth:`cleanup`.
+
+    Arguments
+    ---------
+    basedir : string
+        Directory in which to create the private directory.
+    """
+
+    prefix = "ctmp-ns-"
+
+    def __init__(self, basedir):
+        self.basedir = os.path.abspath(basedir)
+        self.pid = os.getpid()
+        self.dirname = None
+        self.keep = False
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def get_dirname(self):
+        """return the private directory, creating it if necessary."""
+        if self.dirname is None:
+            with self.lock:
+                if self.dirname is None:
+                    if not os.path.exists(self.basedir):
+                        os.makedirs(self.basedir, exist_ok=True)
+                    self.dirname = tempfile.mkdtemp(
+                        dir=self.basedir,
+                        prefix="{}{}-{}-".format(
+                            self.prefix, socket.gethostname(), self.pid))
+        return self.dirname
+
+    def get_filename(self, suffix=""):
+        """return a new name within the private directory.
+
+        The file is not created.
+        """
+        return os.path.join(
+            self.get_dirname(),
+            "ctmp{:06d}{}".format(next(self.counter), suffix))
+
+    def cleanup(self):
+        """remove the private directory and its contents."""
+        if self.dirname is None or self.keep or os.getpid() != self.pid:
+            return
+        shutil.rmtree(self.dirname, ignore_errors=True)
+        self.dirname = None
+
+    def refresh(self):
+        """mark the private directory as in use by updating its
+        modification time."""
+        if self.dirname is None or os.getpid() != self.pid:
+            return
+        try:
+            os.utime(self.dirname)
+        except OSError:
+            pass
+
+    @classmethod
+    def sweep(cls, basedir, max_age):
+        """remove private directories of other processes in `basedir`.
+
+        Directories are removed if they have not been modified for
+        `max_age` seconds. Directories of this host are kept while
+        the process that created them is still running. Directories
+        of other hosts, for example in a shared directory or created
+        by cluster jobs, are kept fresh by the heartbeat of the
+        process using them, see :func:`start_temp_namespace_heartbeat`,
+        and are only removed once the heartbeat has stopped.
+
+        Returns
+        -------
+        removed : list
+            Directories that have been removed.
+        """
+        removed = []
+        if not os.path.isdir(basedir):
+            return removed
+
+        hostname = socket.gethostname()
+        now = time.time()
+        with os.scandir(basedir) as it:
+            for entry in it:
+                if not entry.name.startswith(cls.prefix):
+                    continue
+                try:
+                    host, pid, _ = entry.name[len(cls.prefix):].rsplit("-", 2)
+                    pid = int(pid)
+                    if not entry.is_dir(follow_symlinks=False) or \
+                       now - entry.stat(follow_symlinks=False).st_mtime < max_age:
+                        continue
+                except (ValueError, OSError):
+                    continue
+                if host == hostname and is_process_alive(pid):
+                    continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed.append(entry.path)
+        return removed
+
+
+def is_process_alive(pid):
+    """return True if a process with `pid` exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class TempDirSelector(object):
+    """choose between several directories for temporary files.
+
+    Directories are chosen by weighted round-robin among those
+    directories that have enough free space. Free space is determined
+    with :func:`os.statvfs` and cached for `interval` seconds. Space
+    can be reserved for temporary files of a known size and is
+    subtracted from the free space until it is released.
+
+    Arguments
+    ---------
+    locations : list
+        List of directories. Each directory is either a string, a
+        tuple of ``(directory, weight)`` or a dictionary with the keys
+        ``dir`` and ``weight``. The default weight is 1.
+    min_free : int or string
+        Space that should remain free in each directory.
+    interval : float
+        Time in seconds to cache the free space of a directory.
+    """
+
+    def __init__(self, locations, min_free=0, interval=5):
+        self.locations = []
+        for location in locations:
+            if isinstance(location, str):
+                dirname, weight = location, 1
+            elif isinstance(location, dict):
+                dirname, weight = location["dir"], location.get("weight", 1)
+            else:
+                dirname, weight = location
+            self.locations.append((os.path.abspath(dirname), float(weight)))
+        if not self.locations:
+            raise ValueError("no temporary directories given")
+
+        if isinstance(min_free, str):
+            min_free = IOTools.human2bytes(min_free)
+        self.min_free = min_free or 0
+        self.interval = interval
+        self.current = collections.Counter()
+        self.reserved = collections.Counter()
+        self.reservations = {}
+        self.free_space = {}
+        self.lock = threading.RLock()
+
+    def get_free_space(self, dirname):
+        """return available space in `dirname` in bytes."""
+        now = time.time()
+        cached = self.free_space.get(dirname, None)
+        if cached is not None and now - cached[0] < self.interval:
+            return cached[1]
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            st = os.statvfs(dirname)
+            free = st.f_bavail * st.f_frsize
+        except OSError:
+            free = 0
+        self.free_space[dirname] = (now, free)
+        return free
+
+    def select(self, size=0, randomize=False):
+        """return a directory with at least `size` bytes available.
+
+        If no directory has enough space, the directory with the
+        most space available is returned. If `randomize` is set, the
+        directory is chosen at random according to the weights
+        instead of round-robin.
+        """
+        with self.lock:
+            available = [
+                (self.get_free_space(dirname) - self.reserved[dirname],
+                 dirname, weight)
+                for dirname, weight in self.locations]
+            candidates = [(dirname, weight) for free, dirname, weight
+                          in available if free - size >= self.min_free]
+            if not candidates:
+                free, dirname, weight = max(available)
+                E.warn("no temporary directory with {} bytes available, "
+                       "using {} with {} bytes available".format(
+                           size, dirname, free))
+                return dirname
+
+            if randomize:
+                return random.choices(
+                    [x[0] for x in candidates],
+                    weights=[x[1] for x in candidates])[0]
+
+            # smooth weighted round-robin
+            total = 0
+            for dirname, weight in candidates:
+                self.current[dirname] += weight
+                total += weight
+            dirname = max(candidates, key=lambda x: self.current[x[0]])[0]
+            self.current[dirname] -= total
+            return dirname
+
+    def reserve(self, dirname, size, token):
+        """reserve `size` bytes in `dirname` until `token` is released."""
+        with self.lock:
+            self.reserved[dirname] += size
+            self.reservations[token] = (dirname, size)
+
+    def release(self, token):
+        """release space that has been reserved for `token`."""
+        with self.lock:
+            reservation = self.reservations.pop(token, None)
+            if reservation is not None:
+                self.reserved[reservation[0]] -= reservation[1]
+
+
+def select_temp_dir_on_node(locations, min_free=0, size=0):
+    """choose a directory for the temporary files of a job on the
+    host the job is running on.
+
+    This function is called from job scripts of cluster jobs, so that
+    free space is determined on the execution host. As the choice is
+    not shared between jobs, directories are chosen at random according
+    to their weights. See :class:`TempDirSelector` for the arguments.
+    """
+    return TempDirSelector(locations, min_free=min_free).select(
+        size, randomize=True)
+
+
+def get_temp_dir_selector():
+    """return the :class:`TempDirSelector` for the configuration parameter
+    ``tmpdirs``.
+
+    Returns None if ``tmpdirs`` is not set.
+    """
+    global TEMP_DIR_SELECTOR
+    locations = PARAMS.get("tmpdirs", None)
+    if not locations:
+        return None
+    if isinstance(locations, str):
+        locations = locations.split(",")
+    config = (repr(locations), PARAMS.get("tmpdirs_min_free", 0))
+    selector = TEMP_DIR_SELECTOR
+    if selector is None or selector.config != config:
+        with TEMP_NAMESPACES_LOCK:
+            selector = TempDirSelector(locations, min_free=config[1])
+            selector.config = config
+            TEMP_DIR_SELECTOR = selector
+    return selector
+
+
+def release_temp_space(filename):
+    """release space reserved for a temporary file or directory.
+
+    See :func:`get_temp_dir`.
+    """
+    if TEMP_DIR_SELECTOR is not None:
+        TEMP_DIR_SELECTOR.release(filename)
+
+
+def get_temp_namespace(dir=None, shared=False, size=0):
+    """return the :class:`TempNamespace` of this process for `dir`.
+
+    Namespaces are created once per process and directory. When a
+    namespace is created, stale namespaces left behind by crashed
+    runs in the same directory are swept, see :meth:`TempNamespace.sweep`.
+    The maximum age in seconds is taken from the configuration
+    parameter ``tmpdir_max_age``. Namespaces in use are kept fresh by
+    :func:`start_temp_namespace_heartbeat`.
+
+    If `dir` is not given and ``tmpdirs`` is configured, the directory
+    is chosen by :class:`TempDirSelector` with at least `size` bytes
+    available.
+    """
+    if dir is None:
+        if shared:
+            dir = PARAMS['shared_tmpdir']
+        else:
+            selector = get_temp_dir_selector()
+            if selector is None:
+                dir = PARAMS['tmpdir']
+            else:
+                dir = selector.select(size)
+
+    key = (os.getpid(), os.path.abspath(dir))
+    namespace = TEMP_NAMESPACES.get(key, None)
+    if namespace is None:
+        with TEMP_NAMESPACES_LOCK:
+            namespace = TEMP_NAMESPACES.get(key, None)
+            if namespace is None:
+                max_age = PARAMS.get("tmpdir_max_age", None)
+                if max_age is not None:
+                    TempNamespace.sweep(key[1], max_age)
+                namespace = TempNamespace(key[1])
+                TEMP_NAMESPACES[key] = namespace
+        start_temp_namespace_heartbeat()
+    return namespace
+
+
+def refresh_temp_namespaces():
+    """mark the temporary namespaces of this process as in use."""
+    for namespace in list(TEMP_NAMESPACES.values()):
+        namespace.refresh()
+
+
+def start_temp_namespace_heartbeat():
+    """refresh the temporary namespaces of this process periodically.
+
+    A daemon thread refreshes the namespaces every
+    ``tmpdir_heartbeat`` seconds, so that a sweep from another host
+    does not remove namespaces of processes that are still running.
+    """
+    global TEMP_NAMESPACES_HEARTBEAT
+    interval = PARAMS.get("tmpdir_heartbeat", None)
+    if not interval or TEMP_NAMESPACES_HEARTBEAT == os.getpid():
+        return
+
+    with TEMP_NAMESPACES_LOCK:
+        if TEMP_NAMESPACES_HEARTBEAT == os.getpid():
+            return
+        TEMP_NAMESPACES_HEARTBEAT = os.getpid()
+
+    def beat():
+        while True:
+            time.sleep(interval)
+            refresh_temp_namespaces()
+
+    threading.Thread(target=beat, name="tmpdir-heartbeat",
+                     daemon=True).start()
+
+
+def keep_temp_namespaces():
+    """do not remove the temporary namespaces of this process at exit.
+
+    This is required if jobs that are still running use temporary
+    files. The namespaces will be removed by a later sweep.
+    """
+    for namespace in list(TEMP_NAMESPACES.values()):
+        namespace.keep = True
+
+
+def cleanup_temp_namespaces():
+    """remove the temporary namespaces of this process."""
+    for namespace in list(TEMP_NAMESPACES.values()):
+        namespace.cleanup()
+
+
+atexit.register(cleanup_temp_namespaces)
+
 
 def get_temp_file(dir=None, shared=False):
     '''get a temporary file.
@@ -21,6 +651,11 @@ def get_temp_file(dir=None, shared=False):
     The file is created and the caller needs to close and delete
     the temporary file once it is not used any more.
 
+    If `dir` is not given, the file is created within a private
+    directory of the current process (see :class:`TempNamespace`)
+    and any files left over are removed when the process exits.
+    Files in an explicitly given `dir` are kept.
+
     If dir does not exist, it will be created.
 
     Arguments
@@ -37,23 +672,27 @@ def get_temp_file(dir=None, shared=False):
     file : File
         A file object of the temporary file.
     '''
-    if dir is None:
-        if shared:
-            dir = PARAMS['shared_tmpdir']
-        else:
-            dir = PARAMS['tmpdir']
+    if dir is not None:
+        # the file might be needed after this process has finished,
+        # for example by a cluster job
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        return tempfile.NamedTemporaryFile(dir=dir, delete=False,
+                                           prefix="ctmp")
 
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-
-    return tempfile.NamedTemporaryFile(dir=dir, delete=False, prefix="ctmp")
+    return open(get_temp_namespace(dir, shared).get_filename(), "x+b")
 
 
 def get_temp_filename(dir=None, shared=False, clear=True):
     '''return a temporary filename.
 
-    The file is created and the caller needs to delete the temporary
-    file once it is not used any more (unless `clear` is set`).
+    Unless `clear` is set, the file is created and the caller needs
+    to delete the temporary file once it is not used any more.
+
+    If `dir` is not given, the filename is unique within a private
+    directory of the current process (see :class:`TempNamespace`)
+    and any files left over are removed when the process exits.
+    Files in an explicitly given `dir` are kept.
 
     If dir does not exist, it will be created.
 
@@ -66,7 +705,7 @@ def get_temp_filename(dir=None, shared=False, clear=True):
         If set, the tempory file will be in a shared temporary
         location.
     clear : bool
-        If set, remove the temporary file after creation.
+        If set, do not create the file.
 
     Returns
     -------
@@ -74,19 +713,30 @@ def get_temp_filename(dir=None, shared=False, clear=True):
         Absolute pathname of temporary file.
 
     '''
-    tmpfile = get_temp_file(dir=dir, shared=shared)
-    tmpfile.close()
-    if clear:
-        os.unlink(tmpfile.name)
-    return tmpfile.name
+    if dir is not None:
+        tmpfile = get_temp_file(dir=dir, shared=shared)
+        tmpfile.close()
+        if clear:
+            os.unlink(tmpfile.name)
+        return tmpfile.name
+
+    filename = get_temp_namespace(dir, shared).get_filename()
+    if not clear:
+        open(filename, "x").close()
+    return filename
 
 
-def get_temp_dir(dir=None, shared=False, clear=False):
+def get_temp_dir(dir=None, shared=False, clear=False, size=None):
     '''get a temporary directory.
 
     The directory is created and the caller needs to delete the temporary
     directory once it is not used any more.
 
+    If `dir` is not given, the directory is created within a private
+    directory of the current process (see :class:`TempNamespace`)
+    and any directories left over are removed when the process
+    exits. Directories in an explicitly given `dir` are kept.
+
     If dir does not exist, it will be created.
 
     Arguments
@@ -97,6 +747,12 @@ def get_temp_dir(dir=None, shared=False, clear=False):
     shared : bool
         If set, the tempory directory will be in a shared temporary
         location.
+    clear : bool
+        If set, do not create the directory.
+    size : int or string
+        Expected size of the contents of the directory. If given, the
+        space is reserved in the chosen location until
+        :func:`release_temp_space` is called.
 
     Returns
     -------
@@ -104,21 +760,346 @@ def get_temp_dir(dir=None, shared=False, clear=False):
         Absolute pathname of temporary file.
 
     '''
-    if dir is None:
-        if shared:
-            dir = PARAMS['shared_tmpdir']
-        else:
-            dir = PARAMS['tmpdir']
+    if isinstance(size, str):
+        size = IOTools.human2bytes(size)
+
+    if dir is not None:
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        tmpdir = tempfile.mkdtemp(dir=dir, prefix="ctmp")
+        if clear:
+            os.rmdir(tmpdir)
+        return tmpdir
+
+    selector = None
+    if size and not shared:
+        selector = get_temp_dir_selector()
 
-    if not os.path.exists(dir):
-        os.makedirs(dir)
+    if selector is None:
+        tmpdir = get_temp_namespace(dir, shared).get_filename()
+    else:
+        # select and reserve atomically
+        with selector.lock:
+            namespace = get_temp_namespace(size=size)
+            tmpdir = namespace.get_filename()
+            selector.reserve(namespace.basedir, size, tmpdir)
 
-    tmpdir = tempfile.mkdtemp(dir=dir, prefix="ctmp")
-    if clear:
-        os.rmdir(tmpdir)
+    if not clear:
+        os.mkdir(tmpdir)
     return tmpdir
 
 
+class ReferenceCache(object):
+    """a cache of reference files on local scratch shared between jobs.
+
+    Each entry is a directory named after a key that is derived from
+    the paths, sizes and modification times of the files it contains,
+    see :meth:`get_entry`. Entries are populated by the first job
+    that requires them while holding a lock and are shared by all
+    other jobs on the same node.
+
+    Jobs using an entry hold a shared lock on :file:`<key>.lock`.
+    If the size of the cache exceeds `size`, the least recently
+    used entries that are not locked are removed. If a reference
+    does not fit into the cache, the entry contains symbolic links to
+    the original files instead of copies.
+
+    Hits and misses are appended to :file:`cache.log` within the
+    cache directory.
+
+    Arguments
+    ---------
+    dirname : string
+        Directory of the cache.
+    size : int or string
+        Maximum size of the cache in bytes or as a human readable
+        string such as ``100G``. If None, the size is not limited.
+    """
+
+    def __init__(self, dirname, size=None):
+        self.dirname = os.path.abspath(dirname)
+        if isinstance(size, str):
+            size = IOTools.human2bytes(size)
+        self.size = size
+        self.counts = collections.Counter()
+
+    @staticmethod
+    def get_entry(path):
+        """return key and files of a cache entry for `path`.
+
+        `path` can be a file, a directory or a prefix of several
+        files such as an index consisting of several files.
+
+        Returns
+        -------
+        key : string
+            Key of the entry.
+        sources : list
+            Files or directories to copy into the entry. The list is
+            empty if `path` does not exist.
+        """
+        path = os.path.abspath(path)
+        if os.path.exists(path):
+            sources = [path]
+        else:
+            sources = sorted(x for x in glob.glob(glob.escape(path) + "*")
+                             if os.path.isfile(x))
+
+        signature = [path]
+        for source in sources:
+            if os.path.isdir(source):
+                for root, dirs, files in os.walk(source):
+                    dirs.sort()
+                    for fn in sorted(files):
+                        fn = os.path.join(root, fn)
+                        st = os.stat(fn)
+                        signature.append((fn, st.st_size, st.st_mtime_ns))
+            else:
+                st = os.stat(source)
+                signature.append((source, st.st_size, st.st_mtime_ns))
+
+        key = hashlib.md5(json.dumps(signature).encode("utf-8")).hexdigest()
+        return key, sources
+
+    @contextlib.contextmanager
+    def lock(self, filename, shared=False, blocking=True):
+        """hold a lock on `filename` within the cache directory.
+
+        Yields True if the lock has been acquired. If not `blocking`,
+        yields False if the lock is held elsewhere.
+        """
+        with open(os.path.join(self.dirname, filename), "a") as outf:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(outf.fileno(), flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(outf.fileno(), fcntl.LOCK_UN)
+
+    def log(self, event, key, sources):
+        self.counts[event] += 1
+        with open(os.path.join(self.dirname, "cache.log"), "a") as outf:
+            outf.write("{}\t{}\t{}\t{}\t{}\n".format(
+                time.strftime("%Y-%m-%d %H:%M:%S"), socket.gethostname(),
+                event, key, ",".join(sources)))
+
+    def get_usage(self, key=None):
+        """return entries and bytes used by the cache.
+
+        Incomplete entries of jobs that are not running any more are
+        removed. Entries that are being populated are counted with
+        their final size.
+
+        Returns
+        -------
+        entries : list
+            Tuples of (is_copy, modification time, size, key) for
+            all complete entries except `key`.
+        used : int
+            Number of bytes used.
+        """
+        entries, used = [], 0
+        with os.scandir(self.dirname) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                name = entry.name
+                entry_key = name.split(".")[0]
+                if entry_key == key:
+                    continue
+                if ".tmp" in name:
+                    marker = os.path.join(entry.path, ".reserved")
+                else:
+                    marker = os.path.join(entry.path, ".complete")
+                try:
+                    with open(marker) as inf:
+                        size = int(inf.read().strip())
+                except (OSError, ValueError):
+                    size = None
+
+                if ".tmp" in name or size is None:
+                    with self.lock(entry_key + ".populate",
+                                   blocking=False) as acquired:
+                        if acquired:
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                            continue
+                    used += size or 0
+                else:
+                    entries.append((size > 0, entry.stat().st_mtime,
+                                    size, entry_key))
+                    used += size
+        return entries, used
+
+    def evict(self, size, key=None):
+        """remove entries so that `size` bytes can be added.
+
+        Least recently used entries are removed first. Entries that
+        are in use by a job are not removed.
+
+        Returns
+        -------
+        fits : bool
+            True if `size` bytes can be added to the cache.
+        """
+        entries, used = self.get_usage(key)
+        if self.size is None:
+            return True
+        if size > self.size:
+            return False
+
+        for is_copy, mtime, entry_size, entry_key in sorted(entries):
+            if used + size <= self.size:
+                break
+            with self.lock(entry_key + ".lock", blocking=False) as acquired:
+                if acquired:
+                    shutil.rmtree(os.path.join(self.dirname, entry_key),
+                                  ignore_errors=True)
+                    used -= entry_size
+                    self.log("evict", entry_key, [])
+        return used + size <= self.size
+
+    def fetch(self, key, sources):
+        """return the cache entry for `key`, populating it if necessary.
+
+        The caller should hold a shared lock on :file:`<key>.lock`
+        while the entry is in use.
+
+        Arguments
+        ---------
+        key : string
+            Key of the entry, see :meth:`get_entry`.
+        sources : list
+            Files or directories to copy into the entry.
+
+        Returns
+        -------
+        dirname : string
+            Directory of the entry.
+        """
+        os.makedirs(self.dirname, exist_ok=True)
+        entry = os.path.join(self.dirname, key)
+        with self.lock(key + ".populate"):
+            if os.path.exists(os.path.join(entry, ".complete")):
+                # mark as recently used
+                os.utime(entry)
+                self.log("hit", key, sources)
+                return entry
+
+            # remove left-overs of a failed attempt
+            for tmpdir in glob.glob(entry + ".tmp*"):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+            size = 0
+            for source in sources:
+                if os.path.isdir(source):
+                    for root, dirs, files in os.walk(source):
+                        size += sum(os.path.getsize(os.path.join(root, x))
+                                    for x in files)
+                else:
+                    size += os.path.getsize(source)
+
+            with self.lock(".evict"):
+                fits = self.evict(size, key)
+                tmpdir = tempfile.mkdtemp(dir=self.dirname,
+                                          prefix=key + ".tmp")
+                with open(os.path.join(tmpdir, ".reserved"), "w") as outf:
+                    outf.write(str(size if fits else 0))
+
+            for source in sources:
+                dest = os.path.join(tmpdir, os.path.basename(source))
+                if not fits:
+                    os.symlink(source, dest)
+                elif os.path.isdir(source):
+                    shutil.copytree(source, dest)
+                else:
+                    shutil.copy2(source, dest)
+
+            with open(os.path.join(tmpdir, ".complete"), "w") as outf:
+                outf.write(str(size if fits else 0))
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmpdir, entry)
+            self.log("miss" if fits else "link", key, sources)
+        return entry
+
+
+def get_cache_dir(name=None):
+    """return directory for persistent caches.
+
+    The location can be set with the environment variable
+    ``CGAT_CACHE_DIR`` and defaults to :file:`cgat` within the user's
+    cache directory. The directory is created if it does not exist.
+
+    Arguments
+    ---------
+    name : string
+        If given, return a sub-directory of this name.
+
+    Returns
+    -------
+    dirname : string
+        Absolute path of cache directory.
+    """
+    dirname = os.environ.get("CGAT_CACHE_DIR", None)
+    if dirname is None:
+        dirname = os.path.join(
+            os.environ.get("XDG_CACHE_HOME",
+                           os.path.join(os.path.expanduser("~"), ".cache")),
+            "cgat")
+    if name is not None:
+        dirname = os.path.join(dirname, name)
+    os.makedirs(dirname, exist_ok=True)
+    return os.path.abspath(dirname)
+
+
+def prune_cache_files(filename, prefix):
+    """remove outdated versions of a cache file.
+
+    Cache files are named ``<prefix><signature>``, where the prefix
+    identifies the cached item and the signature its current state.
+    All files in the directory of `filename` that share the prefix are
+    removed, except `filename` itself and temporary files that are
+    still being written.
+
+    Arguments
+    ---------
+    filename : string
+        Current version of the cache file.
+    prefix : string
+        Prefix shared by all versions of the cache file.
+
+    Returns
+    -------
+    removed : list
+        Filenames that have been removed.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    basename = os.path.basename(filename)
+    removed = []
+    try:
+        candidates = os.listdir(dirname)
+    except OSError:
+        return removed
+
+    for fn in candidates:
+        if fn == basename or not fn.startswith(prefix) or \
+           fn.endswith(".tmp"):
+            continue
+        try:
+            os.unlink(os.path.join(dirname, fn))
+            removed.append(os.path.join(dirname, fn))
+        except OSError:
+            # removed by a concurrent process
+            pass
+    return removed
+
+
 def check_executables(filenames):
     """check for the presence/absence of executables"""
 
@@ -7,17 +7,30 @@ Reference
 """
 
 import types
+import bisect
+import copy
 import collections
+import hashlib
+import json
 import os
+import pickle
+import re
 import sys
 import configparser
 import getpass
 import logging
 import yaml
 
+# use the libyaml based loader if available
+try:
+    from yaml import CLoader as YAMLLoader
+except ImportError:
+    from yaml import Loader as YAMLLoader
+
 import CGATCore.Experiment as E
 import CGATCore.IOTools as IOTools
 from CGATCore.Pipeline.Utils import get_caller_locals, is_test
+from CGATCore.Pipeline.Files import get_cache_dir, prune_cache_files
 
 # sort out script paths
 
@@ -47,10 +60,52 @@ class TriggeredDefaultFactory:
         else:
             raise KeyError("missing parameter accessed")
 
+
+class ParameterDict(collections.defaultdict):
+    """a defaultdict that keeps track of changes.
+
+    The attribute `version` is incremented whenever the dictionary
+    is modified. It is used to decide when a :class:`ParameterIndex`
+    needs to be rebuilt.
+    """
+
+    def __init__(self, *args, **kwargs):
+        collections.defaultdict.__init__(self, *args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        collections.defaultdict.__setitem__(self, key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        collections.defaultdict.__delitem__(self, key)
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        collections.defaultdict.update(self, *args, **kwargs)
+        self.version += 1
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return collections.defaultdict.setdefault(self, key, default)
+
+    def pop(self, *args):
+        self.version += 1
+        return collections.defaultdict.pop(self, *args)
+
+    def popitem(self):
+        self.version += 1
+        return collections.defaultdict.popitem(self)
+
+    def clear(self):
+        collections.defaultdict.clear(self)
+        self.version += 1
+
+
 # Global variable for parameter interpolation in commands
 # This is a dictionary that can be switched between defaultdict
 # and normal dict behaviour.
-PARAMS = collections.defaultdict(TriggeredDefaultFactory())
+PARAMS = ParameterDict(TriggeredDefaultFactory())
 
 # patch - if --help or -h in command line arguments,
 # switch to a default dict to avoid missing paramater
@@ -58,6 +113,94 @@ PARAMS = collections.defaultdict(TriggeredDefaultFactory())
 if is_test() or "--help" in sys.argv or "-h" in sys.argv:
     TriggeredDefaultFactory.with_default = True
 
+
+class ParameterStack(collections.ChainMap):
+    """layered view of parameter dictionaries.
+
+    Lookups search the layers in order, for example kwargs before
+    the local variables of the caller before the global :data:`PARAMS`
+    dictionary. Writes and deletions only affect the first layer, so
+    that a view combining large dictionaries can be built without
+    copying them and without modifying them.
+
+    Unlike :class:`collections.ChainMap`, looking up a key does not
+    trigger the default factory of a layer such as :data:`PARAMS`.
+    Missing keys raise a KeyError, which permits the use of the view
+    for ``%``-interpolation of statements.
+    """
+
+    def __getitem__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key]
+        return self.__missing__(key)
+
+    def get(self, key, default=None):
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key]
+        return default
+
+
+class ParameterIndex(object):
+    """index of the parameter names in a dictionary.
+
+    The index permits finding all parameters starting with a prefix,
+    such as task specific parameters starting with an output filename,
+    with a binary search instead of a scan of all keys. Parameter
+    names containing the wildcard ``%`` are precompiled into regular
+    expressions.
+
+    Arguments
+    ---------
+    params : dict
+        Parameter dictionary to index.
+    """
+
+    def __init__(self, params):
+        self.version = getattr(params, "version", None)
+        keys = [x for x in list(params.keys()) if isinstance(x, str)]
+        self.keys = sorted(keys)
+        self.patterns = [(x, re.compile(re.sub("%", ".*", x)))
+                         for x in keys if "%" in x]
+
+    def startswith(self, prefix):
+        """return list of parameter names starting with `prefix`."""
+        result = []
+        idx = bisect.bisect_left(self.keys, prefix)
+        while idx < len(self.keys) and self.keys[idx].startswith(prefix):
+            result.append(self.keys[idx])
+            idx += 1
+        return result
+
+    def match(self, param):
+        """return the first wildcard parameter name matching `param`.
+
+        Returns None if there is no match.
+        """
+        for key, rx in self.patterns:
+            if rx.search(param):
+                return key
+        return None
+
+
+# index of the global parameter dictionary, see get_parameter_index
+PARAMETER_INDEX = None
+
+
+def get_parameter_index():
+    """return a :class:`ParameterIndex` of :data:`PARAMS`.
+
+    The index is built on first use and rebuilt whenever
+    :data:`PARAMS` has changed.
+    """
+    global PARAMETER_INDEX
+    index = PARAMETER_INDEX
+    if index is None or index.version != PARAMS.version:
+        index = PARAMETER_INDEX = ParameterIndex(PARAMS)
+    return index
+
+
 # A list of hard-coded parameters for the environment
 # These can be overwritten by command line options and
 # configuration files
@@ -69,14 +212,49 @@ HARDCODED_PARAMS = {
                              os.path.join("/tmp", getpass.getuser())),
     # directory used for temporary files shared across machines
     'shared_tmpdir': os.environ.get("SHARED_TMPDIR", os.path.abspath(os.getcwd())),
+    # list of directories for temporary local files to choose from.
+    # Each entry is a directory or a dictionary with the keys dir and
+    # weight. If not set, tmpdir is used. Cluster jobs choose
+    # between the directories on the execution host.
+    'tmpdirs': None,
+    # space that should remain free in each of tmpdirs
+    'tmpdirs_min_free': "1G",
+    # age in seconds after which temporary files left behind
+    # by other runs are removed
+    'tmpdir_max_age': 7 * 24 * 3600,
+    # interval in seconds at which running processes mark their
+    # temporary files as in use. Must be shorter than tmpdir_max_age.
+    'tmpdir_heartbeat': 600,
+    # directory on local scratch for cached reference files.
+    # Defaults to reference_cache within tmpdir.
+    'reference_cache_dir': None,
+    # maximum size of the reference cache
+    'reference_cache_size': "100G",
     # database backend
     'database': {'url': 'sqlite3:///./csvdb'},
+    # journal mode of sqlite databases. If unset, the journal mode
+    # stored in the database is kept. "wal" permits reading while data
+    # are being loaded, but requires all processes accessing the
+    # database to run on the same host, so it can not be used if
+    # databases on shared file systems are loaded from cluster jobs.
+    'database_journal_mode': None,
+    # synchronous setting of sqlite connections
+    'database_synchronous': 'normal',
+    # maximum number of bytes of an sqlite database to memory map
+    'database_mmap_size': 268435456,
+    # page cache of sqlite connections, negative numbers are in KiB
+    'database_cache_size': -65536,
+    # number of idle sqlite connections kept for reuse
+    'database_pool_size': 4,
     # cluster option
     'cluster': {
         # cluster queue to use
         'queue': 'main.q',
         # priority of jobs in cluster queue
         'priority': -10,
+        # range by which the priority of jobs off the critical
+        # path will be lowered
+        'priority_spread': 100,
         # number of jobs to submit to cluster queue
         'num_jobs': 100,
         # name of consumable resource to use for requesting memory
@@ -87,6 +265,11 @@ HARDCODED_PARAMS = {
         'options': "",
         # parallel environment to use for multi-threaded jobs
         'parallel_environment': 'smp',
+        # submit jobs ahead of their consumers and let the
+        # scheduler resolve dependencies between them. Only tasks
+        # marked with P.cluster_only are submitted before their
+        # inputs are complete. Not supported for SGE.
+        'dependencies': False,
     },
     # ruffus job limits for databases
     'jobs_limit_db': 10,
@@ -151,7 +334,7 @@ def config_to_dictionary(config):
     return p
 
 
-def input_validation(PARAMS, pipeline_script=""):
+def input_validation(PARAMS, pipeline_script="", threads=10, use_cache=True):
     '''Inspects the PARAMS dictionary looking for problematic input values.
 
     So far we just check that:
@@ -165,6 +348,20 @@ def input_validation(PARAMS, pipeline_script=""):
 
         * if the input is a file, check whether it exists and
           is readable
+
+    Files are checked in parallel, see :func:`check_readable_paths`.
+    All issues are reported in a single table.
+
+    Arguments
+    ---------
+    PARAMS : dict
+        Parameter dictionary to check.
+    pipeline_script : string
+        If given, check the dependencies of this pipeline script.
+    threads : int
+        Number of threads to use for checking files.
+    use_cache : bool
+        If True, cache results of file checks across runs.
     '''
 
     E.info('''input Validation starting''')
@@ -197,20 +394,22 @@ def input_validation(PARAMS, pipeline_script=""):
 
     E.info('''checking pipeline configuration''')
 
-    for key, value in sorted(PARAMS.iteritems()):
+    issues = []
+    paths = collections.defaultdict(list)
+    for key, value in sorted(PARAMS.items()):
 
         key = str(key)
         value = str(value)
 
         # check for missing values
         if value == "":
-            E.warn('\n"{}" is empty, is that expected?'.format(key))
+            issues.append((key, value, "empty"))
             num_missing += 1
 
         # check for a question mark in the dictironary (indicates
         # that there is a missing input parameter)
         if "?" in value:
-            E.warn('\n"{}" is not defined (?), is that expected?'.format(key))
+            issues.append((key, value, "not defined (?)"))
             num_questions += 1
 
         # validate input files listed in PARAMS
@@ -218,75 +417,124 @@ def input_validation(PARAMS, pipeline_script=""):
            or value.endswith(".gz") \
            or value.endswith(".gtf")) \
            and "," not in value:
+            paths[value].append(key)
 
-            if not os.access(value, os.R_OK):
-                E.warn('\n"{}": "{}" is not readable'.format(key, value))
+    readable = check_readable_paths(list(paths.keys()), threads=threads,
+                                    use_cache=use_cache)
+    for path, keys in paths.items():
+        if not readable[path]:
+            issues.extend([(key, path, "not readable") for key in keys])
+
+    E.info("checked {} parameters and {} distinct paths".format(
+        len(PARAMS), len(paths)))
+    if issues:
+        E.warn("configuration issues:\n{}".format(
+            "\n".join(["parameter\tvalue\tissue"] +
+                      ["\t".join(x) for x in sorted(issues)])))
 
     if num_missing or num_questions:
         raise ValueError("pipeline has configuration issues")
 
 
-def get_parameters(filenames=None,
-                   defaults=None,
-                   site_ini=True,
-                   user=True,
-                   only_import=None):
-    '''read one or more config files and build global PARAMS configuration
-    dictionary.
+def check_readable_paths(paths, threads=10, use_cache=True):
+    '''check in parallel whether paths are readable.
+
+    Results for readable files are cached across runs in the
+    directory returned by :func:`Files.get_cache_dir`. A cached result
+    is used if the modification and change times of the file have not
+    changed.
 
     Arguments
     ---------
-    filenames : list
-       List of filenames of the configuration files to read.
-    defaults : dict
-       Dictionary with default values. These will be overwrite
-       any hard-coded parameters, but will be overwritten by user
-       specified parameters in the configuration files.
-    user : bool
-       If set, configuration files will also be read from a
-       file called :file:`.daisy.yml` in the user`s
-       home directory.
-    only_import : bool
-       If set to a boolean, the parameter dictionary will be a
-       defaultcollection. This is useful for pipelines that are
-       imported (for example for documentation generation) but not
-       executed as there might not be an appropriate .ini file
-       available. If `only_import` is None, it will be set to the
-       default, which is to raise an exception unless the calling
-       script is imported or the option ``--is-test`` has been passed
-       at the command line.
+    paths : list
+        List of paths to check. Duplicates are checked only once.
+    threads : int
+        Number of threads to use.
+    use_cache : bool
+        If True, use and update the cache.
 
     Returns
     -------
-    params : dict
-       Global configuration dictionary.
+    readable : dict
+        Mapping of paths to True or False.
     '''
+    # imported here as multiprocessing is slow to import
+    from multiprocessing.pool import ThreadPool
 
-    if filenames is None:
-        filenames = ["benchmark.yml"]
+    cache = {}
+    cache_filename = None
+    if use_cache:
+        try:
+            cache_filename = os.path.join(get_cache_dir("validation"),
+                                          "readable.json")
+            with open(cache_filename) as inf:
+                cache = json.load(inf)
+        except (IOError, OSError, ValueError):
+            cache = {}
+
+    def _check(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path, False, None
+        # the change time catches changes of permissions
+        mtime = [st.st_mtime_ns, st.st_ctime_ns]
+        if cache.get(path, None) == mtime:
+            return path, True, mtime
+        return path, os.access(path, os.R_OK), mtime
+
+    paths = sorted(set(paths))
+    if not paths:
+        return {}
+
+    pool = ThreadPool(max(1, min(threads, len(paths))))
+    try:
+        results = pool.map(_check, paths)
+    finally:
+        pool.terminate()
+
+    readable = {}
+    for path, is_readable, mtime in results:
+        readable[path] = is_readable
+        if is_readable:
+            cache[path] = mtime
+        else:
+            cache.pop(path, None)
 
-    if isinstance(filenames, str):
-        filenames = [filenames]
+    if cache_filename is not None:
+        tmpfile = "{}.{}.tmp".format(cache_filename, os.getpid())
+        try:
+            with open(tmpfile, "w") as outf:
+                json.dump(cache, outf)
+            os.replace(tmpfile, cache_filename)
+        except (IOError, OSError):
+            pass
 
-    global PARAMS
-    old_id = id(PARAMS)
+    return readable
 
-    caller_locals = get_caller_locals()
 
-    # check if this is only for import
-    if only_import is None:
-        only_import = is_test() or "__name__" not in caller_locals or \
-                      caller_locals["__name__"] != "__main__"
+def get_config_filenames(filenames, site_ini=True, user=True):
+    """return list of configuration files to read.
 
-    # important: only update the PARAMS variable as
-    # it is referenced in other modules. Thus the type
-    # needs to be fixed at import. Raise error where this
-    # is not the case.
-    # Note: Parameter sharing in the Pipeline module needs
-    # to be reorganized.
-    if only_import:
-        # turn on default dictionary
-        TriggeredDefaultFactory.with_default = True
+    Site-wide and user configuration files are prepended to
+    `filenames` if they exist. The list passed in is not modified.
+
+    Arguments
+    ---------
+    filenames : list
+       List of filenames of the configuration files to read.
+    site_ini : bool
+       If set, include :file:`/etc/cgat/pipeline.ini`.
+    user : bool
+       If set, include :file:`.daisy.yml` in the user`s home directory.
+
+    Returns
+    -------
+    filenames : list
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    filenames = list(filenames)
 
     if site_ini:
         # read configuration from /etc/cgat/pipeline.ini
@@ -301,24 +549,119 @@ def get_parameters(filenames=None,
         if os.path.exists(fn):
             filenames.insert(0, fn)
 
-    filenames = [x.strip() for x in filenames]
+    return [x.strip() for x in filenames]
 
-    # update with hard-coded PARAMS
-    PARAMS.update(HARDCODED_PARAMS)
 
-    if defaults:
-        PARAMS.update(defaults)
+def get_config_cache_filename(filenames):
+    """return filename of the cached configuration for `filenames`.
 
-    # reset working directory. Set in PARAMS to prevent repeated calls to
-    # os.getcwd() failing if network is busy
-    PARAMS["workingdir"] = os.getcwd()
+    The filename consists of two parts. The first is derived from the
+    paths of the configuration files and is shared by all snapshots of
+    the same set of files. The second is derived from the
+    modification times and sizes of the configuration files and of
+    this module, so that any change to them results in a different
+    filename.
+
+    Returns
+    -------
+    filename : string
+        Filename of the cached configuration.
+    prefix : string
+        Prefix shared by all snapshots of `filenames`.
+    """
+    paths = [os.path.abspath(x) for x in filenames]
+    signature = []
+    for filename in paths + [__file__]:
+        try:
+            st = os.stat(filename)
+            signature.append((filename, st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append((filename, None, None))
+
+    prefix = hashlib.sha1(repr(paths).encode("utf-8")).hexdigest() + "-"
+    key = hashlib.sha1(repr(signature).encode("utf-8")).hexdigest()
+    return (os.path.join(get_cache_dir("config"), prefix + key + ".pickle"),
+            prefix)
+
+
+def read_config_files(filenames, use_cache=True):
+    """read configuration values from a list of files.
+
+    Files ending in ``.ini`` are read first, followed by the yaml
+    files in the order given. Later values overwrite earlier ones.
+    Files that do not exist are skipped.
+
+    Parsed configurations are cached as a binary snapshot in the
+    directory returned by :func:`Files.get_cache_dir`. The snapshot is
+    used as long as none of the files has changed. Only the latest
+    snapshot for a list of files is kept.
+
+    Arguments
+    ---------
+    filenames : list
+        List of configuration files.
+    use_cache : bool
+        If True, use and update the cache.
+
+    Returns
+    -------
+    params : dict
+    """
+    if not use_cache:
+        return parse_config_files(filenames)
+
+    try:
+        cache_filename, prefix = get_config_cache_filename(filenames)
+    except OSError:
+        # cache directory can not be created
+        return parse_config_files(filenames)
+
+    try:
+        with open(cache_filename, "rb") as inf:
+            params = pickle.load(inf)
+        for filename in filenames:
+            if not filename.endswith(".ini") and os.path.exists(filename):
+                get_logger().info("reading config from file {}".format(
+                    filename))
+        return params
+    except (IOError, EOFError, pickle.UnpicklingError):
+        pass
+
+    params = parse_config_files(filenames)
+
+    # write to a temporary file first so that concurrent
+    # readers never see a partial file
+    tmpfile = "{}.{}.tmp".format(cache_filename, os.getpid())
+    try:
+        with open(tmpfile, "wb") as outf:
+            pickle.dump(params, outf, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cache_filename)
+    except (IOError, pickle.PicklingError):
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+    else:
+        prune_cache_files(cache_filename, prefix)
+
+    return params
+
+
+def parse_config_files(filenames):
+    """parse configuration values from a list of files.
+
+    See :func:`read_config_files`.
+
+    Returns
+    -------
+    params : dict
+    """
+    params = {}
 
     # backwards compatibility - read ini files
     ini_filenames = [x for x in filenames if x.endswith(".ini")]
     yml_filenames = [x for x in filenames if not x.endswith(".ini")]
 
     if ini_filenames:
-        conf = configparser.SafeConfigParser()
+        conf = configparser.ConfigParser()
         try:
             conf.read(ini_filenames)
             p = config_to_dictionary(conf)
@@ -334,33 +677,151 @@ def get_parameters(filenames=None,
             config.read(ini_filenames)
             p = config_to_dictionary(config)
         if p:
-            PARAMS.update(p)
+            params.update(p)
+
+    for filename in yml_filenames:
+        if not os.path.exists(filename):
+            continue
+        get_logger().info("reading config from file {}".format(
+            filename))
+
+        with open(filename) as inf:
+            p = yaml.load(inf, Loader=YAMLLoader)
+            if p:
+                params.update(p)
+
+    return params
+
+
+def build_parameters(filenames,
+                     defaults=None,
+                     site_ini=True,
+                     user=True,
+                     workingdir=None,
+                     use_cache=True):
+    """build a parameter dictionary from configuration files.
+
+    Unlike :func:`get_parameters`, the global :data:`PARAMS`
+    dictionary is not modified.
+
+    Arguments
+    ---------
+    filenames : list
+       List of filenames of the configuration files to read.
+    defaults : dict
+       Dictionary with default values overwriting hard-coded parameters.
+    site_ini : bool
+       If set, read the site-wide configuration file.
+    user : bool
+       If set, read :file:`.daisy.yml` in the user`s home directory.
+    workingdir : string
+       Directory relative to which paths are expanded. Defaults to
+       the current working directory.
+    use_cache : bool
+       If True, use cached configurations, see :func:`read_config_files`.
 
-    if yml_filenames:
-        for filename in yml_filenames:
-            if not os.path.exists(filename):
-                continue
-            get_logger().info("reading config from file {}".format(
-                filename))
+    Returns
+    -------
+    params : dict
+    """
+    if workingdir is None:
+        workingdir = os.getcwd()
+    workingdir = os.path.abspath(workingdir)
 
-            with open(filename) as inf:
-                p = yaml.load(inf)
-                if p:
-                    PARAMS.update(p)
+    params = copy.deepcopy(HARDCODED_PARAMS)
+
+    if defaults:
+        params.update(defaults)
+
+    # reset working directory. Set in PARAMS to prevent repeated calls to
+    # os.getcwd() failing if network is busy
+    params["workingdir"] = workingdir
+
+    params.update(read_config_files(
+        get_config_filenames(filenames, site_ini=site_ini, user=user),
+        use_cache=use_cache))
 
     # interpolate some params with other parameters
     for param in INTERPOLATE_PARAMS:
         try:
-            PARAMS[param] = PARAMS[param] % PARAMS
+            params[param] = params[param] % params
         except TypeError as msg:
             raise TypeError('could not interpolate %s: %s' %
-                            (PARAMS[param], msg))
+                            (params[param], msg))
 
     # expand pathnames
-    for param, value in list(PARAMS.items()):
-        if param.endswith("dir"):
+    for param, value in list(params.items()):
+        if param.endswith("dir") and isinstance(value, str):
             if value.startswith("."):
-                PARAMS[param] = os.path.abspath(value)
+                params[param] = os.path.abspath(
+                    os.path.join(workingdir, value))
+
+    return params
+
+
+def get_parameters(filenames=None,
+                   defaults=None,
+                   site_ini=True,
+                   user=True,
+                   only_import=None):
+    '''read one or more config files and build global PARAMS configuration
+    dictionary.
+
+    Arguments
+    ---------
+    filenames : list
+       List of filenames of the configuration files to read.
+    defaults : dict
+       Dictionary with default values. These will be overwrite
+       any hard-coded parameters, but will be overwritten by user
+       specified parameters in the configuration files.
+    user : bool
+       If set, configuration files will also be read from a
+       file called :file:`.daisy.yml` in the user`s
+       home directory.
+    only_import : bool
+       If set to a boolean, the parameter dictionary will be a
+       defaultcollection. This is useful for pipelines that are
+       imported (for example for documentation generation) but not
+       executed as there might not be an appropriate .ini file
+       available. If `only_import` is None, it will be set to the
+       default, which is to raise an exception unless the calling
+       script is imported or the option ``--is-test`` has been passed
+       at the command line.
+
+    Returns
+    -------
+    params : dict
+       Global configuration dictionary.
+    '''
+
+    if filenames is None:
+        filenames = ["benchmark.yml"]
+
+    global PARAMS
+    old_id = id(PARAMS)
+
+    caller_locals = get_caller_locals()
+
+    # check if this is only for import
+    if only_import is None:
+        only_import = is_test() or "__name__" not in caller_locals or \
+                      caller_locals["__name__"] != "__main__"
+
+    # important: only update the PARAMS variable as
+    # it is referenced in other modules. Thus the type
+    # needs to be fixed at import. Raise error where this
+    # is not the case.
+    # Note: Parameter sharing in the Pipeline module needs
+    # to be reorganized.
+    if only_import:
+        # turn on default dictionary
+        TriggeredDefaultFactory.with_default = True
+
+    PARAMS.update(build_parameters(filenames,
+                                   defaults=defaults,
+                                   site_ini=site_ini,
+                                   user=user))
 
     # make sure that the dictionary reference has not changed
     assert id(PARAMS) == old_id
@@ -389,11 +850,9 @@ def match_parameter(param):
     if param in PARAMS:
         return param
 
-    for key in list(PARAMS.keys()):
-        if "%" in key:
-            rx = re.compile(re.sub("%", ".*", key))
-            if rx.search(param):
-                return key
+    key = get_parameter_index().match(param)
+    if key is not None:
+        return key
 
     raise KeyError("parameter '%s' can not be matched in dictionary" %
                    param)
@@ -426,29 +885,63 @@ def substitute_parameters(**kwargs):
 
     Returns
     -------
-    params : dict
-        Dictionary with parameter values.
+    params : ParameterStack
+        Mapping with parameter values. The global dictionary
+        and `kwargs` are not copied.
 
     '''
+    # note the order of layers to make sure that kwargs takes precedence
+    return stack_parameters(ParameterStack(kwargs, PARAMS))
+
+
+def _get_layers(mapping):
+    """return list of dictionaries making up `mapping`."""
+    if isinstance(mapping, collections.ChainMap):
+        layers = []
+        for m in mapping.maps:
+            layers.extend(_get_layers(m))
+        return layers
+    return [mapping]
+
+
+def stack_parameters(options):
+    '''add task specific parameters to a mapping of parameters.
 
-    # build parameter dictionary
-    # note the order of addition to make sure that kwargs takes precedence
-    local_params = dict(list(PARAMS.items()) + list(kwargs.items()))
+    See :func:`substitute_parameters`.
+
+    Arguments
+    ---------
+    options : dict
+        Mapping of parameter values.
+
+    Returns
+    -------
+    params : ParameterStack
+        Mapping with a layer of task specific values on top of
+        `options`. `options` is not modified.
+    '''
+    task_params = {}
+    local_params = ParameterStack(task_params, options)
 
     if "outfile" in local_params:
         # replace specific parameters with task (outfile) specific parameters
         outfile = local_params["outfile"]
-        keys = list(local_params.keys())
-        for k in keys:
-            if k.startswith(outfile):
-                p = k[len(outfile) + 1:]
-                if p not in local_params:
-                    # do not raise error, argument might be a prefix
-                    continue
-                get_logger.debug("substituting task specific parameter "
-                                 "for %s: %s = %s" %
-                                 (outfile, p, local_params[k]))
-                local_params[p] = local_params[k]
+        if isinstance(outfile, str):
+            for mapping in _get_layers(options):
+                if mapping is PARAMS:
+                    keys = get_parameter_index().startswith(outfile)
+                else:
+                    keys = [x for x in list(mapping.keys())
+                            if isinstance(x, str) and x.startswith(outfile)]
+                for k in keys:
+                    p = k[len(outfile) + 1:]
+                    if p not in local_params:
+                        # do not raise error, argument might be a prefix
+                        continue
+                    get_logger().debug("substituting task specific parameter "
+                                       "for %s: %s = %s" %
+                                       (outfile, p, local_params[k]))
+                    task_params[p] = local_params[k]
 
     return local_params
 
@@ -189,30 +189,124 @@ Reference
 ---------
 
 '''
+import importlib
 import os
 
-# import submodules into namespace
-from CGATCore.Pipeline.Control import *
-from CGATCore.Pipeline.Database import *
+# import lightweight submodules into namespace
 from CGATCore.Pipeline.Files import *
-from CGATCore.Pipeline.Cluster import *
-from CGATCore.Pipeline.Execution import *
 from CGATCore.Pipeline.Utils import *
 from CGATCore.Pipeline.Parameters import *
 
 
 # # import submodules
-from . import Execution as Execution
-from . import Control as Control
 from . import Files as Files
 from . import Parameters as Parameters
 
+# Submodules that depend on ruffus, gevent, drmaa or pandas are
+# imported on first access of one of their attributes so that
+# scripts that only need parameters or run a single job start
+# quickly. Later modules take precedence, as in a sequence of
+# ``from X import *`` statements. ``from CGATCore.Pipeline import *``
+# imports them to build ``__all__``.
+LAZY_MODULES = ("Control", "Database", "Cluster", "Execution")
+
+
+def get_public_names():
+    """return the names exported by ``from CGATCore.Pipeline import *``.
+
+    These are the public names of this package and of the
+    submodules in :data:`LAZY_MODULES`.
+    """
+    names = set(x for x in globals() if not x.startswith("_"))
+    names.update(LAZY_MODULES)
+    for module_name in LAZY_MODULES:
+        module = importlib.import_module("." + module_name, __name__)
+        names.update(getattr(
+            module, "__all__",
+            [x for x in vars(module) if not x.startswith("_")]))
+    return sorted(names)
+
+
+_LAZY_NAMES = None
+
+
+def get_lazy_names():
+    """return a mapping of public names to the submodule defining them.
+
+    The submodules in :data:`LAZY_MODULES` are parsed, not imported,
+    so that looking up an unknown name does not import them. Only
+    names bound at the top level of a module are found.
+    """
+    # imported here as ast is only needed on first attribute access
+    import ast
+
+    global _LAZY_NAMES
+    if _LAZY_NAMES is not None:
+        return _LAZY_NAMES
+
+    def _collect(statements):
+        for statement in statements:
+            if isinstance(statement, (ast.FunctionDef,
+                                      ast.AsyncFunctionDef,
+                                      ast.ClassDef)):
+                yield statement.name
+            elif isinstance(statement, (ast.Import, ast.ImportFrom)):
+                for alias in statement.names:
+                    yield (alias.asname or alias.name).split(".")[0]
+            elif isinstance(statement, (ast.Assign, ast.AnnAssign,
+                                        ast.AugAssign)):
+                targets = getattr(statement, "targets",
+                                  [getattr(statement, "target", None)])
+                for target in targets:
+                    for node in ast.walk(target):
+                        if isinstance(node, ast.Name):
+                            yield node.id
+            else:
+                # names bound within if, try and with blocks
+                for field in ("body", "orelse", "finalbody", "handlers"):
+                    yield from _collect(getattr(statement, field, []))
+
+    names = {}
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    for module_name in LAZY_MODULES:
+        with open(os.path.join(dirname, module_name + ".py")) as inf:
+            tree = ast.parse(inf.read())
+        for name in _collect(tree.body):
+            if not name.startswith("_"):
+                names[name] = module_name
+
+    _LAZY_NAMES = names
+    return names
+
+
+def __getattr__(name):
+    if name == "__all__":
+        value = get_public_names()
+        globals()[name] = value
+        return value
+
+    if name in LAZY_MODULES:
+        return importlib.import_module("." + name, __name__)
+
+    module_name = None
+    if not name.startswith("_"):
+        module_name = get_lazy_names().get(name, None)
+
+    if module_name is not None:
+        module = importlib.import_module("." + module_name, __name__)
+        if hasattr(module, name):
+            value = getattr(module, name)
+            globals()[name] = value
+            return value
+
+    raise AttributeError("module {} has no attribute {}".format(
+        __name__, name))
+
+
 # broadcast parameters, take from Parameters.py
 PARAMS = Parameters.PARAMS
 
 # # and drop PARAMS/CONFIG variables into the submodules
-Control.PARAMS = PARAMS
-Execution.PARAMS = PARAMS
 Files.PARAMS = PARAMS
 
 # set working directory at process launch to prevent repeated calls to
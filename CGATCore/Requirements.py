@@ -37,7 +37,6 @@ import os
 import sys
 import collections
 import yaml
-from distutils.version import LooseVersion
 import CGATCore.IOTools as IOTools
 import CGATCore.Experiment as E
 
@@ -210,6 +209,7 @@ def checkRequirementsFromBlock(requirements, counter=None, location=""):
                 continue
 
             # compare installed version with required version
+            from distutils.version import LooseVersion
             comp = LooseVersion(installed_version).__cmp__(required_version)
 
             ok = (required_op == "==" and comp == 0) or \
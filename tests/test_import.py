@@ -0,0 +1,80 @@
+"""Test cases for the lazy imports of pipeline scripts."""
+
+import os
+import subprocess
+import sys
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestLazyImport(unittest.TestCase):
+
+    # modules that are slow to import and should only be
+    # imported when used
+    lazy_modules = ("ruffus", "gevent", "sqlalchemy", "drmaa", "pandas",
+                    "paramiko", "distutils", "CGATCore.Pipeline.Control",
+                    "CGATCore.Pipeline.Execution")
+
+    def get_imported_modules(self, statement):
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(
+            [ROOT] + [x for x in [env.get("PYTHONPATH")] if x])
+        proc = subprocess.Popen(
+            [sys.executable, "-c",
+             "import sys; {}; print(' '.join(sys.modules))".format(
+                 statement)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0,
+                         msg="stderr = {}".format(stderr.decode("utf-8")))
+        return stdout.decode("utf-8").split()
+
+    def test_heavy_modules_are_not_imported(self):
+        modules = self.get_imported_modules("import CGATCore.Pipeline")
+        self.assertEqual(
+            [x for x in self.lazy_modules if x in modules], [])
+
+    def test_unknown_names_do_not_import_heavy_modules(self):
+        modules = self.get_imported_modules(
+            "import CGATCore.Pipeline as P; "
+            "assert not hasattr(P, 'no_such_function')")
+        self.assertEqual(
+            [x for x in self.lazy_modules if x in modules], [])
+
+    def test_lazy_names_import_their_module(self):
+        modules = self.get_imported_modules(
+            "import CGATCore.Pipeline as P; P.connect")
+        self.assertIn("CGATCore.Pipeline.Database", modules)
+        self.assertNotIn("CGATCore.Pipeline.Control", modules)
+
+
+class TestStarImport(unittest.TestCase):
+
+    def test_star_import_exports_lazy_names(self):
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(
+            [ROOT] + [x for x in [env.get("PYTHONPATH")] if x])
+        proc = subprocess.Popen(
+            [sys.executable, "-c",
+             "from CGATCore.Pipeline import *; "
+             "print(run.__module__, load.__module__, connect.__module__, "
+             "main.__module__, get_temp_file.__module__, PARAMS is not None)"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0,
+                         msg="stderr = {}".format(stderr.decode("utf-8")))
+        self.assertEqual(
+            stdout.decode("utf-8").split(),
+            ["CGATCore.Pipeline.Execution", "CGATCore.Pipeline.Database",
+             "CGATCore.Pipeline.Database", "CGATCore.Pipeline.Control",
+             "CGATCore.Pipeline.Files", "True"])
+
+
+if __name__ == "__main__":
+    unittest.main()
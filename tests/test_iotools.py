@@ -51,5 +51,35 @@ class TestIOToolsTouchFileCompressed(TestIOToolsTouchFile):
     basename = "test_iotools_touch_file.txt.gz"
 
 
+class TestIOToolsZapFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tempdir, "source.txt")
+        self.filename = os.path.join(self.tempdir, "linked.txt")
+        with open(self.source, "w") as outf:
+            outf.write("some data\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_zap_file_keeps_data_of_hardlinked_file(self):
+        os.link(self.source, self.filename)
+        original, linkdest = IOTools.zap_file(self.filename)
+        self.assertEqual(original.st_size, 10)
+        self.assertEqual(linkdest, None)
+        self.assertEqual(os.stat(self.filename).st_size, 0)
+        self.assertEqual(os.stat(self.filename).st_nlink, 1)
+        with open(self.source) as inf:
+            self.assertEqual(inf.read(), "some data\n")
+
+    def test_zap_file_breaks_symlink(self):
+        os.symlink(self.source, self.filename)
+        original, linkdest = IOTools.zap_file(self.filename)
+        self.assertEqual(linkdest, self.source)
+        self.assertFalse(os.path.islink(self.filename))
+        self.assertEqual(os.stat(self.source).st_size, 10)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,221 @@
+"""Test cases for the Pipeline.Cluster module."""
+
+import os
+import shutil
+import threading
+import tempfile
+import unittest
+import gevent.event
+import ruffus
+import CGATCore.Pipeline as P
+import CGATCore.Pipeline.Execution as Execution
+
+
+def setUpModule():
+    # keep caches written while loading parameters out of the
+    # user's cache directory
+    global OLD_CACHE_DIR
+    OLD_CACHE_DIR = os.environ.get("CGAT_CACHE_DIR", None)
+    os.environ["CGAT_CACHE_DIR"] = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(os.environ["CGAT_CACHE_DIR"])
+    if OLD_CACHE_DIR is None:
+        del os.environ["CGAT_CACHE_DIR"]
+    else:
+        os.environ["CGAT_CACHE_DIR"] = OLD_CACHE_DIR
+
+
+class JobTemplate(object):
+    pass
+
+
+class DummySession(object):
+    """stand-in for a drmaa session that only builds templates."""
+
+    def createJobTemplate(self):
+        return JobTemplate()
+
+
+class TestJobTemplate(unittest.TestCase):
+
+    cluster_options = {"queue": "all.q",
+                       "memory_resource": "h_vmem",
+                       "parallel_environment": "smp",
+                       "options": ""}
+
+    def build(self, queue_manager, **kwargs):
+        return P.setup_drmaa_job_template(
+            DummySession(),
+            queue_manager,
+            job_name="test",
+            job_memory="1G",
+            job_threads=1,
+            working_directory="/tmp",
+            **dict(self.cluster_options, **kwargs))
+
+    def test_sge_job_without_dependencies_is_not_held(self):
+        jt = self.build("sge")
+        self.assertNotIn("-hold_jid", jt.nativeSpecification)
+
+    def test_sge_job_dependencies_are_rejected(self):
+        # -hold_jid releases jobs even if their dependencies failed
+        self.assertRaises(ValueError, self.build, "sge",
+                          job_dependencies=["1", "2"])
+
+    def test_sge_jobs_are_not_submitted_ahead(self):
+        P.get_parameters()
+        saved_session = Execution.GLOBAL_SESSION
+        Execution.GLOBAL_SESSION = DummySession()
+        try:
+            executors = dict(
+                (queue_manager, Execution.GridExecutor(
+                    job_dependencies=True,
+                    cluster={"queue_manager": queue_manager}))
+                for queue_manager in ("sge", "slurm"))
+        finally:
+            Execution.GLOBAL_SESSION = saved_session
+        self.assertFalse(executors["sge"].submit_ahead)
+        self.assertTrue(executors["slurm"].submit_ahead)
+
+    def test_slurm_job_is_held_on_dependencies(self):
+        jt = self.build("slurm", job_dependencies=["1", "2"])
+        self.assertIn("--dependency=afterok:1:2", jt.nativeSpecification)
+
+
+class TestPendingJobs(unittest.TestCase):
+
+    def setUp(self):
+        for job_id in ("1", "2"):
+            Execution.PENDING_JOBS[job_id] = {
+                "outfiles": ["/data/sample1.bam"],
+                "dependencies": [],
+                "collector": None}
+        Execution.PENDING_OUTPUTS["/data/sample1.bam"] = ["1", "2"]
+
+    def tearDown(self):
+        Execution.PENDING_JOBS.clear()
+        Execution.PENDING_OUTPUTS.clear()
+
+    def test_pending_job_is_found_from_input_files(self):
+        self.assertEqual(
+            Execution.get_pending_job_ids([["/data/sample1.bam"]]),
+            ["1", "2"])
+
+    def test_pending_job_is_found_from_statement(self):
+        self.assertEqual(
+            Execution.get_pending_job_ids(
+                [], ["samtools index /data/sample1.bam"]),
+            ["1", "2"])
+
+    def test_unrelated_files_have_no_pending_jobs(self):
+        self.assertEqual(
+            Execution.get_pending_job_ids(["/data/sample2.bam"],
+                                          ["cat /data/sample2.bam"]),
+            [])
+        self.assertFalse(Execution.is_pending_output("/data/sample2.bam"))
+
+    def test_output_is_pending_until_all_jobs_are_collected(self):
+        Execution._remove_pending_job("2", success=True)
+        self.assertTrue(Execution.is_pending_output("/data/sample1.bam"))
+        Execution._remove_pending_job("1", success=True)
+        self.assertFalse(Execution.is_pending_output("/data/sample1.bam"))
+
+    def test_tasks_wait_for_pending_inputs(self):
+        # a failed job that is being collected elsewhere
+        collector = gevent.event.AsyncResult()
+        collector.set(False)
+        Execution.PENDING_JOBS["1"]["collector"] = collector
+
+        def run_job(func):
+            params = ["/data/sample1.bam", "/data/sample1.bam.bai"]
+            with P.allow_pending_inputs():
+                return ruffus.task.run_pooled_job_without_exceptions(
+                    (params, params, "task", 0, "job",
+                     ruffus.task.job_wrapper_io_files, func, None,
+                     threading.Event(), 0))
+
+        def index(infile, outfile):
+            pass
+
+        self.assertEqual(run_job(index).state, ruffus.task.JOB_ERROR)
+        self.assertEqual(run_job(P.cluster_only(index)).state,
+                         ruffus.task.JOB_COMPLETED)
+
+
+class TestRunJournal(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.journal = Execution.RunJournal(
+            os.path.join(self.work_dir, "journal.jsonl"))
+
+    def tearDown(self):
+        self.journal.close()
+        Execution.REATTACHED_JOBS.clear()
+        shutil.rmtree(self.work_dir)
+
+    def submit(self, job_id, statement, outfile=None, job_name=None):
+        self.journal.record_submission(
+            job_id, statement, ("job.sh", "job.stdout", "job.stderr"),
+            [outfile or "/data/{}.bam".format(job_id)],
+            job_name=job_name)
+
+    def test_collected_jobs_are_not_returned(self):
+        self.submit("1", "cat a")
+        self.submit("2", "cat b")
+        self.journal.record_collection("1", True)
+        self.assertEqual(list(self.journal.read().keys()), ["2"])
+
+    def test_partial_lines_are_ignored(self):
+        self.submit("1", "cat a")
+        self.journal.close()
+        with open(self.journal.filename, "a") as outf:
+            outf.write('{"event": "sub')
+        self.assertEqual(list(self.journal.read().keys()), ["1"])
+
+    def test_journal_without_open_jobs_is_removed(self):
+        self.submit("1", "cat a")
+        self.journal.record_collection("1", True)
+        self.journal.compact(self.journal.read())
+        self.assertFalse(os.path.exists(self.journal.filename))
+
+    def test_reattached_job_is_taken_once(self):
+        self.submit("1", "cat a")
+        Execution.REATTACHED_JOBS.update(self.journal.read())
+        self.assertEqual(
+            Execution.take_reattached_job("cat a")["job_id"], "1")
+        self.assertEqual(Execution.take_reattached_job("cat a"), None)
+        self.assertEqual(Execution.take_reattached_job("cat b"), None)
+
+    def test_reattached_job_is_matched_on_outfiles(self):
+        # statements differ in their temporary filenames
+        self.submit("1", "sort ctmpa > /data/1.bam", job_name="1.bam")
+        Execution.REATTACHED_JOBS.update(self.journal.read())
+        self.assertEqual(
+            Execution.take_reattached_job("sort ctmpb > /data/1.bam",
+                                          ["/data/2.bam"], "1.bam"), None)
+        self.assertEqual(
+            Execution.take_reattached_job("sort ctmpb > /data/1.bam",
+                                          ["/data/1.bam"], "other"), None)
+        self.assertEqual(
+            Execution.take_reattached_job("sort ctmpb > /data/1.bam",
+                                          ["/data/1.bam"],
+                                          "1.bam")["job_id"], "1")
+
+    def test_reattached_job_with_same_statement_is_preferred(self):
+        self.submit("1", "cat a", outfile="/data/a.bam")
+        self.submit("2", "cat b", outfile="/data/a.bam")
+        Execution.REATTACHED_JOBS.update(self.journal.read())
+        self.assertEqual(
+            Execution.take_reattached_job(
+                "cat b", ["/data/a.bam"])["job_id"], "2")
+        self.assertEqual(
+            Execution.take_reattached_job(
+                "cat c", ["/data/a.bam"])["job_id"], "1")
+
+
+if __name__ == "__main__":
+    unittest.main()
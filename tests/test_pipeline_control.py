@@ -3,8 +3,11 @@
 import unittest
 import os
 import shutil
+import sqlite3
 import subprocess
+import tempfile
 
+import ruffus
 import CGATCore
 import CGATCore.Experiment as E
 
@@ -15,6 +18,22 @@ import CGATCore.IOTools as IOTools
 ROOT = os.path.abspath(os.path.dirname(__file__))
 
 
+def setUpModule():
+    # keep caches written while loading parameters out of the
+    # user's cache directory
+    global OLD_CACHE_DIR
+    OLD_CACHE_DIR = os.environ.get("CGAT_CACHE_DIR", None)
+    os.environ["CGAT_CACHE_DIR"] = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(os.environ["CGAT_CACHE_DIR"])
+    if OLD_CACHE_DIR is None:
+        del os.environ["CGAT_CACHE_DIR"]
+    else:
+        os.environ["CGAT_CACHE_DIR"] = OLD_CACHE_DIR
+
+
 class BaseTest(unittest.TestCase):
 
     def setUp(self):
@@ -143,5 +162,331 @@ loggers:
         self.assertTrue("DEBUG" not in stdout)
 
 
+def start_task(outfile):
+    pass
+
+
+def long_task(infile, outfile):
+    pass
+
+
+def final_task(infile, outfile):
+    pass
+
+
+def short_task(infile, outfile):
+    pass
+
+
+class TestTaskCriticality(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pipeline = ruffus.Pipeline("test_criticality")
+        start = cls.pipeline.originate(start_task, ["a.start"])
+        longer = cls.pipeline.transform(long_task, start,
+                                        ruffus.suffix(".start"), ".long")
+        cls.pipeline.transform(final_task, longer,
+                               ruffus.suffix(".long"), ".final")
+        cls.pipeline.transform(short_task, start,
+                               ruffus.suffix(".start"), ".short")
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.history_file = os.path.join(self.work_dir, "history.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_tasks_on_critical_path_have_highest_criticality(self):
+        criticality = P.compute_task_criticality(
+            pipeline=self.pipeline,
+            history_file=self.history_file,
+            durations={"start_task": 1, "long_task": 10,
+                       "final_task": 10, "short_task": 1})
+        self.assertEqual(criticality["start_task"], 1.0)
+        self.assertAlmostEqual(criticality["long_task"], 20.0 / 21)
+        self.assertAlmostEqual(criticality["short_task"], 1.0 / 21)
+
+    def test_tasks_without_durations_use_path_depth(self):
+        criticality = P.compute_task_criticality(
+            pipeline=self.pipeline, history_file=self.history_file)
+        self.assertEqual(criticality["start_task"], 1.0)
+        self.assertGreater(criticality["long_task"],
+                           criticality["short_task"])
+
+
+def create_file(outfile):
+    with open(outfile, "w") as outf:
+        outf.write("data")
+
+
+def copy_file(infile, outfile):
+    shutil.copyfile(infile, outfile)
+
+
+class TestCacheOSFunctions(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.outfile = os.path.join(self.work_dir, "0.start")
+        self.pipeline = ruffus.Pipeline("test_cache_{}".format(
+            os.path.basename(self.work_dir)))
+        self.pipeline.originate(create_file, [self.outfile])
+        self.history_file = os.path.join(self.work_dir, "history.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_outputs_of_task_functions_are_invalidated(self):
+        with open(self.outfile, "w") as outf:
+            outf.write("x")
+        with P.cache_os_functions():
+            self.assertEqual(os.stat(self.outfile).st_size, 1)
+            self.pipeline.run(forcedtorun_tasks=[create_file],
+                              verbose=0, multiprocess=1,
+                              history_file=self.history_file)
+            self.assertEqual(os.stat(self.outfile).st_size, 4)
+
+    def test_relative_paths_follow_working_directory(self):
+        cwd = os.getcwd()
+        with P.cache_os_functions():
+            try:
+                before = os.path.abspath("0.start")
+                os.chdir(self.work_dir)
+                after = os.path.abspath("0.start")
+                relative = os.path.relpath(self.outfile)
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(before, os.path.join(cwd, "0.start"))
+        self.assertEqual(after, self.outfile)
+        self.assertEqual(relative, "0.start")
+
+
+class TestProgressTracker(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.pipeline = ruffus.Pipeline("test_progress_{}".format(
+            os.path.basename(self.work_dir)))
+        start = self.pipeline.originate(
+            create_file,
+            [os.path.join(self.work_dir, "{}.start".format(x))
+             for x in range(3)])
+        self.pipeline.transform(copy_file, start,
+                                ruffus.suffix(".start"), ".copy")
+        self.history_file = os.path.join(self.work_dir, "history.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def run_pipeline(self):
+        tracker = P.ProgressTracker()
+        with tracker.track():
+            self.pipeline.run(verbose=0, multiprocess=1,
+                              history_file=self.history_file)
+        return dict((x.name.split(".")[-1], x) for x in tracker.tasks.values())
+
+    def test_progress_counts_jobs(self):
+        tasks = self.run_pipeline()
+        self.assertEqual(tasks["create_file"].total, 3)
+        self.assertEqual(tasks["create_file"].completed, 3)
+        self.assertEqual(tasks["copy_file"].status, "completed")
+        self.assertEqual(tasks["copy_file"].running, 0)
+
+    def test_progress_counts_uptodate_jobs(self):
+        self.run_pipeline()
+        os.unlink(os.path.join(self.work_dir, "0.copy"))
+        tasks = self.run_pipeline()
+        self.assertEqual(tasks["create_file"].status, "uptodate")
+        self.assertEqual(tasks["create_file"].total, 0)
+        self.assertEqual(tasks["copy_file"].status, "completed")
+        self.assertEqual(tasks["copy_file"].total, 3)
+        self.assertEqual(tasks["copy_file"].uptodate, 2)
+        self.assertEqual(tasks["copy_file"].completed, 1)
+
+    def test_uptodate_tasks_are_reported(self):
+        self.run_pipeline()
+        tasks = self.run_pipeline()
+        self.assertEqual(
+            dict((x, y.status) for x, y in tasks.items()),
+            {"create_file": "uptodate", "copy_file": "uptodate"})
+
+    def test_metrics_are_exported_in_text_format(self):
+        filename = os.path.join(self.work_dir, "metrics.prom")
+        tracker = P.ProgressTracker()
+        with tracker.track(), P.MetricsExporter(tracker,
+                                                filename=filename,
+                                                interval=0.1):
+            self.pipeline.run(verbose=0, multiprocess=1,
+                              history_file=self.history_file)
+
+        with open(filename) as inf:
+            metrics = dict(x.rsplit(" ", 1) for x in inf
+                           if not x.startswith("#"))
+
+        self.assertEqual(float(metrics["cgat_pipeline_jobs_finished_total"]), 6)
+        self.assertGreater(
+            float(metrics["cgat_pipeline_controller_rss_bytes"]), 0)
+        completed = [float(v) for k, v in metrics.items()
+                     if "create_file" in k and 'state="completed"' in k]
+        self.assertEqual(completed, [3])
+
+
+class TestPeekParameters(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.old_cache_dir = os.environ.get("CGAT_CACHE_DIR", None)
+        os.environ["CGAT_CACHE_DIR"] = os.path.join(self.work_dir, "cache")
+        self.pipeline = os.path.join(self.work_dir, "pipeline_peek.py")
+        self.counter = os.path.join(self.work_dir, "counter")
+        with open(self.pipeline, "w") as outf:
+            outf.write("open('{}', 'a').write('x')\n"
+                       "print('{{\"value\": 1}}')\n".format(self.counter))
+        self.config = os.path.join(self.work_dir, "pipeline.yml")
+        with open(self.config, "w") as outf:
+            outf.write("value: 2\nresultsdir: ./results\n")
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ["CGAT_CACHE_DIR"]
+        else:
+            os.environ["CGAT_CACHE_DIR"] = self.old_cache_dir
+        shutil.rmtree(self.work_dir)
+
+    def count_runs(self):
+        with open(self.counter) as inf:
+            return len(inf.read())
+
+    def test_pipeline_is_executed_only_once(self):
+        for x in range(3):
+            params = P.peek_parameters(self.work_dir, self.pipeline)
+        self.assertEqual(params, {"value": 1})
+        self.assertEqual(self.count_runs(), 1)
+
+    def test_pipeline_is_executed_after_config_changes(self):
+        P.peek_parameters(self.work_dir, self.pipeline)
+        with open(self.config, "a") as outf:
+            outf.write("other: 3\n")
+        P.peek_parameters(self.work_dir, self.pipeline)
+        self.assertEqual(self.count_runs(), 2)
+
+    def test_outdated_results_are_removed(self):
+        for x in range(3):
+            with open(self.config, "a") as outf:
+                outf.write("other{}: 3\n".format(x))
+            P.peek_parameters(self.work_dir, self.pipeline)
+        self.assertEqual(self.count_runs(), 3)
+
+        key, prefix = P.get_peek_parameters_key(self.work_dir, self.pipeline)
+        self.assertEqual(
+            os.listdir(os.path.join(os.environ["CGAT_CACHE_DIR"],
+                                    "peek_parameters")),
+            [key + ".json"])
+
+    def test_parameters_can_be_loaded_in_process(self):
+        params = P.peek_parameters(self.work_dir, self.pipeline,
+                                   in_process=True)
+        self.assertFalse(os.path.exists(self.counter))
+        self.assertEqual(params["value"], 2)
+        self.assertEqual(params["resultsdir"],
+                         os.path.join(self.work_dir, "results"))
+
+
+class TestClean(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.files = [os.path.join(self.work_dir, "file{}.txt".format(x))
+                      for x in range(20)]
+        for fn in self.files:
+            with open(fn, "w") as outf:
+                outf.write("data")
+        self.logfile = os.path.join(self.work_dir, "clean.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_files_are_zapped_and_logged(self):
+        c = P.clean(self.files, self.logfile, threads=4, batch_size=3,
+                    dry_run=False)
+        self.assertEqual(c.zapped, 20)
+        self.assertEqual(c.bytes, 80)
+        self.assertTrue(all(os.path.getsize(x) == 0 for x in self.files))
+        with open(self.logfile) as inf:
+            self.assertEqual(len(inf.readlines()), 21)
+
+    def test_dry_run_reports_bytes_and_keeps_files(self):
+        c = P.clean(self.files, self.logfile, dry_run=True)
+        self.assertEqual(c.bytes, 80)
+        self.assertTrue(all(os.path.getsize(x) == 4 for x in self.files))
+        self.assertFalse(os.path.exists(self.logfile))
+
+    def test_links_do_not_count_towards_bytes(self):
+        os.symlink(self.files[0], self.files[0] + ".link")
+        os.link(self.files[1], self.files[1] + ".link")
+        files = [self.files[0] + ".link", self.files[1] + ".link"]
+        c = P.clean(files, self.logfile, dry_run=True)
+        self.assertEqual((c.zapped, c.bytes), (2, 0))
+        c = P.clean(files, self.logfile, dry_run=False)
+        self.assertEqual((c.zapped, c.links, c.bytes), (2, 1, 0))
+        self.assertEqual(os.path.getsize(self.files[0]), 4)
+        self.assertEqual(os.path.getsize(self.files[1]), 4)
+
+    def test_dry_run_skips_broken_links(self):
+        broken = os.path.join(self.work_dir, "broken.link")
+        os.symlink(os.path.join(self.work_dir, "missing"), broken)
+        c = P.clean(self.files + [broken], self.logfile, dry_run=True)
+        self.assertEqual((c.files, c.zapped, c.bytes), (21, 20, 80))
+
+
+class TestClonePipeline(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.src_dir = os.path.join(self.work_dir, "src")
+        self.dest_dir = os.path.join(self.work_dir, "dest")
+        for dirname in ("sample1.dir/sub", "tmp"):
+            os.makedirs(os.path.join(self.src_dir, dirname))
+        os.makedirs(self.dest_dir)
+        for fn in ("pipeline.ini", "sample1.dir/sub/a.txt", "tmp/b.txt"):
+            with open(os.path.join(self.src_dir, fn), "w") as outf:
+                outf.write("data")
+        dbh = sqlite3.connect(os.path.join(self.src_dir, "csvdb"))
+        dbh.execute("CREATE TABLE test (x INT)")
+        dbh.execute("INSERT INTO test VALUES (1)")
+        dbh.commit()
+        dbh.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_pipeline_is_cloned(self):
+        P.clone_pipeline(self.src_dir, self.dest_dir, link_mode="hardlink")
+        src = os.path.join(self.src_dir, "sample1.dir", "sub", "a.txt")
+        dest = os.path.join(self.dest_dir, "sample1.dir", "sub", "a.txt")
+        self.assertTrue(os.path.samefile(src, dest))
+        self.assertFalse(os.path.islink(dest))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.dest_dir, "tmp")))
+        self.assertFalse(
+            os.path.islink(os.path.join(self.dest_dir, "pipeline.ini")))
+        self.assertEqual(
+            os.stat(os.path.join(self.src_dir, "sample1.dir")).st_mtime,
+            os.stat(os.path.join(self.dest_dir, "sample1.dir")).st_mtime)
+
+        dbh = sqlite3.connect(os.path.join(self.dest_dir, "csvdb"))
+        self.assertEqual(dbh.execute("SELECT x FROM test").fetchall(),
+                         [(1,)])
+        dbh.close()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,513 @@
+"""Test cases for the Pipeline.Database module."""
+
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import tempfile
+import unittest
+import gevent
+import CGATCore.IOTools as IOTools
+import CGATCore.Pipeline as P
+import CGATCore.Pipeline.Database as Database
+
+
+def setUpModule():
+    # keep caches written while loading parameters out of the
+    # user's cache directory
+    global OLD_CACHE_DIR
+    OLD_CACHE_DIR = os.environ.get("CGAT_CACHE_DIR", None)
+    os.environ["CGAT_CACHE_DIR"] = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(os.environ["CGAT_CACHE_DIR"])
+    if OLD_CACHE_DIR is None:
+        del os.environ["CGAT_CACHE_DIR"]
+    else:
+        os.environ["CGAT_CACHE_DIR"] = OLD_CACHE_DIR
+
+
+class BaseTest(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.database = os.path.join(self.work_dir, "csvdb")
+        self.saved_database = P.PARAMS["database"]
+        P.PARAMS["database"] = {"url": "sqlite:///" + self.database}
+
+    def tearDown(self):
+        Database.stop_load_coordinators()
+        P.PARAMS["database"] = self.saved_database
+        shutil.rmtree(self.work_dir)
+
+    def write_table(self, filename, lines):
+        filename = os.path.join(self.work_dir, filename)
+        with IOTools.open_file(filename, "w") as outf:
+            outf.write("".join("\t".join(map(str, x)) + "\n" for x in lines))
+        return filename
+
+    def fetch(self, statement):
+        dbh = sqlite3.connect(self.database)
+        try:
+            return dbh.execute(statement).fetchall()
+        finally:
+            dbh.close()
+
+
+class TestLoad(BaseTest):
+
+    def test_compressed_file_is_loaded_in_process(self):
+        infile = self.write_table(
+            "data.tsv.gz",
+            [("track", "value")] + [("t%i" % x, x) for x in range(10)])
+        outfile = os.path.join(self.work_dir, "data.load")
+        P.load(infile, outfile, options="--add-index=track")
+        self.assertTrue(os.path.exists(outfile))
+        self.assertEqual(self.fetch("SELECT COUNT(*), SUM(value) FROM data"),
+                         [(10, 45)])
+
+    def test_limit_keeps_header(self):
+        infile = self.write_table(
+            "data.tsv",
+            [("track", "value")] + [("t%i" % x, x) for x in range(10)])
+        P.load(infile, os.path.join(self.work_dir, "data.load"),
+               limit=3, shuffle=True)
+        self.assertEqual(self.fetch("SELECT COUNT(*) FROM data"), [(3, )])
+
+    def test_transposed_table_is_loaded(self):
+        infile = self.write_table(
+            "data.tsv", [("bin", "a", "b"), ("length", 1, 2),
+                         ("width", 3, 4)])
+        P.load(infile, os.path.join(self.work_dir, "data.load"),
+               transpose="track")
+        self.assertEqual(
+            self.fetch("SELECT track, length, width FROM data"),
+            [("a", 1, 3), ("b", 2, 4)])
+
+    def test_collapse(self):
+        lines = ["row\tvalue\n", "a\t1\n", "b\t2\n", "a\t3\n"]
+        self.assertEqual(Database.collapse_table(lines, "na"),
+                         ["row\tcolumn_0\tcolumn_1\n",
+                          "a\t1\t3\n",
+                          "b\t2\tna\n"])
+
+    def test_unknown_options_are_rejected(self):
+        self.assertRaises(ValueError, Database.build_load_options,
+                          "data", options="--no-such-option")
+
+
+class TestConcatenateAndLoad(BaseTest):
+
+    def test_tables_are_concatenated_in_process(self):
+        infiles = [
+            self.write_table("sample%i.tsv.gz" % x,
+                             [("gene", "count") + (("length", ) if x else ())] +
+                             [("g%i" % y, y * x) + ((y, ) if x else ())
+                              for y in range(5)])
+            for x in range(3)]
+        P.concatenateAndLoad(infiles,
+                             os.path.join(self.work_dir, "counts.load"),
+                             regex_filename=r"([^/]*)\.tsv\.gz")
+        self.assertEqual(
+            self.fetch("SELECT track, COUNT(*), SUM(count) FROM counts "
+                       "GROUP BY track ORDER BY track"),
+            [("sample0", 5, 0), ("sample1", 5, 10), ("sample2", 5, 20)])
+        self.assertEqual(
+            self.fetch("SELECT DISTINCT length FROM counts "
+                       "WHERE track = 'sample0'"), [(None, )])
+        self.assertEqual(
+            self.fetch("SELECT COUNT(*) FROM sqlite_master "
+                       "WHERE type = 'index' AND tbl_name = 'counts'"),
+            [(1, )])
+
+
+class TestMergeAndLoad(BaseTest):
+
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.infiles = [
+            self.write_table("file1.tsv.gz", [("category", "result"),
+                                              ("length", 12),
+                                              ("width", 100)]),
+            self.write_table("file2.tsv.gz", [("category", "result"),
+                                              ("length", 20),
+                                              ("height", 50)])]
+
+    def test_tables_are_merged_row_wise(self):
+        lines = list(Database.iterate_merged_tables(
+            self.infiles, ["file1", "file2"], max_cells=3))
+        self.assertEqual(lines, ["track\tlength\twidth\theight\n",
+                                 "file1\t12\t100\t0\n",
+                                 "file2\t20\t0\t50\n"])
+
+    def test_tables_fitting_into_memory_are_merged_row_wise(self):
+        lines = list(Database.iterate_merged_tables(
+            self.infiles, ["file1", "file2"]))
+        self.assertEqual(lines, ["track\tlength\twidth\theight\n",
+                                 "file1\t12\t100\t0\n",
+                                 "file2\t20\t0\t50\n"])
+
+    def test_short_lines_are_filled_with_missing_value(self):
+        infile = self.write_table("short.tsv", [("category", "result"),
+                                                ("length", 12),
+                                                ("width", )])
+        lines = list(Database.iterate_merged_tables(
+            [infile], ["short"], row_wise=False, missing_value="na"))
+        self.assertEqual(lines, ["bin\tshort\n",
+                                 "length\t12\n",
+                                 "width\tna\n"])
+
+    def test_lines_without_key_raise_error(self):
+        infile = self.write_table("short.tsv", [("result", "category"),
+                                                (12, "length"),
+                                                (100, )])
+        with self.assertRaisesRegex(ValueError, r"short.tsv:3:"):
+            Database.read_merge_table(infile, columns=(1, 0))
+
+    def test_merged_table_is_loaded(self):
+        P.mergeAndLoad(self.infiles,
+                       os.path.join(self.work_dir, "merged.load"),
+                       suffix=".tsv.gz",
+                       row_wise=False)
+        self.assertEqual(
+            self.fetch("SELECT bin, file1, file2 FROM merged"),
+            [("length", 12, 20), ("width", 100, 0), ("height", 0, 50)])
+
+
+class TestConnect(BaseTest):
+
+    def tearDown(self):
+        Database.close_connection_pools()
+        P.PARAMS.pop("annotations_database", None)
+        BaseTest.tearDown(self)
+
+    def test_connections_are_reused(self):
+        dbh = P.connect()
+        self.assertIsInstance(dbh, sqlite3.Connection)
+        dbh.execute("CREATE TABLE data (x INT)")
+        dbh.commit()
+        dbh.close()
+        dbh = P.connect()
+        pool = list(Database.CONNECTION_POOLS.values())[0]
+        self.assertEqual(pool.counts, {"opened": 1, "reused": 1})
+        self.assertEqual(dbh.execute("SELECT COUNT(*) FROM data").fetchall(),
+                         [(0, )])
+        self.assertEqual(dbh.execute("PRAGMA journal_mode").fetchall(),
+                         [("delete", )])
+
+    def test_journal_mode_can_be_configured(self):
+        saved_journal_mode = P.PARAMS.get("database_journal_mode")
+        P.PARAMS["database_journal_mode"] = "wal"
+        try:
+            dbh = P.connect()
+        finally:
+            P.PARAMS["database_journal_mode"] = saved_journal_mode
+        self.assertEqual(dbh.execute("PRAGMA journal_mode").fetchall(),
+                         [("wal", )])
+        dbh.close()
+
+    def test_closed_connections_can_not_be_used(self):
+        dbh = P.connect()
+        dbh.close()
+        self.assertRaises(sqlite3.ProgrammingError, dbh.execute, "SELECT 1")
+        self.assertRaises(sqlite3.ProgrammingError, dbh.cursor)
+        dbh.close()
+        other = P.connect()
+        self.assertIs(other, dbh)
+        self.assertEqual(other.execute("SELECT 1").fetchall(), [(1, )])
+        pool = list(Database.CONNECTION_POOLS.values())[0]
+        self.assertEqual(pool.counts, {"opened": 1, "reused": 1})
+
+    def test_connection_state_is_reset(self):
+        dbh = P.connect()
+        dbh.row_factory = sqlite3.Row
+        dbh.text_factory = bytes
+        dbh.isolation_level = None
+        dbh.create_function("double", 1, lambda x: 2 * x)
+        dbh.execute("CREATE TEMP TABLE scratch (x INT)")
+        dbh.execute("PRAGMA foreign_keys = ON")
+        dbh.execute("PRAGMA cache_size = 10")
+        dbh.execute("ATTACH DATABASE ':memory:' AS other")
+        dbh.close()
+
+        dbh = P.connect()
+        self.assertEqual(dbh.row_factory, None)
+        self.assertEqual(dbh.text_factory, str)
+        self.assertEqual(dbh.isolation_level, "")
+        self.assertRaises(sqlite3.OperationalError,
+                          dbh.execute, "SELECT double(1)")
+        self.assertEqual(
+            dbh.execute("SELECT COUNT(*) FROM temp.sqlite_master").fetchall(),
+            [(0, )])
+        self.assertEqual(dbh.execute("PRAGMA foreign_keys").fetchall(),
+                         [(0, )])
+        self.assertNotEqual(dbh.execute("PRAGMA cache_size").fetchall(),
+                            [(10, )])
+        self.assertNotIn(
+            "other", [x[1] for x in dbh.execute("PRAGMA database_list")])
+
+    def test_handles_work_with_pandas(self):
+        import pandas
+        dbh = P.connect()
+        pandas.DataFrame({"x": [1, 2]}).to_sql("frame", dbh, index=False)
+        self.assertEqual(
+            pandas.read_sql("SELECT SUM(x) AS x FROM frame", dbh)["x"][0], 3)
+        dbh.close()
+
+    def test_attachments_are_cached(self):
+        annotations = os.path.join(self.work_dir, "annotations")
+        dbh = sqlite3.connect(annotations)
+        dbh.execute("CREATE TABLE genes (gene_id TEXT)")
+        dbh.close()
+        P.PARAMS["annotations_database"] = annotations
+
+        dbh = P.connect()
+        dbh.close()
+        dbh = P.connect()
+        self.assertEqual(dbh.attached, {"annotations": annotations})
+        self.assertEqual(
+            dbh.execute("SELECT COUNT(*) FROM annotations.genes").fetchall(),
+            [(0, )])
+
+
+class TestCreateView(BaseTest):
+
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.load("reads", [("track", "reads")] +
+                  [("t%i" % x, x) for x in range(5)])
+        self.load("stats", [("track", "length")] +
+                  [("t%i" % x, x * 10) for x in range(5)])
+        self.outfile = os.path.join(self.work_dir, "view.load")
+
+    def tearDown(self):
+        Database.close_connection_pools()
+        BaseTest.tearDown(self)
+
+    def load(self, tablename, lines, options=""):
+        infile = self.write_table(tablename + ".tsv", lines)
+        P.load(infile, os.path.join(self.work_dir, tablename + ".load"),
+               options=options)
+
+    def create_view(self):
+        dbh = P.connect()
+        Database.createView(dbh, (("reads", "track"), ("stats", "track")),
+                            "view", self.outfile)
+        dbh.close()
+
+    def delete_from_view(self, track):
+        # rows deleted from the view are only restored by a full rebuild
+        dbh = P.connect()
+        dbh.execute("DELETE FROM view WHERE track = ?", (track, ))
+        dbh.commit()
+        dbh.close()
+
+    def test_unchanged_view_is_skipped(self):
+        self.create_view()
+        self.assertEqual(self.fetch("SELECT COUNT(*) FROM view"), [(5, )])
+        self.delete_from_view("t0")
+        self.create_view()
+        self.assertEqual(self.fetch("SELECT COUNT(*) FROM view"), [(4, )])
+
+    def test_appended_rows_are_added(self):
+        self.create_view()
+        self.delete_from_view("t0")
+        self.load("reads", [("track", "reads"), ("t5", 5)],
+                  options="--append")
+        self.load("stats", [("track", "length"), ("t5", 50)],
+                  options="--append")
+        self.create_view()
+        self.assertEqual(
+            self.fetch("SELECT track, reads, length FROM view "
+                       "WHERE track = 't5'"), [("t5", 5, 50)])
+        self.assertEqual(self.fetch("SELECT COUNT(*) FROM view"), [(5, )])
+
+    def test_updated_rows_recreate_view(self):
+        self.create_view()
+        self.delete_from_view("t0")
+        dbh = P.connect()
+        dbh.execute("UPDATE stats SET length = 1 WHERE track = 't1'")
+        dbh.commit()
+        dbh.close()
+        self.create_view()
+        self.assertEqual(self.fetch("SELECT COUNT(*) FROM view"), [(5, )])
+        self.assertEqual(
+            self.fetch("SELECT length FROM view WHERE track = 't1'"), [(1, )])
+
+    def test_loads_are_recorded(self):
+        self.load("reads", [("track", "reads"), ("t5", 5)],
+                  options="--append")
+        self.assertEqual(
+            self.fetch("SELECT nrows, max_rowid, version, created, changed "
+                       "FROM table_status WHERE tablename = 'reads'"),
+            [(6, 6, 2, 1, 0)])
+        self.assertEqual(
+            self.fetch("SELECT loaded IS NOT NULL FROM table_status"),
+            [(1, ), (1, )])
+
+    def test_deleted_rows_recreate_view(self):
+        self.create_view()
+        dbh = P.connect()
+        dbh.execute("DELETE FROM reads WHERE track = 't0'")
+        dbh.execute("DELETE FROM stats WHERE track = 't0'")
+        dbh.commit()
+        dbh.close()
+        self.create_view()
+        self.assertEqual(self.fetch("SELECT COUNT(*) FROM view"), [(4, )])
+
+    def test_table_replaced_outside_loads_recreates_view(self):
+        self.create_view()
+        dbh = P.connect()
+        dbh.execute("DROP TABLE stats")
+        dbh.execute("CREATE TABLE stats (track TEXT, length INT)")
+        dbh.executemany("INSERT INTO stats VALUES (?, ?)",
+                        [("t%i" % x, x) for x in range(5)])
+        dbh.commit()
+        dbh.close()
+        self.create_view()
+        self.assertEqual(self.fetch("SELECT SUM(length) FROM view"), [(10, )])
+
+    def test_appended_rows_are_validated(self):
+        self.create_view()
+        self.load("reads", [("track", "reads"), ("t5", 5)],
+                  options="--append")
+        self.assertRaises(ValueError, self.create_view)
+
+    def test_reloaded_table_recreates_view(self):
+        self.create_view()
+        self.load("stats", [("track", "width")] +
+                  [("t%i" % x, x) for x in range(5)])
+        self.create_view()
+        self.assertEqual(self.fetch("SELECT SUM(width) FROM view"), [(10, )])
+
+
+class TestLoadCoordinator(BaseTest):
+
+    def test_queued_uploads_are_batched(self):
+        coordinator = Database.LoadCoordinator(self.database)
+        started, release = threading.Event(), threading.Event()
+
+        def block(dbhandle):
+            started.set()
+            release.wait()
+
+        def create(name):
+            def _create(dbhandle):
+                dbhandle.execute("CREATE TABLE %s (x INT)" % name)
+                dbhandle.execute("INSERT INTO %s VALUES (1)" % name)
+                if name == "fails":
+                    raise ValueError("upload failed")
+            return _create
+
+        errors = []
+
+        def submit(func):
+            try:
+                coordinator.submit(func)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=submit, args=(block,))]
+        threads[0].start()
+        started.wait()
+        for name in ("t1", "fails", "t2"):
+            threads.append(threading.Thread(target=submit,
+                                            args=(create(name),)))
+            threads[-1].start()
+        while coordinator.queue.qsize() < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        coordinator.stop()
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(coordinator.counts["uploads"], 4)
+        self.assertEqual(coordinator.counts["transactions"], 2)
+        self.assertEqual(
+            self.fetch("SELECT name FROM sqlite_master WHERE type='table' "
+                       "ORDER BY name"), [("t1", ), ("t2", )])
+
+    def test_locked_uploads_are_retried(self):
+        coordinator = Database.LoadCoordinator(self.database)
+        calls = []
+
+        def upload(dbhandle):
+            calls.append(dbhandle.in_transaction)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("database table is locked")
+            dbhandle.execute("CREATE TABLE data (x INT)")
+
+        coordinator.submit(upload, retries=1)
+        coordinator.stop()
+        self.assertEqual(calls, [True, True])
+        self.assertEqual(coordinator.counts["retries"], 1)
+        self.assertEqual(coordinator.counts["transactions"], 2)
+        self.assertEqual(self.fetch("SELECT COUNT(*) FROM data"), [(0, )])
+
+    def test_uploads_are_retried_while_database_is_locked(self):
+        dbh = sqlite3.connect(self.database, isolation_level=None,
+                              check_same_thread=False)
+        dbh.execute("PRAGMA journal_mode = delete")
+        dbh.execute("CREATE TABLE other (x INT)")
+        # hold a shared lock so that the upload can not commit
+        dbh.execute("BEGIN")
+        dbh.execute("SELECT * FROM other").fetchall()
+        release = threading.Timer(0.5, dbh.execute, ("COMMIT", ))
+        release.start()
+
+        saved_journal_mode = P.PARAMS.get("database_journal_mode")
+        P.PARAMS["database_journal_mode"] = "delete"
+        Database.LOAD_COORDINATORS[os.path.abspath(self.database)] = \
+            Database.LoadCoordinator(self.database, timeout=0.1)
+        try:
+            Database.upload_lines(
+                ("%s\n" % x for x in ["track\tvalue", "a\t1", "b\t2"]),
+                os.path.join(self.work_dir, "data.load"),
+                Database.build_load_options("data"))
+        finally:
+            P.PARAMS["database_journal_mode"] = saved_journal_mode
+            release.join()
+            dbh.close()
+        self.assertEqual(self.fetch("SELECT track, value FROM data"),
+                         [("a", 1), ("b", 2)])
+
+    def test_greenlets_are_not_blocked(self):
+        coordinator = Database.LoadCoordinator(self.database)
+        events = []
+
+        def upload(dbhandle):
+            time.sleep(0.5)
+            events.append("upload")
+
+        def tick():
+            for x in range(10):
+                events.append("tick")
+                gevent.sleep(0.01)
+
+        gevent.joinall([gevent.spawn(coordinator.submit, upload),
+                        gevent.spawn(tick)], raise_error=True)
+        coordinator.stop()
+        self.assertEqual(events, ["tick"] * 10 + ["upload"])
+
+    def test_parallel_loads_are_committed(self):
+        infile = self.write_table(
+            "data.tsv", [("track", "value")] + [("t%i" % x, x) for x in range(10)])
+        threads = [threading.Thread(
+            target=P.load,
+            args=(infile, os.path.join(self.work_dir, "data%i.load" % x)))
+            for x in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for x in range(5):
+            self.assertEqual(
+                self.fetch("SELECT COUNT(*) FROM data%i" % x), [(10, )])
+
+
+if __name__ == "__main__":
+    unittest.main()
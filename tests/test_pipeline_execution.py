@@ -1,11 +1,14 @@
 """Test cases for the Pipeline.Execution module."""
 
 import shutil
+import subprocess
 import unittest
 import contextlib
 import socket
 import os
+import tempfile
 import CGATCore.Pipeline as P
+import CGATCore.Pipeline.Execution as Execution
 import CGATCore.IOTools as IOTools
 
 
@@ -21,6 +24,22 @@ def run_on_cluster(to_cluster):
         yield
 
 
+def setUpModule():
+    # keep caches written while loading parameters out of the
+    # user's cache directory
+    global OLD_CACHE_DIR
+    OLD_CACHE_DIR = os.environ.get("CGAT_CACHE_DIR", None)
+    os.environ["CGAT_CACHE_DIR"] = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(os.environ["CGAT_CACHE_DIR"])
+    if OLD_CACHE_DIR is None:
+        del os.environ["CGAT_CACHE_DIR"]
+    else:
+        os.environ["CGAT_CACHE_DIR"] = OLD_CACHE_DIR
+
+
 class BaseTest(unittest.TestCase):
 
     def setUp(self):
@@ -70,6 +89,107 @@ class TestExecutionRun(BaseTest):
         hostname = socket.gethostname()
         self.assertEqual(hostname, execution_hostname)
 
+    def test_staged_job_should_use_local_copies(self):
+        infile = os.path.join(self.work_dir, "in.txt")
+        outfile = os.path.join(self.work_dir, "out.txt")
+        with open(infile, "w") as outf:
+            outf.write("data\n")
+
+        P.run("readlink -f {infile} > {outfile}; cat {infile} >> {outfile}".format(
+            infile=infile, outfile=outfile),
+            infile=infile,
+            outfile=outfile,
+            job_stage_inputs=True,
+            to_cluster=False)
+
+        with IOTools.open_file(outfile) as inf:
+            staged_infile, data = inf.read().splitlines()
+
+        self.assertNotEqual(staged_infile, infile)
+        self.assertTrue(staged_infile.startswith(
+            os.path.realpath(P.PARAMS["tmpdir"])))
+        self.assertFalse(os.path.exists(staged_infile))
+        self.assertEqual(data, "data")
+        self.assertEqual(os.listdir(self.work_dir), ["in.txt", "out.txt"])
+
+    def test_cached_reference_should_be_used(self):
+        reference = os.path.join(self.work_dir, "genome.fa")
+        outfile = os.path.join(self.work_dir, "out.txt")
+        cache_dir = os.path.join(self.work_dir, "cache")
+        with open(reference, "w") as outf:
+            outf.write(">chr1\nACGT\n")
+
+        for x in range(2):
+            P.run("readlink -f {reference} > {outfile}".format(
+                reference=reference, outfile=outfile),
+                reference_genome=reference,
+                reference_cache_dir=cache_dir,
+                job_cache_parameters=["reference_genome"],
+                to_cluster=False)
+
+            with IOTools.open_file(outfile) as inf:
+                cached = inf.read().strip()
+            self.assertTrue(cached.startswith(cache_dir))
+            self.assertEqual(os.path.basename(cached), "genome.fa")
+
+        with IOTools.open_file(os.path.join(cache_dir, "cache.log")) as inf:
+            self.assertEqual([x.split("\t")[2] for x in inf],
+                             ["miss", "hit"])
+
+
+    def test_job_script_should_record_exit_status(self):
+        executor = Execution.LocalExecutor()
+        executor.workingdir = self.work_dir
+        executor.shellfile = None
+        with executor:
+            statement, job_path = executor.build_job_script("exit 3")
+
+        self.assertEqual(subprocess.call(["bash", job_path]), 3)
+        self.assertEqual(Execution.read_exit_status(job_path, attempts=1), 3)
+        os.unlink(job_path + ".exit")
+        self.assertEqual(Execution.read_exit_status(job_path, attempts=1),
+                         None)
+
+    def test_cluster_job_should_choose_temp_dir_on_node(self):
+        dirs = [os.path.join(self.work_dir, x) for x in ("ssd1", "ssd2")]
+        outfile = os.path.join(self.work_dir, "out")
+        executor = Execution.LocalExecutor()
+        executor.select_temp_dir_on_node = True
+        executor.workingdir = self.work_dir
+        executor.shellfile = None
+        saved = P.PARAMS.get("tmpdirs", None)
+        P.PARAMS["tmpdirs"] = dirs
+        try:
+            with executor:
+                statement, job_path = executor.build_job_script(
+                    "echo $TMPDIR > {}".format(outfile))
+        finally:
+            P.PARAMS["tmpdirs"] = saved
+
+        self.assertEqual(subprocess.call(["bash", job_path]), 0)
+        with open(outfile) as inf:
+            tmpdir = inf.read().strip()
+        self.assertIn(os.path.dirname(tmpdir), dirs)
+        self.assertTrue(os.path.basename(tmpdir).startswith(
+            "ctmp-ns-{}-".format(socket.gethostname())))
+        self.assertFalse(os.path.exists(tmpdir))
+
+    def test_temp_space_should_be_released_when_job_completes(self):
+        dirs = [os.path.join(self.work_dir, x) for x in ("ssd1", "ssd2")]
+        executor = Execution.LocalExecutor(job_temp_space="1K")
+        executor.workingdir = self.work_dir
+        executor.shellfile = None
+        saved = P.PARAMS.get("tmpdirs", None)
+        P.PARAMS["tmpdirs"] = dirs
+        try:
+            with executor:
+                executor.run(["true"])
+                self.assertEqual(executor.temp_reservations, {})
+                self.assertEqual(
+                    sum(P.get_temp_dir_selector().reserved.values()), 0)
+        finally:
+            P.PARAMS["tmpdirs"] = saved
+
 
 class TestExecutionRunLocal(unittest.TestCase):
 
@@ -0,0 +1,318 @@
+"""Test cases for the Pipeline.Files module."""
+
+import os
+import shutil
+import subprocess
+import time
+import tempfile
+import unittest
+import CGATCore.Pipeline as P
+import CGATCore.Pipeline.Files as Files
+
+
+def setUpModule():
+    # keep caches written while loading parameters out of the
+    # user's cache directory
+    global OLD_CACHE_DIR
+    OLD_CACHE_DIR = os.environ.get("CGAT_CACHE_DIR", None)
+    os.environ["CGAT_CACHE_DIR"] = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(os.environ["CGAT_CACHE_DIR"])
+    if OLD_CACHE_DIR is None:
+        del os.environ["CGAT_CACHE_DIR"]
+    else:
+        os.environ["CGAT_CACHE_DIR"] = OLD_CACHE_DIR
+
+
+class TestFileMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.filename = os.path.join(self.work_dir, "file.txt")
+        self.cache = Files.FileMetadataCache(maxsize=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def touch(self, filename, content="data"):
+        with open(filename, "w") as outf:
+            outf.write(content)
+
+    def test_stat_is_cached(self):
+        self.touch(self.filename)
+        self.cache.stat(self.filename)
+        self.cache.stat(self.filename)
+        self.assertEqual(self.cache.counts["stat_hits"], 1)
+        self.assertEqual(self.cache.counts["stat_misses"], 1)
+
+    def test_missing_files_are_not_cached(self):
+        self.assertRaises(OSError, self.cache.stat, self.filename)
+        self.touch(self.filename)
+        self.assertEqual(self.cache.stat(self.filename).st_size, 4)
+
+    def test_invalidated_files_are_stat_again(self):
+        self.touch(self.filename)
+        self.assertEqual(self.cache.stat(self.filename).st_size, 4)
+        self.touch(self.filename, "more data")
+        Files.FILE_METADATA_CACHE = self.cache
+        try:
+            Files.invalidate_file_metadata([self.filename])
+        finally:
+            Files.FILE_METADATA_CACHE = None
+        self.assertEqual(self.cache.stat(self.filename).st_size, 9)
+
+    def test_cache_is_bounded(self):
+        for x in range(4):
+            fn = os.path.join(self.work_dir, "file{}.txt".format(x))
+            self.touch(fn)
+            self.cache.stat(fn)
+        self.assertEqual(len(self.cache.caches["stat"]), 2)
+
+    def test_islink_is_derived_from_stat(self):
+        self.touch(self.filename)
+        link = os.path.join(self.work_dir, "link.txt")
+        os.symlink(self.filename, link)
+        self.assertTrue(self.cache.islink(link))
+        self.assertFalse(self.cache.islink(self.filename))
+        self.assertFalse(self.cache.islink(link + ".missing"))
+
+    def test_prefetched_files_are_served_from_cache(self):
+        subdir = os.path.join(self.work_dir, "sub")
+        os.mkdir(subdir)
+        self.touch(os.path.join(subdir, "a.txt"))
+        self.touch(os.path.join(self.work_dir, ".hidden"))
+        cache = Files.FileMetadataCache()
+        self.assertEqual(cache.prefetch(self.work_dir), 2)
+        cache.stat(os.path.join(subdir, "a.txt"))
+        self.assertTrue(os.path.exists(os.path.join(subdir, "a.txt")))
+        self.assertEqual(cache.counts["stat_hits"], 1)
+        self.assertEqual(cache.counts["stat_misses"], 0)
+
+
+class TestTempNamespace(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.namespace = Files.TempNamespace(self.work_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_names_are_unique_and_not_created(self):
+        names = [self.namespace.get_filename() for x in range(100)]
+        self.assertEqual(len(set(names)), 100)
+        self.assertEqual(os.listdir(self.namespace.get_dirname()), [])
+        self.assertEqual(os.path.dirname(names[0]),
+                         self.namespace.get_dirname())
+
+    def test_temp_files_are_created_in_namespace(self):
+        filename = P.get_temp_filename(clear=False)
+        dirname = P.get_temp_dir()
+        try:
+            self.assertTrue(os.path.isfile(filename))
+            self.assertTrue(os.path.isdir(dirname))
+            self.assertEqual(os.path.dirname(filename),
+                             os.path.dirname(dirname))
+            self.assertTrue(os.path.basename(os.path.dirname(filename)).
+                            startswith(Files.TempNamespace.prefix))
+            self.assertFalse(os.path.exists(P.get_temp_filename()))
+        finally:
+            os.unlink(filename)
+            os.rmdir(dirname)
+
+    def test_temp_files_in_explicit_dir_are_kept(self):
+        filename = P.get_temp_filename(dir=self.work_dir, clear=False)
+        dirname = P.get_temp_dir(dir=self.work_dir)
+        with P.get_temp_file(dir=self.work_dir) as outf:
+            self.assertEqual(os.path.dirname(outf.name), self.work_dir)
+        self.assertTrue(os.path.isfile(filename))
+        self.assertTrue(os.path.isdir(dirname))
+        self.assertEqual(os.path.dirname(filename), self.work_dir)
+        self.assertEqual(os.path.dirname(dirname), self.work_dir)
+        self.assertFalse(os.path.exists(
+            P.get_temp_filename(dir=self.work_dir)))
+
+    def test_namespace_is_removed_at_cleanup(self):
+        dirname = self.namespace.get_dirname()
+        with open(self.namespace.get_filename(), "w") as outf:
+            outf.write("data")
+        self.namespace.cleanup()
+        self.assertFalse(os.path.exists(dirname))
+
+    def test_kept_namespace_is_not_removed(self):
+        dirname = self.namespace.get_dirname()
+        self.namespace.keep = True
+        self.namespace.cleanup()
+        self.assertTrue(os.path.exists(dirname))
+
+    def test_stale_namespaces_are_swept(self):
+        # a process that has finished
+        proc = subprocess.Popen(["true"])
+        proc.wait()
+        stale = Files.TempNamespace(self.work_dir)
+        stale.pid = proc.pid
+        old = stale.get_dirname()
+        recent = Files.TempNamespace(self.work_dir)
+        recent.pid = proc.pid
+        recent = recent.get_dirname()
+        running = self.namespace.get_dirname()
+        for dirname in (old, running):
+            os.utime(dirname, (0, 0))
+
+        self.assertEqual(Files.TempNamespace.sweep(self.work_dir, 3600),
+                         [old])
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(running))
+
+    def test_namespaces_of_other_hosts_are_kept_while_refreshed(self):
+        stopped, running = [
+            os.path.join(self.work_dir,
+                         "{}node{}-1-abcdef".format(Files.TempNamespace.prefix, x))
+            for x in range(2)]
+        for dirname in (stopped, running):
+            os.mkdir(dirname)
+            os.utime(dirname, (0, 0))
+
+        # the heartbeat of a process on node1
+        os.utime(running)
+
+        self.assertEqual(Files.TempNamespace.sweep(self.work_dir, 3600),
+                         [stopped])
+        self.assertTrue(os.path.exists(running))
+
+    def test_refresh_updates_namespace(self):
+        dirname = self.namespace.get_dirname()
+        os.utime(dirname, (0, 0))
+        self.namespace.refresh()
+        self.assertGreater(os.stat(dirname).st_mtime, time.time() - 3600)
+
+
+class TestTempDirSelector(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.dirs = [os.path.join(self.work_dir, x) for x in ("ssd1", "ssd2")]
+        self.free = dict((x, 1000) for x in self.dirs)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def make_selector(self, locations, **kwargs):
+        selector = Files.TempDirSelector(locations, **kwargs)
+        selector.get_free_space = lambda dirname: self.free[dirname]
+        return selector
+
+    def test_directories_are_chosen_by_weight(self):
+        selector = self.make_selector([(self.dirs[0], 2), self.dirs[1]])
+        self.assertEqual([selector.select() for x in range(6)],
+                         [self.dirs[0], self.dirs[1], self.dirs[0]] * 2)
+
+    def test_full_directories_are_skipped(self):
+        selector = self.make_selector(self.dirs, min_free=100)
+        self.free[self.dirs[0]] = 150
+        self.assertEqual(set(selector.select(10) for x in range(4)),
+                         set(self.dirs))
+        self.assertEqual(set(selector.select(100) for x in range(4)),
+                         set([self.dirs[1]]))
+
+    def test_reserved_space_is_not_available(self):
+        selector = self.make_selector(self.dirs)
+        selector.reserve(self.dirs[0], 600, "job1")
+        self.assertEqual(set(selector.select(500) for x in range(4)),
+                         set([self.dirs[1]]))
+        selector.release("job1")
+        self.assertEqual(set(selector.select(500) for x in range(4)),
+                         set(self.dirs))
+
+    def test_random_selection_skips_full_directories(self):
+        selector = self.make_selector(self.dirs, min_free=100)
+        self.free[self.dirs[0]] = 150
+        self.assertEqual(
+            set(selector.select(100, randomize=True) for x in range(10)),
+            set([self.dirs[1]]))
+
+    def test_temp_dirs_are_spread_across_locations(self):
+        saved = P.PARAMS.get("tmpdirs", None)
+        P.PARAMS["tmpdirs"] = [{"dir": x} for x in self.dirs]
+        try:
+            tmpdirs = [P.get_temp_dir(size="1K") for x in range(4)]
+            for tmpdir in tmpdirs:
+                P.release_temp_space(tmpdir)
+        finally:
+            P.PARAMS["tmpdirs"] = saved
+        self.assertEqual(
+            [os.path.dirname(os.path.dirname(x)) for x in tmpdirs],
+            self.dirs * 2)
+        self.assertEqual(sum(Files.TEMP_DIR_SELECTOR.reserved.values()), 0)
+
+
+class TestReferenceCache(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.cache_dir = os.path.join(self.work_dir, "cache")
+        self.references = []
+        for x in range(3):
+            fn = os.path.join(self.work_dir, "genome{}.fa".format(x))
+            with open(fn, "w") as outf:
+                outf.write("A" * 100)
+            self.references.append(fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def fetch(self, cache, path):
+        key, sources = Files.ReferenceCache.get_entry(path)
+        return cache.fetch(key, sources)
+
+    def test_entries_are_populated_once(self):
+        cache = Files.ReferenceCache(self.cache_dir)
+        entry = self.fetch(cache, self.references[0])
+        self.assertEqual(self.fetch(cache, self.references[0]), entry)
+        self.assertEqual(cache.counts["miss"], 1)
+        self.assertEqual(cache.counts["hit"], 1)
+        local = os.path.join(entry, "genome0.fa")
+        self.assertFalse(os.path.islink(local))
+        with open(local) as inf:
+            self.assertEqual(inf.read(), "A" * 100)
+
+    def test_modified_files_are_new_entries(self):
+        cache = Files.ReferenceCache(self.cache_dir)
+        entry = self.fetch(cache, self.references[0])
+        with open(self.references[0], "a") as outf:
+            outf.write("C")
+        self.assertNotEqual(self.fetch(cache, self.references[0]), entry)
+
+    def test_prefixes_are_cached(self):
+        cache = Files.ReferenceCache(self.cache_dir)
+        entry = self.fetch(cache, os.path.join(self.work_dir, "genome"))
+        self.assertEqual(sorted(x for x in os.listdir(entry)
+                                if not x.startswith(".")),
+                         ["genome0.fa", "genome1.fa", "genome2.fa"])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = Files.ReferenceCache(self.cache_dir, size=250)
+        first = self.fetch(cache, self.references[0])
+        second = self.fetch(cache, self.references[1])
+        os.utime(first, (0, 0))
+        with cache.lock(os.path.basename(second) + ".lock", shared=True):
+            self.fetch(cache, self.references[2])
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+        self.assertEqual(cache.counts["evict"], 1)
+
+    def test_large_files_are_linked(self):
+        cache = Files.ReferenceCache(self.cache_dir, size=50)
+        entry = self.fetch(cache, self.references[0])
+        self.assertTrue(os.path.islink(os.path.join(entry, "genome0.fa")))
+        self.assertEqual(cache.counts["link"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+"""Test cases for the Pipeline.Parameters module."""
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import CGATCore.Pipeline as P
+import CGATCore.Pipeline.Parameters as Parameters
+
+
+def setUpModule():
+    # keep caches written while loading parameters out of the
+    # user's cache directory
+    global OLD_CACHE_DIR
+    OLD_CACHE_DIR = os.environ.get("CGAT_CACHE_DIR", None)
+    os.environ["CGAT_CACHE_DIR"] = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(os.environ["CGAT_CACHE_DIR"])
+    if OLD_CACHE_DIR is None:
+        del os.environ["CGAT_CACHE_DIR"]
+    else:
+        os.environ["CGAT_CACHE_DIR"] = OLD_CACHE_DIR
+
+
+class TestSubstituteParameters(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.saved = dict(P.PARAMS)
+        P.PARAMS.update({"tophat_threads": 4,
+                         "tophat_cutoff": 0.5,
+                         "sample1.bam.gz_tophat_threads": 6})
+
+    def tearDown(self):
+        P.PARAMS.clear()
+        P.PARAMS.update(self.saved)
+
+    def test_kwargs_take_precedence(self):
+        params = P.substitute_parameters(tophat_cutoff=1.0)
+        self.assertEqual(params["tophat_cutoff"], 1.0)
+        self.assertEqual(params["tophat_threads"], 4)
+
+    def test_task_specific_parameters_are_substituted(self):
+        params = P.substitute_parameters(outfile="sample1.bam.gz")
+        self.assertEqual(params["tophat_threads"], 6)
+        self.assertEqual(params["tophat_cutoff"], 0.5)
+        self.assertEqual(P.PARAMS["tophat_threads"], 4)
+
+    def test_statements_can_be_interpolated(self):
+        params = P.substitute_parameters(outfile="sample1.bam.gz")
+        self.assertEqual("%(outfile)s %(tophat_threads)i" % params,
+                         "sample1.bam.gz 6")
+        self.assertRaises(KeyError, lambda: "%(missing)s" % params)
+
+    def test_writes_do_not_modify_lower_layers(self):
+        kwargs = {"outfile": "a"}
+        params = Parameters.ParameterStack({}, kwargs, P.PARAMS)
+        params["tophat_threads"] = 8
+        params["outfile"] = "b"
+        self.assertEqual(params["tophat_threads"], 8)
+        self.assertEqual(params["outfile"], "b")
+        self.assertEqual(P.PARAMS["tophat_threads"], 4)
+        self.assertEqual(kwargs, {"outfile": "a"})
+
+    def test_task_specific_parameters_are_found_after_changes(self):
+        P.substitute_parameters(outfile="sample2.bam.gz")
+        P.PARAMS["sample2.bam.gz_tophat_threads"] = 2
+        params = P.substitute_parameters(outfile="sample2.bam.gz")
+        self.assertEqual(params["tophat_threads"], 2)
+
+    def test_wildcard_parameters_are_matched(self):
+        P.PARAMS["sample%_tophat_threads"] = 2
+        self.assertEqual(P.match_parameter("tophat_threads"),
+                         "tophat_threads")
+        self.assertEqual(P.match_parameter("sample3_tophat_threads"),
+                         "sample%_tophat_threads")
+        self.assertRaises(KeyError, P.match_parameter, "bowtie_threads")
+
+    def test_missing_keys_are_not_added_to_lower_layers(self):
+        params = Parameters.ParameterStack({}, P.PARAMS)
+        self.assertEqual(params.get("missing"), None)
+        self.assertNotIn("missing", P.PARAMS)
+
+
+class TestConfigCache(unittest.TestCase):
+
+    # number of keys in the benchmark configuration
+    nkeys = 10000
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.old_cache_dir = os.environ.get("CGAT_CACHE_DIR", None)
+        os.environ["CGAT_CACHE_DIR"] = os.path.join(self.work_dir, "cache")
+        self.filename = os.path.join(self.work_dir, "pipeline.yml")
+        with open(self.filename, "w") as outf:
+            for x in range(self.nkeys):
+                outf.write("sample{0}:\n  file: sample{0}.fastq.gz\n"
+                           "  threads: {0}\n".format(x))
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ["CGAT_CACHE_DIR"]
+        else:
+            os.environ["CGAT_CACHE_DIR"] = self.old_cache_dir
+        shutil.rmtree(self.work_dir)
+
+    def test_cached_config_is_used(self):
+        parsed = Parameters.read_config_files([self.filename])
+        self.assertEqual(len(parsed), self.nkeys)
+
+        # replace the snapshot to check that it is read instead of
+        # the configuration file
+        cache_filename, prefix = Parameters.get_config_cache_filename(
+            [self.filename])
+        self.assertTrue(os.path.exists(cache_filename))
+        with open(cache_filename, "wb") as outf:
+            pickle.dump({"cached": True}, outf)
+
+        cached = Parameters.read_config_files([self.filename])
+        self.assertEqual(cached, {"cached": True})
+
+    def test_changed_config_is_parsed_again(self):
+        Parameters.read_config_files([self.filename])
+        with open(self.filename, "a") as outf:
+            outf.write("extra: 1\n")
+        params = Parameters.read_config_files([self.filename])
+        self.assertEqual(params["extra"], 1)
+
+    def test_outdated_snapshots_are_removed(self):
+        other = os.path.join(self.work_dir, "other.yml")
+        with open(other, "w") as outf:
+            outf.write("other: 1\n")
+        Parameters.read_config_files([other])
+
+        for x in range(3):
+            with open(self.filename, "a") as outf:
+                outf.write("extra{}: 1\n".format(x))
+            Parameters.read_config_files([self.filename])
+
+        cache_dir = os.path.join(os.environ["CGAT_CACHE_DIR"], "config")
+        self.assertEqual(
+            sorted(os.listdir(cache_dir)),
+            sorted([os.path.basename(
+                Parameters.get_config_cache_filename([x])[0])
+                for x in (self.filename, other)]))
+
+    def test_python_tags_are_supported(self):
+        with open(self.filename, "w") as outf:
+            outf.write("pair: !!python/tuple [1, 2]\n")
+        params = Parameters.read_config_files([self.filename])
+        self.assertEqual(params["pair"], (1, 2))
+
+
+class TestInputValidation(unittest.TestCase):
+
+    def setUp(self):
+        P.get_parameters()
+        self.work_dir = P.get_temp_dir()
+        self.old_cache_dir = os.environ.get("CGAT_CACHE_DIR", None)
+        os.environ["CGAT_CACHE_DIR"] = os.path.join(self.work_dir, "cache")
+        self.filename = os.path.join(self.work_dir, "genome.fa")
+        with open(self.filename, "w") as outf:
+            outf.write(">chr1\nACGT\n")
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ["CGAT_CACHE_DIR"]
+        else:
+            os.environ["CGAT_CACHE_DIR"] = self.old_cache_dir
+        shutil.rmtree(self.work_dir)
+
+    def test_paths_are_checked(self):
+        missing = os.path.join(self.work_dir, "missing.fa")
+        for x in range(2):
+            readable = Parameters.check_readable_paths(
+                [self.filename, missing, self.filename])
+            self.assertEqual(readable, {self.filename: True,
+                                        missing: False})
+
+    def test_missing_values_raise_error(self):
+        Parameters.input_validation({"genome": self.filename})
+        self.assertRaises(ValueError,
+                          Parameters.input_validation,
+                          {"genome": self.filename, "annotation": "?"})
+
+
+if __name__ == "__main__":
+    unittest.main()